@@ -2,7 +2,7 @@ import asyncio
 import client_pools
 from fastapi import FastAPI, HTTPException, Request, Security, Body, Header, responses, Depends, File, Form
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, RedirectResponse, JSONResponse
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.security import APIKeyHeader
 from contextlib import asynccontextmanager
@@ -36,6 +36,7 @@ from telethon.errors import SessionPasswordNeededError
 import telegram_utils # <-- Добавляем этот импорт
 import inspect
 import redis_utils
+import post_model
 from redis_utils import update_account_usage_redis, reset_account_stats_redis
 import user_manager
 import media_utils
@@ -49,6 +50,9 @@ from telegram_routes import router as telegram_v1_router
 from utils import auto_reset_unused_accounts, clean_orphan_redis_keys, auto_clean_orphan_redis_keys
 from telegram_routes import collect_comments_handler, get_collect_comments_status_handler
 from comment_collector import worker as comment_worker
+from post_jobs import worker as post_jobs_worker, submit_post_job_handler, get_post_job_status_handler
+from channel_directory import DIRECTORY_SOURCES, directory_writer, find_with_directory
+from fast_response import FastJSONResponse, response_cache_key, get_cached_response, cached_json_response
 
 load_dotenv()  # Загружаем .env до импорта модулей
 
@@ -351,6 +355,10 @@ async def lifespan(app: FastAPI):
     comment_worker_task = asyncio.create_task(comment_worker())
     logger.info("Воркер сбора комментариев Telegram запущен.")
 
+    # --- Запуск воркера асинхронных задач сбора постов ---
+    post_jobs_worker_task = asyncio.create_task(post_jobs_worker())
+    logger.info("Воркер асинхронных задач сбора постов запущен.")
+
     logger.info("Приложение готово к работе.")
     
     # --- Работа приложения ---
@@ -376,13 +384,23 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Ошибка при остановке планировщика: {e}", exc_info=True)
 
-    # 3. Закрытие соединения с Redis
+    # 3. Сброс накопленной статистики аккаунтов и закрытие соединения с Redis
+    try:
+        await redis_utils.usage_accumulator.flush()
+        await directory_writer.flush()
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе накопленной статистики аккаунтов и каталога каналов: {e}", exc_info=True)
+    try:
+        await client_pools.vk_transport.close_all()
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии HTTP сессий VK: {e}", exc_info=True)
     if redis_client:
         try:
             logger.info("Закрытие асинхронного соединения с Redis...")
             # --- ИСПРАВЛЕНО ЗДЕСЬ ---
             # Просто вызываем await aclose() для асинхронного клиента
             await redis_client.aclose() # <-- ЗАМЕНА ЗДЕСЬ
+            await redis_utils.close_redis_bytes()
             # Опционально: ожидание закрытия (для некоторых библиотек/версий)
             # if hasattr(redis_client, 'wait_closed'):
             #     await redis_client.wait_closed()
@@ -437,6 +455,16 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Ошибка при остановке воркера сбора комментариев: {e}")
 
+    # 7. Отмена воркера задач сбора постов
+    logger.info("Остановка воркера асинхронных задач сбора постов...")
+    post_jobs_worker_task.cancel()
+    try:
+        await post_jobs_worker_task
+    except asyncio.CancelledError:
+        logger.info("Воркер задач сбора постов успешно остановлен.")
+    except Exception as e:
+        logger.error(f"Ошибка при остановке воркера задач сбора постов: {e}")
+
     logger.info("Приложение успешно остановлено.")
 
 # --- Инициализация FastAPI приложения ---
@@ -978,6 +1006,10 @@ async def find_groups(request: Request):
         platform = data.get("platform", "vk") # Изменено на vk по умолчанию? Или telegram?
         min_members = data.get("min_members", 10000)
         max_count = data.get("max_groups", 20)
+        # local - только локальный каталог, remote - только поиск на платформе, hybrid - каталог + дополнение поиском
+        source = str(data.get("source", "remote")).lower()
+        if source not in DIRECTORY_SOURCES:
+            return JSONResponse(status_code=400, content={"error": f"source должен быть одним из: {', '.join(DIRECTORY_SOURCES)}"})
 
         # Получаем API ключ из заголовка запроса или из тела запроса
         if not api_key:
@@ -1000,6 +1032,11 @@ async def find_groups(request: Request):
 
         # --- УБИРАЕМ создание request_for_auth, т.к. auth_middleware больше не нужен для Telegram ---
 
+        # Поиск только по локальному каталогу не требует клиентов платформы
+        if source == "local" and platform.lower() in ("vk", "telegram"):
+            groups = await find_with_directory(platform.lower(), keywords, min_members, max_count, source, None)
+            return {"groups": groups, "count": len(groups)}
+
         if platform.lower() == "vk":
             # ---> Используем ГЛОБАЛЬНЫЙ экземпляр пула VK <---\
             vk_pool_instance = vk_pool # Обращаемся к глобальной переменной
@@ -1017,7 +1054,10 @@ async def find_groups(request: Request):
                         content={"error": "No VK account available"}
                     )
                 logger.info(f"Получен клиент VK {vk_account_id} для поиска групп.")
-                groups = await find_groups_by_keywords(vk_client, keywords, min_members, max_count, api_key)
+                groups = await find_with_directory(
+                    "vk", keywords, min_members, max_count, source,
+                    lambda: find_groups_by_keywords(vk_client, keywords, min_members, max_count, api_key)
+                )
                 return {"groups": groups, "count": len(groups)}
             except Exception as e:
                 logger.error(f"Error in find_groups for VK: {e}", exc_info=True)
@@ -1045,12 +1085,15 @@ async def find_groups(request: Request):
 
                 logger.info(f"Запуск поиска каналов Telegram с использованием пула...")
                 # ---> Передаем ПУЛ в find_channels, а не клиента <---
-                channels = await find_channels(
-                    telegram_pool=telegram_pool_instance, # <--- Передаем пул
-                    keywords=keywords,
-                    min_members=min_members,
-                    max_channels=max_count,
-                    api_key=api_key # api_key нужен для получения активных аккаунтов внутри
+                channels = await find_with_directory(
+                    "telegram", keywords, min_members, max_count, source,
+                    lambda: find_channels(
+                        telegram_pool=telegram_pool_instance, # <--- Передаем пул
+                        keywords=keywords,
+                        min_members=min_members,
+                        max_channels=max_count,
+                        api_key=api_key # api_key нужен для получения активных аккаунтов внутри
+                    )
                 )
                 logger.info(f"Поиск каналов завершен, найдено: {len(channels)}")
                 return {"groups": channels, "count": len(channels)}
@@ -1072,7 +1115,72 @@ async def find_groups(request: Request):
             content={"error": f"Internal server error: {str(e)}"}
         )
 
-@app.post("/trending-posts")
+def _get_stream_format(request: Request, data: dict) -> Optional[str]:
+    """Потоковый режим ответа: 'ndjson', 'sse' или None (обычный JSON)."""
+    accept = request.headers.get('accept', '')
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    stream = data.get('stream')
+    if stream is True or str(stream).lower() in ('true', '1', 'ndjson'):
+        return 'ndjson'
+    if str(stream).lower() == 'sse':
+        return 'sse'
+    return None
+
+def _stream_channel_results(fetch, stream_format: str) -> StreamingResponse:
+    """Отдает результаты по каналам по мере готовности, в конце - итоговую запись.
+
+    fetch(on_channel_result) - корутина сбора постов (get_trending_posts / get_posts_by_period),
+    вызывающая on_channel_result(channel_id, posts) после каждого канала.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    started_at = time.monotonic()
+    stats = {"channels": 0, "posts": 0}
+
+    async def on_channel_result(channel_id, posts):
+        posts = posts or []
+        stats["channels"] += 1
+        stats["posts"] += len(posts)
+        await queue.put({"type": "channel", "channel_id": str(channel_id), "posts": posts})
+
+    async def run_fetch():
+        summary = {"type": "summary", "status": "ok"}
+        try:
+            all_posts = await fetch(on_channel_result)
+            summary["total_posts"] = len(all_posts) if isinstance(all_posts, list) else stats["posts"]
+        except Exception as e:
+            logger.error(f"Ошибка при потоковой выдаче постов: {e}", exc_info=True)
+            summary.update({"status": "error", "error": str(e), "total_posts": stats["posts"]})
+        summary["channels"] = stats["channels"]
+        summary["elapsed_seconds"] = round(time.monotonic() - started_at, 2)
+        await queue.put(summary)
+        await queue.put(None)
+
+    def format_record(record: dict) -> bytes:
+        payload = post_model.dumps(record)
+        if stream_format == 'sse':
+            return b"event: " + record['type'].encode() + b"\ndata: " + payload + b"\n\n"
+        return payload + b"\n"
+
+    async def body():
+        fetch_task = asyncio.create_task(run_fetch())
+        try:
+            while True:
+                record = await queue.get()
+                if record is None:
+                    break
+                yield format_record(record)
+        finally:
+            if not fetch_task.done():
+                # Клиент отключился - прекращаем сбор
+                fetch_task.cancel()
+
+    media_type = "text/event-stream" if stream_format == 'sse' else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type)
+
+@app.post("/trending-posts", response_class=FastJSONResponse)
 async def trending_posts(request: Request, data: dict):
     # Инициализируем планировщик медиа
     from media_utils import init_scheduler
@@ -1119,6 +1227,38 @@ async def trending_posts(request: Request, data: dict):
         if api_key is None:
             logger.error("API ключ не предоставлен")
             raise HTTPException(status_code=401, detail="API ключ не предоставлен")
+        # Ключ проверяется до чтения кэша: закэшированные результаты собраны аккаунтами других пользователей
+        if not await verify_api_key(api_key):
+            raise HTTPException(status_code=401, detail="Неверный API ключ")
+        stream_format = _get_stream_format(request, data)
+        if stream_format:
+            return _stream_channel_results(
+                lambda on_channel_result: get_trending_posts(
+                    telegram_pool=telegram_pool_instance,
+                    channel_ids=group_ids,
+                    days_back=days_back,
+                    posts_per_channel=posts_per_group,
+                    min_views=min_views,
+                    min_reactions=data.get('min_reactions'),
+                    min_comments=data.get('min_comments'),
+                    min_forwards=data.get('min_forwards'),
+                    api_key=api_key,
+                    on_channel_result=on_channel_result,
+                    total_limit=data.get('total_limit'),
+                    score_formula=data.get('score_formula')
+                ),
+                stream_format
+            )
+        cache_key = response_cache_key('trending', api_key, {
+            'group_ids': group_ids, 'days_back': days_back, 'posts_per_group': posts_per_group, 'min_views': min_views,
+            'min_reactions': data.get('min_reactions'), 'min_comments': data.get('min_comments'),
+            'min_forwards': data.get('min_forwards'), 'total_limit': data.get('total_limit'),
+            'score_formula': data.get('score_formula'),
+        })
+        cached_body = await get_cached_response(cache_key)
+        if cached_body is not None:
+            logger.info(f"trending-posts: ответ для {len(group_ids)} каналов отдан из кэша")
+            return FastJSONResponse(cached_body)
         try:
             # ---> Прямой вызов get_trending_posts с пулом <---
             result = await get_trending_posts(
@@ -1131,9 +1271,11 @@ async def trending_posts(request: Request, data: dict):
                 min_reactions=data.get('min_reactions'), # Передаем остальные параметры, если они есть
                 min_comments=data.get('min_comments'),
                 min_forwards=data.get('min_forwards'),
-                api_key=api_key
+                api_key=api_key,
+                total_limit=data.get('total_limit'), # Сколько лучших постов вернуть всего (по умолчанию все)
+                score_formula=data.get('score_formula') # engagement (по умолчанию), time_decay, channel_zscore
             )
-            return result
+            return await cached_json_response(cache_key, result)
 
         except Exception as e:
             logger.error(f"Ошибка в trending_posts для Telegram: {e}", exc_info=True)
@@ -1151,6 +1293,8 @@ async def trending_posts(request: Request, data: dict):
         if api_key is None: # Добавим проверку ключа и для VK
             logger.error("API ключ не предоставлен для VK")
             raise HTTPException(status_code=401, detail="API ключ не предоставлен")
+        if not await verify_api_key(api_key):
+            raise HTTPException(status_code=401, detail="Неверный API ключ")
 
         try:
              vk_client, vk_account_id = await vk_pool_instance.select_next_client(api_key)
@@ -1167,14 +1311,14 @@ async def trending_posts(request: Request, data: dict):
                       gid_str = f"-{gid_str}"
                   formatted_group_ids.append(gid_str)
 
-             return await get_vk_posts_in_groups(vk_client, formatted_group_ids, count=posts_per_group * len(group_ids), min_views=min_views, days_back=days_back)
+             return FastJSONResponse(await get_vk_posts_in_groups(vk_client, formatted_group_ids, count=posts_per_group * len(group_ids), min_views=min_views, days_back=days_back, score_formula=data.get('score_formula')))
         except Exception as e:
             logger.error(f"Ошибка в trending_posts для VK: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"Ошибка при получении трендовых постов VK: {str(e)}")
 
     raise HTTPException(400, "Платформа не поддерживается")
 
-@app.post("/posts")
+@app.post("/posts", response_class=FastJSONResponse)
 async def get_posts(request: Request, data: dict):
     """Получение постов из групп по ключевым словам."""
     api_key = request.headers.get('api-key') or request.headers.get('x-api-key')
@@ -1199,6 +1343,7 @@ async def get_posts(request: Request, data: dict):
     max_groups = data.get('max_groups', data.get('maxGroups', 10))
     max_posts_per_group = data.get('max_posts_per_group', data.get('maxPostsPerGroup', 300))
     group_ids = data.get('group_ids', data.get('groupIds', None))
+    search_mode = data.get('search_mode', data.get('searchMode', 'wall')) # wall (по умолчанию) | search | auto
     
     logger.info(f"Получение постов с параметрами: platform={platform}, group_keywords={group_keywords}, search_keywords={search_keywords}")
     
@@ -1228,6 +1373,18 @@ async def get_posts(request: Request, data: dict):
                     count, 
                     min_views, 
                     days_back, 
+                    max_posts_per_group,
+                    search_mode=search_mode
+                )
+            elif search_keywords and not group_keywords:
+                # Только ключевые слова постов - поиск по всему VK через newsfeed.search
+                posts = await get_vk_posts_in_groups(
+                    vk, 
+                    [], 
+                    search_keywords, 
+                    count, 
+                    min_views, 
+                    days_back, 
                     max_posts_per_group
                 )
             else:
@@ -1240,15 +1397,16 @@ async def get_posts(request: Request, data: dict):
                     min_views, 
                     days_back, 
                     max_groups, 
-                    max_posts_per_group
+                    max_posts_per_group,
+                    search_mode=search_mode
                 )
             
             # Если запрос был в формате JS-версии, форматируем ответ соответствующим образом
             if 'groupKeywords' in data and group_keywords:
                 # Возвращаем результат в формате JS-версии {keyword: posts[]}
-                return {group_keywords[0] if isinstance(group_keywords, list) else group_keywords: posts}
+                return FastJSONResponse({group_keywords[0] if isinstance(group_keywords, list) else group_keywords: posts})
             
-            return posts
+            return FastJSONResponse(posts)
             
         except Exception as e:
             import traceback
@@ -1279,7 +1437,7 @@ async def posts_by_keywords(request: Request, data: dict):
         return await get_vk_posts(vk, group_keywords, post_keywords, count, min_views, days_back, max_groups)
     raise HTTPException(400, "Платформа не поддерживается")
 
-@app.post("/posts-by-period")
+@app.post("/posts-by-period", response_class=FastJSONResponse)
 async def get_posts_by_period(request: Request, data: dict):
     # Инициализируем планировщик медиа
     from media_utils import init_scheduler
@@ -1324,6 +1482,31 @@ async def get_posts_by_period(request: Request, data: dict):
                  raise HTTPException(status_code=401, detail="Неверный API ключ")
             # +++ КОНЕЦ: ДОБАВИТЬ ИСПОЛЬЗОВАНИЕ ПУЛА НАПРЯМУЮ +++
 
+            stream_format = _get_stream_format(request, data)
+            if stream_format:
+                return _stream_channel_results(
+                    lambda on_channel_result: get_posts_by_period(
+                        telegram_pool=telegram_pool,
+                        group_ids=group_ids,
+                        limit_per_channel=max_posts,
+                        days_back=days_back,
+                        min_views=min_views,
+                        api_key=api_key,
+                        on_channel_result=on_channel_result,
+                        total_limit=data.get('total_limit')
+                    ),
+                    stream_format
+                )
+
+            cache_key = response_cache_key('period', api_key, {
+                'group_ids': group_ids, 'max_posts': max_posts,
+                'days_back': days_back, 'min_views': min_views, 'total_limit': data.get('total_limit'),
+            })
+            cached_body = await get_cached_response(cache_key)
+            if cached_body is not None:
+                logger.info(f"posts-by-period: ответ для {len(group_ids)} каналов отдан из кэша")
+                return FastJSONResponse(cached_body)
+
             # Вызываем get_posts_by_period напрямую с пулом
             result = await get_posts_by_period(
                 telegram_pool=telegram_pool, # <<< Передаем глобальный пул
@@ -1331,10 +1514,11 @@ async def get_posts_by_period(request: Request, data: dict):
                 limit_per_channel=max_posts,
                 days_back=days_back,
                 min_views=min_views,
-                api_key=api_key
+                api_key=api_key,
+                total_limit=data.get('total_limit') # Сколько самых новых постов вернуть всего (по умолчанию все)
                 # non_blocking и is_degraded больше не передаются
             )
-            return result
+            return await cached_json_response(cache_key, result)
         except HTTPException as http_exc:
              # Перебрасываем HTTP исключения дальше
              raise http_exc
@@ -1458,7 +1642,7 @@ async def get_posts_by_period(request: Request, data: dict):
             final_posts = all_posts[:max_posts]
 
             logger.info(f"VK: Завершена обработка постов за период. Найдено {len(final_posts)} постов.")
-            return {"posts": final_posts} # Формат ответа {"posts": [...]}
+            return FastJSONResponse({"posts": final_posts}) # Формат ответа {"posts": [...]}
 
         except HTTPException as http_exc:
             raise http_exc # Перебрасываем HTTP исключения
@@ -1475,6 +1659,18 @@ async def collect_comments(request: Request, data: dict):
 async def collect_comments_status(task_id: str):
     return await get_collect_comments_status_handler(task_id)
 
+@app.post("/jobs/trending-posts")
+async def submit_trending_posts_job(request: Request, data: dict):
+    return await submit_post_job_handler(request, data, "trending")
+
+@app.post("/jobs/posts-by-period")
+async def submit_posts_by_period_job(request: Request, data: dict):
+    return await submit_post_job_handler(request, data, "period")
+
+@app.get("/jobs/{job_id}", response_class=FastJSONResponse)
+async def post_job_status(job_id: str, include_partial: bool = True):
+    return FastJSONResponse(await get_post_job_status_handler(job_id, include_partial))
+
 @app.get("/api/accounts/status")
 async def get_accounts_status(api_key: str = Header(...)):
     """Получает статус всех аккаунтов."""
@@ -3725,7 +3921,7 @@ async def test_vk_tokens(request: Request):
         logger.error(f"Трассировка: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка при тестировании токенов VK: {str(e)}")
 
-@app.post("/bulk-posts")
+@app.post("/bulk-posts", response_class=FastJSONResponse)
 async def bulk_posts(request: Request, data: dict):
     """Получение постов из групп по нескольким ключевым словам с возвратом сгруппированных результатов."""
     api_key = request.headers.get('api-key') or request.headers.get('x-api-key')
@@ -3751,6 +3947,7 @@ async def bulk_posts(request: Request, data: dict):
     max_groups = data.get('max_groups', data.get('maxGroups', 10))
     max_posts_per_group = data.get('max_posts_per_group', data.get('maxPostsPerGroup', 300))
     group_ids = data.get('group_ids', data.get('groupIds', None))
+    search_mode = data.get('search_mode', data.get('searchMode', 'wall')) # wall (по умолчанию) | search | auto
     
     logger.info(f"Получение постов для нескольких ключевых слов: {group_keywords}, search_keywords={search_keywords}")
     
@@ -3782,7 +3979,8 @@ async def bulk_posts(request: Request, data: dict):
                 count, 
                 min_views, 
                 days_back, 
-                max_posts_per_group
+                max_posts_per_group,
+                search_mode=search_mode
             )
             
             # Используем первое ключевое слово как ключ
@@ -3800,13 +3998,14 @@ async def bulk_posts(request: Request, data: dict):
                     min_views, 
                     days_back, 
                     max_groups, 
-                    max_posts_per_group
+                    max_posts_per_group,
+                    search_mode=search_mode
                 )
                 
                 # Добавляем результат в словарь с ключом = ключевому слову
                 result[keyword] = posts
         
-        return result
+        return FastJSONResponse(result)
     
     except Exception as e:
         import traceback
@@ -0,0 +1,209 @@
+"""Локальный каталог каналов/групп (PostgreSQL) для ответа на /find-groups без обращения к платформам.
+
+Каналы, найденные поиском, trending, сбором постов и комментариев, накапливаются в памяти
+и пакетно сохраняются в таблицу channel_directory. Поиск идет по подстроке в search_text
+(ILIKE ускоряется триграммным GIN-индексом, если доступно расширение pg_trgm).
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from user_manager import get_db_pool
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY_FLUSH_INTERVAL = float(os.getenv('DIRECTORY_FLUSH_INTERVAL', '5.0'))
+# Через сколько запись считается устаревшей для режима hybrid (обновляется удаленным поиском)
+DIRECTORY_STALE_AFTER = timedelta(hours=float(os.getenv('DIRECTORY_STALE_AFTER_HOURS', '72')))
+DIRECTORY_SOURCES = ('local', 'remote', 'hybrid')
+
+
+async def init_channel_directory(conn: asyncpg.Connection):
+    """Создает таблицу каталога и индексы (вызывается из init_db)."""
+    await conn.execute('''
+    CREATE TABLE IF NOT EXISTS channel_directory (
+        platform TEXT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        username TEXT,
+        title TEXT,
+        description TEXT,
+        members_count INTEGER,
+        is_closed BOOLEAN DEFAULT FALSE,
+        search_text TEXT NOT NULL DEFAULT '',
+        last_seen TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (platform, channel_id)
+    )''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_channel_directory_members ON channel_directory (platform, members_count DESC)')
+    # Записи Telegram без username (приватные каналы) раньше сохранялись открытыми - скрываем их из общего поиска
+    await conn.execute("UPDATE channel_directory SET is_closed = TRUE WHERE platform = 'telegram' AND username IS NULL AND NOT is_closed")
+    # pg_trgm может быть недоступен (нет прав) - тогда поиск работает без индекса
+    try:
+        async with conn.transaction():
+            await conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_channel_directory_search_trgm ON channel_directory USING GIN (search_text gin_trgm_ops)')
+    except Exception as e:
+        logger.warning(f"Триграммный индекс каталога каналов не создан (pg_trgm недоступен?): {e}")
+    logger.info("Таблица 'channel_directory' проверена/создана.")
+
+
+def _search_text(*parts: Optional[str]) -> str:
+    return ' '.join(part.lower() for part in parts if part)
+
+
+class ChannelDirectoryWriter:
+    """Буфер записей каталога в памяти с периодическим пакетным upsert в PostgreSQL."""
+
+    def __init__(self, flush_interval: float = DIRECTORY_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(self, platform: str, channel_id, title: Optional[str] = None, username: Optional[str] = None,
+               members_count: Optional[int] = None, description: Optional[str] = None, is_closed: bool = False):
+        """Запоминает канал (без обращения к БД). Повторные записи одного канала объединяются."""
+        try:
+            channel_id = abs(int(channel_id))
+        except (TypeError, ValueError):
+            return
+        key = (platform, channel_id)
+        entry = self._pending.get(key, {})
+        # Не затираем известные значения пустыми (например, members_count из другого источника)
+        for field, value in (('title', title), ('username', username), ('members_count', members_count),
+                             ('description', description)):
+            if value is not None:
+                entry[field] = value
+        entry['is_closed'] = bool(is_closed)
+        self._pending[key] = entry
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        except RuntimeError:
+            self._flush_task = None
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Сохраняет накопленные записи одним executemany. Возвращает число записей."""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [
+            (platform, channel_id, entry.get('username'), entry.get('title'), entry.get('description'),
+             entry.get('members_count'), entry.get('is_closed', False),
+             _search_text(entry.get('title'), entry.get('username'), entry.get('description')))
+            for (platform, channel_id), entry in pending.items()
+        ]
+        try:
+            pool = await get_db_pool()
+            async with pool.acquire() as conn:
+                await conn.executemany('''
+                    INSERT INTO channel_directory
+                        (platform, channel_id, username, title, description, members_count, is_closed, search_text, last_seen)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, CURRENT_TIMESTAMP)
+                    ON CONFLICT (platform, channel_id) DO UPDATE SET
+                        username = COALESCE(EXCLUDED.username, channel_directory.username),
+                        title = COALESCE(EXCLUDED.title, channel_directory.title),
+                        description = COALESCE(EXCLUDED.description, channel_directory.description),
+                        members_count = COALESCE(EXCLUDED.members_count, channel_directory.members_count),
+                        is_closed = EXCLUDED.is_closed,
+                        search_text = CASE WHEN EXCLUDED.search_text <> '' THEN EXCLUDED.search_text ELSE channel_directory.search_text END,
+                        last_seen = CURRENT_TIMESTAMP
+                ''', rows)
+            logger.debug(f"Каталог каналов: сохранено {len(rows)} записей")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {len(rows)} записей в каталог каналов: {e}")
+            for key, entry in pending.items():
+                self._pending.setdefault(key, entry)
+            return 0
+
+
+directory_writer = ChannelDirectoryWriter()
+
+
+def _format_row(platform: str, row) -> Dict[str, Any]:
+    """Приводит запись каталога к формату ответа /find-groups соответствующей платформы."""
+    if platform == 'vk':
+        return {
+            "id": f"-{row['channel_id']}",
+            "name": row['title'] or "",
+            "members": row['members_count'] or 0,
+            "is_closed": 1 if row['is_closed'] else 0,
+        }
+    username = row['username']
+    return {
+        'id': row['channel_id'],
+        'title': row['title'],
+        'username': username,
+        'link': f"https://t.me/{username}" if username else None,
+        'members_count': row['members_count'],
+    }
+
+def _members_of(platform: str, item: Dict) -> int:
+    return (item.get('members') if platform == 'vk' else item.get('members_count')) or 0
+
+
+async def search_local(platform: str, keywords: List[str], min_members: int = 0, max_count: int = 20) -> Tuple[List[Dict], bool]:
+    """Ищет каналы в каталоге по подстроке в названии/username/описании.
+
+    Returns:
+        (список в формате платформы, все ли найденные записи свежие)
+    """
+    patterns = [f"%{kw.strip().lower()}%" for kw in keywords if kw and kw.strip()]
+    if not patterns:
+        return [], False
+    try:
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT channel_id, username, title, members_count, is_closed, last_seen
+                FROM channel_directory
+                WHERE platform = $1 AND search_text ILIKE ANY($2::text[])
+                  AND COALESCE(members_count, 0) >= $3 AND NOT is_closed
+                ORDER BY members_count DESC NULLS LAST
+                LIMIT $4
+            ''', platform, patterns, min_members, max_count)
+    except Exception as e:
+        logger.error(f"Ошибка поиска в каталоге каналов ({platform}): {e}")
+        return [], False
+    stale_before = datetime.now(timezone.utc) - DIRECTORY_STALE_AFTER
+    all_fresh = all(row['last_seen'] and row['last_seen'] >= stale_before for row in rows)
+    return [_format_row(platform, row) for row in rows], all_fresh
+
+
+async def find_with_directory(platform: str, keywords: List[str], min_members: int, max_count: int, source: str,
+                              remote_search: Callable[[], Awaitable[List[Dict]]]) -> List[Dict]:
+    """Поиск групп с учетом источника: local (только каталог), remote (только платформа), hybrid.
+
+    В режиме hybrid удаленный поиск запускается, только если локально найдено меньше
+    max_count каналов или среди найденных есть устаревшие записи.
+    """
+    if isinstance(keywords, str):
+        keywords = [keywords]
+    if source not in DIRECTORY_SOURCES:
+        source = 'remote'
+
+    if source == 'remote':
+        return await remote_search()
+
+    local_results, all_fresh = await search_local(platform, keywords, min_members, max_count)
+    if source == 'local' or (len(local_results) >= max_count and all_fresh):
+        logger.info(f"Каталог каналов ({platform}): {len(local_results)} результатов из локального каталога")
+        return local_results
+
+    logger.info(f"Каталог каналов ({platform}): локально {len(local_results)} из {max_count} (свежие: {all_fresh}), дополняем удаленным поиском")
+    remote_results = await remote_search()
+    merged = {str(item.get('id')): item for item in local_results}
+    merged.update({str(item.get('id')): item for item in remote_results or []}) # Удаленные данные свежее
+    return sorted(merged.values(), key=lambda item: _members_of(platform, item), reverse=True)[:max_count]
@@ -10,7 +10,8 @@ from datetime import datetime, timezone, timedelta
 from urllib.parse import urlparse
 import re
 import traceback
-from redis_utils import get_account_stats_redis
+import aiohttp
+from redis_utils import get_account_stats_redis, park_account_redis, get_parked_accounts_redis
 from user_manager import get_active_accounts, update_account_usage
 
 # --- Добавляем константу задержки (если ее нет) ---
@@ -21,6 +22,73 @@ TELEGRAM_DEGRADED_MODE_DELAY = 0.5 # Секунды
 
 logger = logging.getLogger(__name__)
 
+# --- Темп запросов Telegram на аккаунт (token bucket по классам запросов) ---
+# Класс запроса -> (запросов в секунду, емкость корзины)
+TELEGRAM_PACING_RATES = {
+    'default': (1.0, 3),
+    'search': (0.2, 2),
+    'history': (1.0, 3),
+    'full_channel': (0.5, 3),
+    'download': (0.5, 2),
+}
+# Общий множитель скорости (например, 1.5 для более агрессивного темпа на проверенных аккаунтах)
+TELEGRAM_PACING_SCALE = float(os.getenv('TG_PACING_SCALE', '1.0'))
+
+
+class AccountPacer:
+    """Token bucket для одного аккаунта Telegram, общий для всех запросов через этот аккаунт."""
+
+    def __init__(self, account_id: str, rates: Optional[Dict[str, Tuple[float, int]]] = None):
+        self.account_id = account_id
+        self.rates = rates or TELEGRAM_PACING_RATES
+        self.degraded = False
+        now = time.monotonic()
+        self._tokens = {request_class: float(capacity) for request_class, (_, capacity) in self.rates.items()}
+        self._updated = {request_class: now for request_class in self.rates}
+        self._lock = asyncio.Lock()
+
+    def _rate(self, request_class: str) -> float:
+        rate = self.rates[request_class][0] * TELEGRAM_PACING_SCALE
+        return rate / 2 if self.degraded else rate # В режиме деградации темп вдвое ниже
+
+    def _refill(self, request_class: str, now: float):
+        capacity = self.rates[request_class][1]
+        elapsed = now - self._updated[request_class]
+        self._tokens[request_class] = min(capacity, self._tokens[request_class] + elapsed * self._rate(request_class))
+        self._updated[request_class] = now
+
+    async def acquire(self, request_class: str = 'default', cost: float = 1.0) -> float:
+        """Ждет токен нужного класса. Возвращает время ожидания в секундах."""
+        if request_class not in self.rates:
+            request_class = 'default'
+        waited = 0.0
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                self._refill(request_class, now)
+                if self._tokens[request_class] >= cost:
+                    self._tokens[request_class] -= cost
+                    if waited:
+                        logger.debug(f"[Acc: {self.account_id}] Pacing '{request_class}': ожидание {waited:.2f} сек.")
+                    return waited
+                wait_time = (cost - self._tokens[request_class]) / self._rate(request_class)
+            await asyncio.sleep(wait_time)
+            waited += wait_time
+
+    def get_budget(self) -> Dict[str, Dict[str, float]]:
+        """Текущий бюджет по классам запросов: доступные токены, скорость и емкость."""
+        now = time.monotonic()
+        budget = {}
+        for request_class, (_, capacity) in self.rates.items():
+            self._refill(request_class, now)
+            budget[request_class] = {
+                'tokens': round(self._tokens[request_class], 2),
+                'rate_per_sec': round(self._rate(request_class), 3),
+                'capacity': capacity
+            }
+        return budget
+# -----------------------------------------------
+
 class ClientPool:
     """Базовый класс для пула клиентов."""
     
@@ -41,6 +109,14 @@ class ClientPool:
         """
         logger.info(f"Получение клиента {self.platform} для аккаунта {account_id}")
         return self.clients.get(account_id)
+
+    def get_account_id_by_client(self, client: Any) -> Optional[str]:
+        """Обратный поиск: ID аккаунта, которому принадлежит объект клиента."""
+        for account_id, pool_client in self.clients.items():
+            if pool_client is client:
+                return str(account_id)
+        return None
+
     def add_client(self, account_id: str, client: Any) -> None:
         """Добавляет клиент в пул."""
         if not account_id:
@@ -126,12 +202,94 @@ class ClientPool:
         raise NotImplementedError("Метод должен быть реализован в подклассе")
 
 
+# --- HTTP-транспорт VK: долгоживущие сессии на пару (аккаунт, прокси) ---
+VK_HTTP_LIMIT = int(os.getenv('VK_HTTP_LIMIT', '20')) # Соединений на одну сессию
+VK_HTTP_LIMIT_PER_HOST = int(os.getenv('VK_HTTP_LIMIT_PER_HOST', '8'))
+VK_HTTP_KEEPALIVE = float(os.getenv('VK_HTTP_KEEPALIVE', '60')) # Сколько держать простаивающее соединение (сек)
+VK_HTTP_DNS_TTL = int(os.getenv('VK_HTTP_DNS_TTL', '300'))
+VK_HTTP_TIMEOUT = float(os.getenv('VK_HTTP_TIMEOUT', '30'))
+
+
+class VKTransport:
+    """Общие aiohttp-сессии для всех запросов к VK.
+
+    На каждую пару (аккаунт, прокси) создается одна сессия со своим коннектором
+    (keep-alive, кэш DNS, лимиты соединений), поэтому TCP/SOCKS/TLS-рукопожатие
+    выполняется один раз, а не на каждый вызов API.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[Tuple[str, str], Tuple[aiohttp.ClientSession, Optional[str]]] = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _connector_kwargs() -> Dict[str, Any]:
+        return {
+            'limit': VK_HTTP_LIMIT,
+            'limit_per_host': VK_HTTP_LIMIT_PER_HOST,
+            'keepalive_timeout': VK_HTTP_KEEPALIVE,
+            'ttl_dns_cache': VK_HTTP_DNS_TTL,
+        }
+
+    def _create_session(self, proxy_url: Optional[str]) -> Tuple[aiohttp.ClientSession, Optional[str]]:
+        """Возвращает (сессия, прокси для передачи в запрос). SOCKS-прокси встроен в коннектор."""
+        timeout = aiohttp.ClientTimeout(total=VK_HTTP_TIMEOUT)
+        if proxy_url and not proxy_url.startswith(('http://', 'https://')):
+            try:
+                from aiohttp_socks import ProxyConnector
+                connector = ProxyConnector.from_url(proxy_url, **self._connector_kwargs())
+                return aiohttp.ClientSession(connector=connector, timeout=timeout), None
+            except ImportError:
+                logger.warning("Библиотека aiohttp-socks не установлена, но требуется для SOCKS прокси. Сессия VK создана без прокси.")
+                proxy_url = None
+        connector = aiohttp.TCPConnector(**self._connector_kwargs())
+        return aiohttp.ClientSession(connector=connector, timeout=timeout), proxy_url
+
+    async def get_session(self, account_id: Optional[str], proxy: Optional[str] = None) -> Tuple[aiohttp.ClientSession, Optional[str]]:
+        """Сессия для аккаунта и прокси. Возвращает (сессия, прокси для параметра proxy= запроса)."""
+        proxy_url = proxy
+        if proxy_url and '://' not in proxy_url:
+            proxy_url = 'http://' + proxy_url
+        key = (str(account_id or ''), proxy_url or '')
+        entry = self._sessions.get(key)
+        if entry and not entry[0].closed:
+            return entry
+        async with self._lock:
+            entry = self._sessions.get(key)
+            if entry and not entry[0].closed:
+                return entry
+            entry = self._create_session(proxy_url)
+            self._sessions[key] = entry
+            logger.info(f"Создана HTTP сессия VK для аккаунта {account_id or '-'} ({'через прокси' if proxy_url else 'без прокси'})")
+            return entry
+
+    async def close_account(self, account_id: str):
+        """Закрывает сессии аккаунта (например, после смены прокси или удаления)."""
+        for key in [key for key in self._sessions if key[0] == str(account_id)]:
+            session, _ = self._sessions.pop(key)
+            await session.close()
+
+    async def close_all(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session, _ in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии HTTP сессии VK: {e}")
+        if sessions:
+            logger.info(f"Закрыто HTTP сессий VK: {len(sessions)}")
+
+
+vk_transport = VKTransport()
+
+
 class VKClientPool(ClientPool):
     """Пул клиентов VK."""
     
     def __init__(self):
         super().__init__()
         self.platform = 'vk'
+        self.transport = vk_transport # Общие HTTP-сессии для всех клиентов VK
         self.max_retries = 3
         self.retry_delay = 5  # секунды
         self.current_index = 0
@@ -660,6 +818,9 @@ async def create_telegram_client(
 
 class TelegramClientPool(ClientPool):
     """Пул клиентов Telegram."""
+
+    # Темп запросов на аккаунт общий для всех экземпляров пула и TelegramClientWrapper
+    _pacers: Dict[str, AccountPacer] = {}
     
     def __init__(self):
         super().__init__()
@@ -675,11 +836,57 @@ class TelegramClientPool(ClientPool):
         self.usage_counts: Dict[str, int] = {} # (IDs as strings)
         self.last_used: Dict[str, datetime] = {} # (IDs as strings)
         self.active_accounts: Dict[str, Dict] = {} # Инициализируем active_accounts (IDs as strings)
-
-    async def get_active_clients(self, api_key):
+        self.parked_until: Dict[str, float] = {} # Аккаунты после FloodWait: {'account_id': available_at} (IDs as strings)
+
+    @classmethod
+    def get_pacer(cls, account_id: Union[int, str]) -> AccountPacer:
+        """Возвращает (создает при необходимости) pacer аккаунта."""
+        account_id_str = str(account_id)
+        pacer = cls._pacers.get(account_id_str)
+        if pacer is None:
+            pacer = AccountPacer(account_id_str)
+            cls._pacers[account_id_str] = pacer
+        return pacer
+
+    def get_pacing_budget(self, account_id: Union[int, str]) -> Dict[str, Dict[str, float]]:
+        """Текущий бюджет запросов аккаунта по классам (search, history, full_channel, download)."""
+        return self.get_pacer(account_id).get_budget()
+
+    async def park_account(self, account_id: Union[int, str], seconds: int):
+        """Паркует аккаунт после FloodWait: до available_at он не выдается пулом (состояние хранится в Redis)."""
+        account_id_str = str(account_id)
+        available_at = time.time() + max(int(seconds or 0), 1)
+        if available_at <= self.parked_until.get(account_id_str, 0):
+            return
+        self.parked_until[account_id_str] = available_at
+        logger.warning(f"Аккаунт {self.platform} {account_id_str} припаркован на {seconds} сек. из-за FloodWait")
+        await park_account_redis(account_id_str, self.platform, available_at)
+
+    async def get_parked_accounts(self, account_ids: List[Union[int, str]]) -> Dict[str, float]:
+        """Возвращает {account_id: available_at} для припаркованных аккаунтов (память процесса + Redis)."""
+        now = time.time()
+        self.parked_until = {acc_id: until for acc_id, until in self.parked_until.items() if until > now}
+        account_ids_str = [str(acc_id) for acc_id in account_ids]
+        parked = {acc_id: self.parked_until[acc_id] for acc_id in account_ids_str if acc_id in self.parked_until}
+        parked_redis = await get_parked_accounts_redis(account_ids_str, self.platform)
+        for acc_id, until in parked_redis.items():
+            parked[acc_id] = max(until, parked.get(acc_id, 0))
+        return parked
+
+    async def exclude_parked_accounts(self, accounts: List[Dict]) -> List[Dict]:
+        """Убирает из списка аккаунтов припаркованные после FloodWait."""
+        parked = await self.get_parked_accounts([acc['id'] for acc in accounts])
+        if not parked:
+            return accounts
+        logger.info(f"Исключены припаркованные аккаунты {self.platform}: " + ", ".join(f"{acc_id} (еще {int(until - time.time())} сек.)" for acc_id, until in parked.items()))
+        return [acc for acc in accounts if str(acc['id']) not in parked]
+
+    async def get_active_clients(self, api_key, include_parked: bool = False):
         logger.info(f"[TelegramClientPool.get_active_clients] Вход для api_key={api_key}. Stacktrace:\n{''.join(traceback.format_stack(limit=5))}")
         from user_manager import get_active_accounts
         active_accounts = await get_active_accounts(api_key, "telegram")
+        if not include_parked:
+            active_accounts = await self.exclude_parked_accounts(active_accounts)
         
         # Проверяем, все ли активные аккаунты имеют клиентов
         for account in active_accounts:
@@ -1260,6 +1467,7 @@ class TelegramClientPool(ClientPool):
     def set_degraded_mode(self, account_id: Union[int, str], degraded: bool):
         """Устанавливает режим пониженной производительности для Telegram аккаунта."""
         account_id_str = str(account_id) # Приводим к строке на всякий случай
+        self.get_pacer(account_id_str).degraded = bool(degraded)
         if degraded:
             logger.warning(f"Включение режима деградации для Telegram аккаунта {account_id_str}")
             self.degraded_mode_status[account_id_str] = True
@@ -1,7 +1,7 @@
 # Импорт пулов
 from pools import telegram_pool, vk_pool
 # Импорт VK функций
-from vk_utils import fetch_vk_comments, VKClient
+from vk_utils import fetch_vk_comments, fetch_vk_comments_batch, VKClient
 # ... остальной импорт ...
 
 # ... существующий код ... 
@@ -10,8 +10,8 @@ import os
 import json
 import asyncio
 import redis.asyncio as redis
-from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError, MessageIdInvalidError
-from telegram_utils import TelegramClientWrapper
+from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError, MessageIdInvalidError, FloodWaitError
+from telegram_utils import TelegramClientWrapper, resolve_channel_cached
 import aiohttp
 import re
 import random
@@ -38,7 +38,7 @@ def extract_user_id(msg):
 async def fetch_comments_telegram(wrapper, entity, post_id, max_comments=100):
     comments = []
     try:
-        async for msg in wrapper.client.iter_messages(entity, reply_to=post_id, limit=max_comments):
+        async for msg in wrapper.iter_messages_paced(entity, reply_to=post_id, limit=max_comments):
             comments.append({
                 "id": msg.id,
                 "text": msg.text,
@@ -46,6 +46,8 @@ async def fetch_comments_telegram(wrapper, entity, post_id, max_comments=100):
                 "from_id": extract_user_id(msg)
             })
         return comments, None
+    except FloodWaitError:
+        raise # Обрабатывается в process_subtask (парковка аккаунта)
     except Exception as e:
         error_msg = str(e)
         if "The message ID used in the peer was invalid" in error_msg and "GetRepliesRequest" in error_msg:
@@ -120,7 +122,7 @@ async def process_subtask(subtask):
                 failed_links = post_links
                 return results, failed_links, f"Ошибка при создании клиента для аккаунта {account_id}: {e}"
         wrapper = TelegramClientWrapper(client, account_id, api_key) if client and account_id else None
-        for link in post_links:
+        for link_index, link in enumerate(post_links):
             result = {"original_link": link}
             m = re.match(r"https://t.me/([^/]+)/([0-9]+)", link)
             if not m or not wrapper or not client:
@@ -138,7 +140,8 @@ async def process_subtask(subtask):
                     failed_links.append(link)
                     results.append(result)
                     continue
-                entity = await wrapper.make_high_level_request(wrapper.client.get_entity, username)
+                # Метаданные канала берем из Redis-кэша, get_entity только при промахе
+                entity, _meta = await resolve_channel_cached(wrapper, username)
                 msg = await wrapper.make_high_level_request(wrapper.client.get_messages, entity, ids=post_id)
                 if not msg:
                     result["status"] = "not_found"
@@ -156,6 +159,12 @@ async def process_subtask(subtask):
                 else:
                     result["status"] = "ok"
                     result["comments"] = comments
+            except FloodWaitError as e:
+                # Паркуем аккаунт; текущая и оставшиеся ссылки уйдут на другой аккаунт через повтор подзадачи
+                print(f"[process_subtask] FloodWait {e.seconds} сек. для аккаунта {account_id}, паркуем аккаунт")
+                await telegram_pool.park_account(account_id, e.seconds)
+                failed_links.extend(post_links[link_index:])
+                break
             except (ChannelPrivateError, UsernameNotOccupiedError, MessageIdInvalidError) as e:
                 result["status"] = "access_denied"
                 failed_links.append(link)
@@ -170,17 +179,25 @@ async def process_subtask(subtask):
         if not client or not account_id:
             failed_links = post_links
             return results, failed_links, "Нет доступного VK аккаунта"
+        parsed_links = {}
         for link in post_links:
-            result = {"original_link": link}
             m = VK_LINK_RE.search(link)
-            if not m:
+            if m:
+                parsed_links[link] = (int(m.group(1)), int(m.group(2)))
+        # Комментарии всех постов подзадачи запрашиваются пачками через execute
+        try:
+            batch_results = await fetch_vk_comments_batch(client, list(dict.fromkeys(parsed_links.values())), max_comments)
+        except Exception as e:
+            batch_results = {post: (None, str(e)) for post in parsed_links.values()}
+        for link in post_links:
+            result = {"original_link": link}
+            if link not in parsed_links:
                 result["status"] = "parse_error"
                 failed_links.append(link)
                 results.append(result)
                 continue
-            owner_id, post_id = int(m.group(1)), int(m.group(2))
             try:
-                comments, err = await fetch_vk_comments(owner_id, post_id, client.access_token, max_comments)
+                comments, err = batch_results.get(parsed_links[link], (None, "Нет результата"))
                 if err == "no_comments":
                     result["status"] = "no_comments"
                     result["comments"] = []
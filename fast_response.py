@@ -0,0 +1,70 @@
+"""Быстрая отдача JSON для эндпоинтов сбора постов.
+
+FastJSONResponse сериализует ответ через post_model.dumps (orjson, если установлен) и
+не проходит через jsonable_encoder FastAPI. Готовые bytes отдаются как есть - так
+закэшированный в Redis ответ возвращается без разбора и повторной сериализации.
+
+Кэш готовых ответов включается явно (RESPONSE_CACHE_TTL > 0) и читается bytes-клиентом
+Redis, чтобы попадание в кэш не требовало декодирования строки.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from fastapi.responses import JSONResponse
+
+import post_model
+from redis_utils import get_redis_bytes, tenant_scope
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить сериализованный ответ (сек). 0 (по умолчанию) - кэш ответов выключен
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '0'))
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse на orjson; bytes считаются уже готовым JSON и не сериализуются повторно."""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return bytes(content)
+        return post_model.dumps(content)
+
+
+def response_cache_key(route: str, api_key: Optional[str], params: Dict[str, Any]) -> str:
+    """Ключ кэша ответа: маршрут + пользователь + хэш нормализованных параметров запроса.
+
+    Ответ собран аккаунтами конкретного пользователя, поэтому другим API ключам он не отдается.
+    """
+    normalized = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return f"resp_cache:{route}:{tenant_scope(api_key)}:{hashlib.sha1(normalized.encode('utf-8')).hexdigest()}"
+
+async def get_cached_response(cache_key: str) -> Optional[bytes]:
+    """Возвращает сериализованный ответ из кэша или None."""
+    if RESPONSE_CACHE_TTL <= 0:
+        return None
+    redis_client = get_redis_bytes()
+    if not redis_client:
+        return None
+    try:
+        return await redis_client.get(cache_key)
+    except Exception as e:
+        logger.error(f"Ошибка Redis при чтении кэша ответа {cache_key}: {e}")
+        return None
+
+async def cached_json_response(cache_key: str, content: Any) -> FastJSONResponse:
+    """Сериализует ответ один раз, сохраняет bytes в кэш и отдает их клиенту.
+
+    Пустой результат не кэшируется: это может быть ошибка сбора или отсутствие аккаунтов.
+    """
+    body = post_model.dumps(content)
+    if RESPONSE_CACHE_TTL > 0 and content:
+        redis_client = get_redis_bytes()
+        if redis_client:
+            try:
+                await redis_client.set(cache_key, body, ex=RESPONSE_CACHE_TTL)
+            except Exception as e:
+                logger.error(f"Ошибка Redis при сохранении кэша ответа {cache_key}: {e}")
+    return FastJSONResponse(body)
@@ -262,6 +262,8 @@ async def process_single_media_background(account_id: str, media_object, file_id
                     return
 
                 # Обычное скачивание (не видео-плейсхолдер)
+                # Скачивание учитывается в общем темпе запросов аккаунта (класс 'download')
+                await app.telegram_pool.get_pacer(account_id).acquire('download')
                 logger.debug(f"BG Download: Начинаем скачивание медиа {file_id} в {local_path}")
                 try:
                     downloaded_path = await client.download_media(media_object, local_path)
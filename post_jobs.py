@@ -0,0 +1,239 @@
+"""Асинхронные задачи сбора постов (trending / posts-by-period) через Redis.
+
+Шаблон тот же, что у сборщика комментариев: запрос ставит задачу в очередь и сразу
+возвращает job_id, воркер обрабатывает ее, а статус и частичные результаты читаются из Redis.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import aiohttp
+import redis.asyncio as redis
+from fastapi import HTTPException
+
+import post_model
+from pools import telegram_pool
+from user_manager import verify_api_key
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost")
+redis_conn = redis.from_url(REDIS_URL)
+
+POST_JOBS_QUEUE = "post_jobs"
+POST_JOB_TTL = int(os.getenv("POST_JOB_TTL", str(24 * 3600))) # Сколько хранить статус и результаты задачи
+POST_JOB_CONCURRENCY = int(os.getenv("POST_JOB_CONCURRENCY", "2")) # Одновременно выполняемых задач на процесс
+POST_JOB_KINDS = ("trending", "period")
+
+
+def _job_key(job_id: str) -> str:
+    return f"post_job:{job_id}"
+
+def _compress(data) -> bytes:
+    return zlib.compress(post_model.dumps(data))
+
+def _decompress(raw: bytes):
+    return post_model.loads(zlib.decompress(raw))
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _get_api_key(request) -> str:
+    api_key = request.headers.get('api-key') or request.headers.get('x-api-key')
+    if not api_key:
+        auth_header = request.headers.get('authorization')
+        if auth_header and auth_header.startswith('Bearer '):
+            api_key = auth_header.split(' ')[1]
+    if not api_key:
+        raise HTTPException(401, "API ключ обязателен")
+    return api_key
+
+
+async def submit_post_job_handler(request, data: dict, kind: str):
+    """Ставит задачу сбора постов в очередь и возвращает job_id."""
+    api_key = _get_api_key(request)
+    if not await verify_api_key(api_key):
+        raise HTTPException(401, "Неверный API ключ")
+    if kind not in POST_JOB_KINDS:
+        raise HTTPException(400, f"Неизвестный тип задачи: {kind}")
+
+    platform = data.get("platform", "telegram")
+    if platform != "telegram":
+        raise HTTPException(400, "Асинхронные задачи пока поддерживаются только для Telegram")
+
+    group_ids_input = data.get("group_ids", [])
+    if isinstance(group_ids_input, (int, str)):
+        group_ids_input = [group_ids_input]
+    if not isinstance(group_ids_input, list):
+        raise HTTPException(400, "Некорректный формат group_ids")
+    group_ids = [str(gid) for gid in group_ids_input if gid is not None]
+    if not group_ids:
+        raise HTTPException(400, "ID групп обязательны")
+
+    job_id = str(uuid.uuid4())
+    job = {
+        "job_id": job_id,
+        "kind": kind,
+        "api_key": api_key,
+        "group_ids": group_ids,
+        "params": {k: v for k, v in data.items() if k not in ("group_ids", "callback_url", "platform")},
+        "callback_url": data.get("callback_url"),
+    }
+
+    key = _job_key(job_id)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping={
+            "status": "queued",
+            "kind": kind,
+            "channels_total": len(group_ids),
+            "channels_done": 0,
+            "posts_found": 0,
+            "created_at": _now_iso(),
+        })
+        pipe.expire(key, POST_JOB_TTL)
+        pipe.rpush(POST_JOBS_QUEUE, json.dumps(job))
+        await pipe.execute()
+
+    logger.info(f"Задача сбора постов {job_id} ({kind}, {len(group_ids)} каналов) поставлена в очередь.")
+    return {"status": "queued", "job_id": job_id, "channels_total": len(group_ids)}
+
+
+async def get_post_job_status_handler(job_id: str, include_partial: bool = True):
+    """Статус задачи; для незавершенной задачи - частичные результаты по готовым каналам."""
+    key = _job_key(job_id)
+    raw_status = await redis_conn.hgetall(key)
+    if not raw_status:
+        return {"status": "not_found", "job_id": job_id}
+    status = {k.decode(): v.decode() for k, v in raw_status.items()}
+    for field in ("channels_total", "channels_done", "posts_found"):
+        if field in status:
+            status[field] = int(status[field])
+    status["job_id"] = job_id
+
+    if status.get("status") == "done":
+        result_raw = await redis_conn.get(f"{key}:result")
+        if result_raw:
+            # Результат уже сериализован - встраиваем его в ответ без разбора
+            status["result"] = post_model.raw_json(zlib.decompress(result_raw))
+    elif include_partial:
+        batches = await redis_conn.lrange(f"{key}:partial", 0, -1)
+        status["partial_results"] = [post for batch in batches for post in _decompress(batch)]
+    return status
+
+
+async def _send_callback(callback_url: str, payload: Dict):
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(callback_url, json=payload, timeout=30) as resp:
+                logger.info(f"[post_jobs] Callback POST {callback_url} -> {resp.status}")
+    except Exception as e:
+        logger.error(f"[post_jobs] Ошибка при отправке callback на {callback_url}: {e}")
+
+
+async def _run_post_job(job: Dict):
+    from telegram_utils import get_trending_posts, get_posts_by_period
+
+    job_id = job["job_id"]
+    key = _job_key(job_id)
+    params = job.get("params") or {}
+    started_at = time.monotonic()
+    await redis_conn.hset(key, mapping={"status": "processing", "started_at": _now_iso()})
+
+    async def on_channel_result(channel_id, posts):
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            if posts:
+                pipe.rpush(f"{key}:partial", _compress(posts))
+                pipe.expire(f"{key}:partial", POST_JOB_TTL)
+            pipe.hincrby(key, "channels_done", 1)
+            pipe.hincrby(key, "posts_found", len(posts or []))
+            await pipe.execute()
+
+    try:
+        if job["kind"] == "trending":
+            posts: List[Dict] = await get_trending_posts(
+                telegram_pool=telegram_pool,
+                channel_ids=job["group_ids"],
+                days_back=params.get("days_back", 7),
+                posts_per_channel=params.get("posts_per_group", 10),
+                min_views=params.get("min_views", 0),
+                min_reactions=params.get("min_reactions"),
+                min_comments=params.get("min_comments"),
+                min_forwards=params.get("min_forwards"),
+                api_key=job["api_key"],
+                on_channel_result=on_channel_result,
+                total_limit=params.get("total_limit"),
+                score_formula=params.get("score_formula")
+            )
+        else:
+            posts = await get_posts_by_period(
+                telegram_pool=telegram_pool,
+                group_ids=job["group_ids"],
+                limit_per_channel=params.get("max_posts", 100),
+                days_back=params.get("days_back", 7),
+                min_views=params.get("min_views", 0),
+                api_key=job["api_key"],
+                on_channel_result=on_channel_result,
+                total_limit=params.get("total_limit")
+            )
+        final_status = {"status": "done", "posts_found": len(posts)}
+    except Exception as e:
+        logger.error(f"[post_jobs] Ошибка выполнения задачи {job_id}: {e}", exc_info=True)
+        posts = None
+        final_status = {"status": "error", "error": str(e)}
+
+    final_status["finished_at"] = _now_iso()
+    final_status["elapsed_seconds"] = round(time.monotonic() - started_at, 2)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        if posts is not None:
+            pipe.set(f"{key}:result", _compress(posts), ex=POST_JOB_TTL)
+            pipe.delete(f"{key}:partial") # Частичные результаты больше не нужны
+        pipe.hset(key, mapping=final_status)
+        pipe.expire(key, POST_JOB_TTL)
+        await pipe.execute()
+    logger.info(f"[post_jobs] Задача {job_id} завершена со статусом {final_status['status']} за {final_status['elapsed_seconds']} сек.")
+
+    callback_url = job.get("callback_url")
+    if callback_url:
+        payload = {"job_id": job_id, **final_status}
+        if posts is not None:
+            payload["result"] = posts
+        await _send_callback(callback_url, payload)
+
+
+async def worker():
+    """Разбирает очередь задач сбора постов, не более POST_JOB_CONCURRENCY одновременно."""
+    semaphore = asyncio.Semaphore(POST_JOB_CONCURRENCY)
+    running = set()
+
+    async def run_with_semaphore(job):
+        try:
+            await _run_post_job(job)
+        finally:
+            semaphore.release()
+
+    while True:
+        try:
+            await semaphore.acquire()
+            job_data = await redis_conn.blpop([POST_JOBS_QUEUE], timeout=5)
+            if not job_data:
+                semaphore.release()
+                continue
+            _, job_raw = job_data
+            job = json.loads(job_raw.decode() if isinstance(job_raw, bytes) else job_raw)
+            task = asyncio.create_task(run_with_semaphore(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        except asyncio.CancelledError:
+            for task in running:
+                task.cancel()
+            raise
+        except Exception as e:
+            semaphore.release()
+            logger.error(f"[post_jobs] Ошибка воркера: {e}", exc_info=True)
+            await asyncio.sleep(5)
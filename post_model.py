@@ -0,0 +1,215 @@
+"""Единая модель поста (Telegram и VK) и нормализация сырых сообщений в нее.
+
+Post - компактный слотовый dataclass: сообщение Telethon или JSON поста VK
+преобразуется в него один раз, а формат ответа конкретного эндпоинта задается
+раскладкой (layout) при сериализации в dict. Сериализация в JSON - через dumps().
+"""
+import json
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import scoring
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError: # orjson необязателен - используем стандартный json
+    orjson = None
+
+
+@dataclass(slots=True)
+class Post:
+    """Пост в нормализованном виде. Поля с None не попадают в dict (если раскладка их допускает)."""
+    platform: str
+    id: int
+    channel_id: Any
+    date: Optional[str]
+    text: str = ""
+    views: Optional[int] = None
+    reactions: Optional[int] = None
+    comments: Optional[int] = None
+    forwards: Optional[int] = None
+    url: Optional[str] = None
+    channel_title: Optional[str] = None
+    channel_username: Optional[str] = None
+    subscribers: Optional[int] = None
+    media: Optional[List[Any]] = field(default_factory=list)
+    trend_score: Optional[float] = None
+
+    def to_dict(self, layout: str = 'telegram') -> Dict[str, Any]:
+        fields, optional = LAYOUTS[layout]
+        result = {}
+        for out_key, attr in fields:
+            value = getattr(self, attr)
+            if value is None and out_key in optional:
+                continue
+            result[out_key] = value
+        return result
+
+
+# Раскладки ответа: (пары (ключ в ответе, поле Post), ключи, опускаемые при None)
+LAYOUTS: Dict[str, Tuple[Tuple[Tuple[str, str], ...], frozenset]] = {
+    # trending Telegram: все ключи присутствуют всегда (null, если значения нет)
+    'telegram': (
+        (('id', 'id'), ('channel_id', 'channel_id'), ('channel_title', 'channel_title'),
+         ('channel_username', 'channel_username'), ('subscribers', 'subscribers'), ('text', 'text'),
+         ('views', 'views'), ('reactions', 'reactions'), ('comments', 'comments'), ('forwards', 'forwards'),
+         ('date', 'date'), ('url', 'url'), ('media', 'media'), ('trend_score', 'trend_score')),
+        frozenset(),
+    ),
+    # posts-by-period Telegram: как trending, но без subscribers
+    'telegram_period': (
+        (('id', 'id'), ('channel_id', 'channel_id'), ('channel_title', 'channel_title'),
+         ('channel_username', 'channel_username'), ('text', 'text'),
+         ('views', 'views'), ('reactions', 'reactions'), ('comments', 'comments'), ('forwards', 'forwards'),
+         ('date', 'date'), ('url', 'url'), ('media', 'media'), ('trend_score', 'trend_score')),
+        frozenset(),
+    ),
+    # posts Telegram (упрощенный ответ: только просмотры)
+    'telegram_simple': (
+        (('id', 'id'), ('channel_id', 'channel_id'), ('channel_title', 'channel_title'), ('text', 'text'),
+         ('views', 'views'), ('date', 'date'), ('url', 'url'), ('media', 'media')),
+        frozenset(),
+    ),
+    # VKClient.process_groups / get_posts_in_groups
+    'vk': (
+        (('id', 'id'), ('date', 'date'), ('views', 'views'), ('text', 'text'), ('group_id', 'channel_id'),
+         ('group_title', 'channel_title'), ('url', 'url'), ('likes', 'reactions'), ('reposts', 'forwards'),
+         ('comments', 'comments'), ('group_members', 'subscribers'), ('media', 'media'), ('trend_score', 'trend_score')),
+        frozenset(),
+    ),
+    # get_vk_posts_in_groups (формат стены: post_id / owner_id, медиа - список ссылок)
+    'vk_wall': (
+        (('text', 'text'), ('likes', 'reactions'), ('reposts', 'forwards'), ('comments', 'comments'),
+         ('views', 'views'), ('date', 'date'), ('post_id', 'id'), ('owner_id', 'channel_id'), ('url', 'url'),
+         ('trend_score', 'trend_score'), ('media', 'media')),
+        frozenset({'media'}),
+    ),
+}
+
+
+# --- Telegram ---
+
+def telegram_counters(message) -> Tuple[int, int, int, int]:
+    """(views, reactions, comments, forwards) сообщения Telethon."""
+    views = getattr(message, 'views', 0) or 0
+    reactions_obj = getattr(message, 'reactions', None)
+    reactions = sum(r.count for r in reactions_obj.results) if reactions_obj and reactions_obj.results else 0
+    replies = getattr(message, 'replies', None)
+    comments = replies.replies if replies and replies.replies is not None else 0
+    forwards = getattr(message, 'forwards', 0) or 0
+    return views, reactions, comments, forwards
+
+def telegram_post_url(channel_username: Optional[str], channel_id, message_id: int) -> str:
+    if channel_username:
+        return f"https://t.me/{channel_username}/{message_id}"
+    try:
+        channel_part = abs(int(channel_id))
+    except (TypeError, ValueError):
+        channel_part = channel_id
+    return f"https://t.me/c/{channel_part}/{message_id}"
+
+def telegram_message_text(message) -> str:
+    return getattr(message, 'message', None) or getattr(message, 'text', None) or ""
+
+def post_from_telegram(message, channel_id, channel_title: Optional[str] = None, channel_username: Optional[str] = None,
+                       subscribers: Optional[int] = None, text: Optional[str] = None, media: Optional[List] = None,
+                       counters: Optional[Tuple[int, int, int, int]] = None, trend_score: Optional[float] = None,
+                       url: Optional[str] = None, with_counters: bool = True) -> Post:
+    """Нормализует сообщение Telethon в Post.
+
+    counters можно передать уже посчитанными (из фильтрации), чтобы не считать повторно.
+    with_counters=False оставляет только просмотры (для упрощенных ответов).
+    """
+    views, reactions, comments, forwards = counters or telegram_counters(message)
+    date = message.date.isoformat() if getattr(message, 'date', None) else None
+    return Post(
+        platform='telegram',
+        id=message.id,
+        channel_id=channel_id,
+        date=date,
+        text=text if text is not None else telegram_message_text(message),
+        views=views,
+        reactions=reactions if with_counters else None,
+        comments=comments if with_counters else None,
+        forwards=forwards if with_counters else None,
+        url=url or telegram_post_url(channel_username, channel_id, message.id),
+        channel_title=channel_title,
+        channel_username=channel_username,
+        subscribers=subscribers,
+        media=media if media is not None else [],
+        trend_score=trend_score,
+    )
+
+
+# --- VK ---
+
+def vk_counters(item: Dict) -> Tuple[int, int, int, int]:
+    """(views, likes, comments, reposts) поста VK."""
+    return (
+        item.get("views", {}).get("count", 0),
+        item.get("likes", {}).get("count", 0),
+        item.get("comments", {}).get("count", 0),
+        item.get("reposts", {}).get("count", 0),
+    )
+
+def vk_trend_score(views: int, likes: int, comments: int, reposts: int, group_members: int) -> int:
+    """Та же базовая формула, что и для Telegram (scoring.trend_score)."""
+    return scoring.round_score(scoring.trend_score(views, likes, comments, reposts, group_members))
+
+def post_from_vk(item: Dict, group_id, group_title: str = "", group_members: Optional[int] = None,
+                 url: Optional[str] = None, media: Optional[List] = None, date: Optional[str] = None,
+                 trend_score: Optional[float] = None) -> Post:
+    """Нормализует пост VK (элемент wall.get) в Post. trend_score считается, если не передан."""
+    views, likes, comments, reposts = vk_counters(item)
+    if trend_score is None and group_members is not None:
+        trend_score = vk_trend_score(views, likes, comments, reposts, group_members)
+    return Post(
+        platform='vk',
+        id=item["id"],
+        channel_id=group_id,
+        date=date or datetime.fromtimestamp(item["date"], tz=timezone.utc).isoformat(),
+        text=item.get("text", ""),
+        views=views,
+        reactions=likes,
+        comments=comments,
+        forwards=reposts,
+        url=url or f"https://vk.com/wall{item.get('owner_id')}_{item['id']}",
+        channel_title=group_title,
+        subscribers=group_members,
+        media=media if media is not None else [],
+        trend_score=trend_score,
+    )
+
+
+# --- Сериализация ---
+
+def _default(obj):
+    if isinstance(obj, Post):
+        return obj.to_dict('vk' if obj.platform == 'vk' else 'telegram')
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+def dumps(obj) -> bytes:
+    """Сериализует ответ/пост в JSON (bytes). Использует orjson, если он установлен."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, default=_default).encode('utf-8')
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def raw_json(data: bytes):
+    """Встраивает уже сериализованный JSON в другой объект без разбора (orjson.Fragment).
+
+    Без orjson (или в старой версии без Fragment) данные просто разбираются.
+    """
+    if orjson is not None and hasattr(orjson, 'Fragment'):
+        return orjson.Fragment(data)
+    return loads(data)
@@ -8,9 +8,12 @@ import os
 from dotenv import load_dotenv
 import redis.asyncio as aredis
 import asyncio
+import json
+import hashlib
 import asyncpg # Добавляем для обработки ошибок
 from typing import Optional, Union, Dict, Any, List # Add Optional here if not present, or modify existing import
 import pytz
+import post_model
 
 # Импортируем нужные async функции из user_manager
 # get_db_connection теперь возвращает пул
@@ -72,6 +75,30 @@ def init_redis():
         aredis_client = None
         return False
 
+# Клиент без декодирования ответов: для готовых bytes (сериализованные ответы API)
+aredis_bytes_client = None
+
+def get_redis_bytes():
+    """Возвращает клиент Redis, отдающий значения как bytes (без decode_responses)."""
+    global aredis_bytes_client
+    if aredis_bytes_client is None:
+        try:
+            options = dict(socket_timeout=5, socket_connect_timeout=5, retry_on_timeout=True)
+            if REDIS_URL:
+                aredis_bytes_client = aredis.from_url(REDIS_URL, **options)
+            else:
+                aredis_bytes_client = aredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD, **options)
+        except Exception as e:
+            logger.error(f"Не удалось создать bytes-клиент Redis: {e}")
+            return None
+    return aredis_bytes_client
+
+async def close_redis_bytes():
+    global aredis_bytes_client
+    if aredis_bytes_client is not None:
+        await aredis_bytes_client.aclose()
+        aredis_bytes_client = None
+
 async def get_redis():
     """Асинхронно возвращает клиент Redis, при необходимости инициализирует и проверяет подключение."""
     global aredis_client
@@ -393,6 +420,7 @@ async def reset_account_stats_redis(account_id, platform):
         
         # Используем await для delete
         deleted_count = await redis_client.delete(count_key, last_used_key)
+        usage_accumulator.reset(account_id, platform) # Локальные несброшенные запросы тоже обнуляем
         
         if deleted_count > 0:
             logger.info(f"Статистика из Redis для аккаунта {platform}:{account_id} успешно сброшена (удалено {deleted_count} ключей).")
@@ -503,5 +531,371 @@ async def reset_all_account_stats():
         logger.error(traceback.format_exc())
         return False
 
+# --- Парковка аккаунтов после FloodWait ---
+async def park_account_redis(account_id, platform, available_at: float) -> bool:
+    """Сохраняет момент (unix time), до которого аккаунт недоступен из-за FloodWait."""
+    redis_client = await get_redis()
+    if not redis_client:
+        logger.warning(f"Redis недоступен, парковка {platform}:{account_id} сохранена только в памяти процесса")
+        return False
+    try:
+        ttl = max(1, int(available_at - time.time()) + 1)
+        await redis_client.set(f"account_parked:{platform}:{account_id}", f"{available_at:.3f}", ex=ttl)
+        return True
+    except aredis.RedisError as e:
+        logger.error(f"Ошибка Redis при парковке аккаунта {platform}:{account_id}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Ошибка парковки аккаунта {platform}:{account_id} в Redis: {e}")
+        return False
+
+
+async def get_parked_accounts_redis(account_ids: List[Any], platform) -> Dict[str, float]:
+    """Возвращает {account_id: available_at} для аккаунтов, которые еще припаркованы."""
+    if not account_ids:
+        return {}
+    redis_client = await get_redis()
+    if not redis_client:
+        return {}
+    try:
+        keys = [f"account_parked:{platform}:{account_id}" for account_id in account_ids]
+        values = await redis_client.mget(keys)
+        now = time.time()
+        parked = {}
+        for account_id, value in zip(account_ids, values):
+            if value and float(value) > now:
+                parked[str(account_id)] = float(value)
+        return parked
+    except aredis.RedisError as e:
+        logger.error(f"Ошибка Redis при чтении припаркованных аккаунтов {platform}: {e}")
+        return {}
+    except Exception as e:
+        logger.error(f"Ошибка чтения припаркованных аккаунтов {platform} из Redis: {e}")
+        return {}
+
+# --- Кэш метаданных Telegram-каналов ---
+# Метаданные (id, username, title, access_hash по аккаунтам) живут долго,
+# число подписчиков хранится отдельным ключом с более коротким TTL.
+TG_CHANNEL_META_TTL = int(os.getenv('TG_CHANNEL_META_TTL', 7 * 86400))
+TG_CHANNEL_MEMBERS_TTL = int(os.getenv('TG_CHANNEL_MEMBERS_TTL', 6 * 3600))
+
+
+def normalize_tg_channel_id(channel_ref) -> Optional[int]:
+    """Приводит ID канала к положительному виду без префикса -100. Для username возвращает None."""
+    try:
+        numeric_id = int(channel_ref)
+    except (TypeError, ValueError):
+        return None
+    if numeric_id < 0:
+        str_id = str(numeric_id)
+        numeric_id = int(str_id[4:]) if str_id.startswith('-100') else abs(numeric_id)
+    return numeric_id
+
+
+async def get_tg_channel_meta(channel_ref, account_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Возвращает метаданные канала из Redis по ID или username.
+
+    access_hash привязан к аккаунту Telegram, поэтому возвращается только для account_id.
+    """
+    redis_client = await get_redis()
+    if not redis_client:
+        return None
+    try:
+        channel_id = normalize_tg_channel_id(channel_ref)
+        if channel_id is None:
+            username = str(channel_ref).lstrip('@').lower()
+            if not username:
+                return None
+            cached_id = await redis_client.get(f"tg_channel_username:{username}")
+            if not cached_id:
+                return None
+            channel_id = int(cached_id)
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"tg_channel:{channel_id}")
+            pipe.get(f"tg_channel:{channel_id}:members")
+            meta_raw, members_raw = await pipe.execute()
+        if not meta_raw and members_raw is None:
+            return None
+
+        access_hash = meta_raw.get(f"access_hash:{account_id}") if account_id else None
+        return {
+            'id': channel_id,
+            'username': meta_raw.get('username') or None,
+            'title': meta_raw.get('title') or None,
+            'access_hash': int(access_hash) if access_hash else None,
+            'participants_count': int(members_raw) if members_raw is not None else None
+        }
+    except aredis.RedisError as e:
+        logger.error(f"Ошибка Redis при чтении метаданных канала {channel_ref}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка чтения метаданных канала {channel_ref} из Redis: {e}")
+        return None
+
+
+async def set_tg_channel_meta(
+    channel_id,
+    account_id: Optional[str] = None,
+    access_hash: Optional[int] = None,
+    username: Optional[str] = None,
+    title: Optional[str] = None,
+    participants_count: Optional[int] = None
+) -> bool:
+    """Сохраняет известные поля метаданных канала в Redis. Поля со значением None не перезаписываются."""
+    channel_id = normalize_tg_channel_id(channel_id)
+    if channel_id is None:
+        return False
+    redis_client = await get_redis()
+    if not redis_client:
+        return False
+    try:
+        meta_key = f"tg_channel:{channel_id}"
+        fields = {'id': channel_id}
+        if username:
+            fields['username'] = username
+        if title:
+            fields['title'] = title
+        if account_id and access_hash is not None:
+            fields[f"access_hash:{account_id}"] = access_hash
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(meta_key, mapping=fields)
+            pipe.expire(meta_key, TG_CHANNEL_META_TTL)
+            if username:
+                pipe.set(f"tg_channel_username:{username.lower()}", channel_id, ex=TG_CHANNEL_META_TTL)
+            if participants_count is not None:
+                pipe.set(f"{meta_key}:members", int(participants_count), ex=TG_CHANNEL_MEMBERS_TTL)
+            await pipe.execute()
+        return True
+    except aredis.RedisError as e:
+        logger.error(f"Ошибка Redis при сохранении метаданных канала {channel_id}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Ошибка сохранения метаданных канала {channel_id} в Redis: {e}")
+        return False
+
+async def get_tg_channel_members_many(channel_ids: List[int]) -> Dict[int, int]:
+    """Число подписчиков для нескольких каналов одним MGET (только для тех, что есть в кэше)."""
+    redis_client = await get_redis()
+    if not redis_client or not channel_ids:
+        return {}
+    try:
+        values = await redis_client.mget([f"tg_channel:{channel_id}:members" for channel_id in channel_ids])
+    except Exception as e:
+        logger.error(f"Ошибка Redis при пакетном чтении подписчиков ({len(channel_ids)} каналов): {e}")
+        return {}
+    return {channel_id: int(value) for channel_id, value in zip(channel_ids, values) if value is not None}
+
+# --- Кэш результатов trending по каналам ---
+
+def tenant_scope(api_key: Optional[str]) -> str:
+    """Короткий хэш API ключа для ключей кэша: посты, собранные аккаунтами одного пользователя
+    (в т.ч. из доступных только им приватных каналов), не отдаются другим пользователям."""
+    return hashlib.sha1((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+TG_TRENDING_CACHE_TTL = int(os.getenv('TG_TRENDING_CACHE_TTL', 600))
+# Доля TTL, после которой запись отдается, но обновляется в фоне (stale-while-revalidate)
+TG_TRENDING_CACHE_REFRESH_RATIO = float(os.getenv('TG_TRENDING_CACHE_REFRESH_RATIO', '0.7'))
+
+async def get_tg_trending_cache(cache_keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Читает закэшированные посты каналов одним MGET. Возвращает {cache_key: {'posts', 'fetched_at', 'stale'}}."""
+    redis_client = await get_redis()
+    if not redis_client or not cache_keys:
+        return {}
+    try:
+        raw_values = await redis_client.mget(cache_keys)
+    except Exception as e:
+        logger.error(f"Ошибка Redis при чтении кэша trending ({len(cache_keys)} ключей): {e}")
+        return {}
+    now = time.time()
+    refresh_after = TG_TRENDING_CACHE_TTL * TG_TRENDING_CACHE_REFRESH_RATIO
+    entries = {}
+    for cache_key, raw in zip(cache_keys, raw_values):
+        if not raw:
+            continue
+        try:
+            entry = post_model.loads(raw)
+        except ValueError:
+            continue
+        entry['stale'] = now - entry.get('fetched_at', 0) >= refresh_after
+        entries[cache_key] = entry
+    return entries
+
+async def set_tg_trending_cache(cache_key: str, posts: List[Dict]) -> bool:
+    """Сохраняет обработанные посты канала для данного окна фильтров."""
+    redis_client = await get_redis()
+    if not redis_client:
+        return False
+    try:
+        payload = post_model.dumps({'fetched_at': time.time(), 'posts': posts})
+        await redis_client.set(cache_key, payload, ex=TG_TRENDING_CACHE_TTL)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка Redis при сохранении кэша trending {cache_key}: {e}")
+        return False
+
+async def claim_tg_trending_refresh(cache_key: str, ttl: int = 120) -> bool:
+    """Захватывает право на фоновое обновление записи, чтобы параллельные запросы его не дублировали."""
+    redis_client = await get_redis()
+    if not redis_client:
+        return False
+    try:
+        return bool(await redis_client.set(f"{cache_key}:refreshing", 1, nx=True, ex=ttl))
+    except Exception as e:
+        logger.error(f"Ошибка Redis при захвате обновления {cache_key}: {e}")
+        return False
+
+# --- Межпроцессный singleflight (блокировка загрузки одного и того же канала) ---
+
+_RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+async def acquire_singleflight_lock(key: str, ttl: int = 120) -> Optional[str]:
+    """Пытается захватить блокировку загрузки. Возвращает токен владельца или None, если занято."""
+    redis_client = await get_redis()
+    if not redis_client:
+        return None
+    token = os.urandom(8).hex()
+    try:
+        if await redis_client.set(f"singleflight:{key}", token, nx=True, ex=ttl):
+            return token
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка Redis при захвате блокировки singleflight {key}: {e}")
+        return None
+
+async def release_singleflight_lock(key: str, token: str) -> bool:
+    """Снимает блокировку, только если она все еще принадлежит этому владельцу."""
+    redis_client = await get_redis()
+    if not redis_client or not token:
+        return False
+    try:
+        return bool(await redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, f"singleflight:{key}", token))
+    except Exception as e:
+        logger.error(f"Ошибка Redis при снятии блокировки singleflight {key}: {e}")
+        return False
+
+async def is_singleflight_locked(key: str) -> bool:
+    redis_client = await get_redis()
+    if not redis_client:
+        return False
+    try:
+        return bool(await redis_client.exists(f"singleflight:{key}"))
+    except Exception:
+        return False
+
+# --- Накопитель использования аккаунтов (в памяти процесса) ---
+
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '2.0'))
+# Как часто перечитывать счётчик из Redis (учёт запросов других процессов)
+USAGE_REFRESH_INTERVAL = float(os.getenv('USAGE_REFRESH_INTERVAL', '30.0'))
+
+class AccountUsageAccumulator:
+    """Копит запросы аккаунтов в памяти и периодически сбрасывает их в Redis одним pipeline.
+
+    Redis остаётся общим источником истины для процессов, но не участвует в каждом запросе:
+    record() не делает сетевых вызовов, а requests_count берётся из локальной оценки.
+    """
+
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL, refresh_interval: float = USAGE_REFRESH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self._pending: Dict[tuple, int] = {}        # (platform, account_id) -> ещё не сброшенные запросы
+        self._last_used: Dict[tuple, str] = {}      # (platform, account_id) -> ISO-время последнего запроса
+        self._counts: Dict[tuple, int] = {}         # Оценка полного счётчика (Redis + pending)
+        self._refreshed_at: Dict[tuple, float] = {} # Когда счётчик последний раз сверяли с Redis
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, account_id, platform, count: int = 1) -> int:
+        """Учитывает запрос аккаунта без обращения к Redis. Возвращает локальную оценку счетчика."""
+        key = (platform, str(account_id))
+        self._pending[key] = self._pending.get(key, 0) + count
+        self._counts[key] = self._counts.get(key, 0) + count
+        self._last_used[key] = datetime.now(pytz.timezone("Europe/Moscow")).isoformat()
+        self._ensure_flusher()
+        return self._counts[key]
+
+    async def get_requests_count(self, account_id, platform) -> int:
+        """Счётчик запросов аккаунта. В Redis ходит не чаще раза в refresh_interval на аккаунт."""
+        key = (platform, str(account_id))
+        now = time.monotonic()
+        if key in self._counts and now - self._refreshed_at.get(key, 0) < self.refresh_interval:
+            return self._counts[key]
+        self._refreshed_at[key] = now # Даже при ошибке Redis не повторяем попытку на каждом запросе
+        stats = await get_account_stats_redis(account_id, platform)
+        if isinstance(stats, dict):
+            self._counts[key] = int(stats.get('requests_count', 0)) + self._pending.get(key, 0)
+        return self._counts.get(key, 0)
+
+    def reset(self, account_id, platform):
+        """Сбрасывает локальное состояние аккаунта (например, после обнуления статистики)."""
+        key = (platform, str(account_id))
+        for store in (self._pending, self._last_used, self._counts, self._refreshed_at):
+            store.pop(key, None)
+
+    def _ensure_flusher(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        except RuntimeError:
+            # Нет запущенного цикла событий - данные будут сброшены при следующем flush()
+            self._flush_task = None
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._pending:
+                return # Новый цикл запустится при следующем record()
+
+    async def flush(self) -> bool:
+        """Сбрасывает накопленные счетчики всех аккаунтов в Redis одним pipeline."""
+        async with self._flush_lock:
+            if not self._pending:
+                return True
+            pending, last_used = self._pending, self._last_used
+            self._pending, self._last_used = {}, {}
+            keys = list(pending.keys())
+
+            redis_client = await get_redis()
+            if not redis_client:
+                logger.warning(f"Redis недоступен, откладываем сброс статистики для {len(keys)} аккаунтов")
+                self._restore(pending, last_used)
+                return False
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for platform, account_id in keys:
+                        pipe.incrby(f"account:{platform}:{account_id}:requests_count", pending[(platform, account_id)])
+                        if (platform, account_id) in last_used:
+                            pipe.set(f"account:{platform}:{account_id}:last_used", last_used[(platform, account_id)])
+                    results = await pipe.execute()
+            except Exception as e:
+                logger.error(f"Ошибка Redis при пакетном сбросе статистики ({len(keys)} аккаунтов): {e}")
+                self._restore(pending, last_used)
+                return False
+
+            # INCRBY возвращает общий счётчик (с учетом других процессов) - сверяем локальную оценку
+            result_idx = 0
+            for key in keys:
+                self._counts[key] = int(results[result_idx]) + self._pending.get(key, 0)
+                result_idx += 2 if key in last_used else 1
+            logger.debug(f"Статистика Redis сброшена для {len(keys)} аккаунтов")
+
+        # Синхронизация с БД - как и раньше, с некоторой вероятностью, но вне пути запроса
+        for platform, account_id in keys:
+            if random.random() < 0.1:
+                await sync_account_stats_to_db(account_id, platform)
+        return True
+
+    def _restore(self, pending: Dict[tuple, int], last_used: Dict[tuple, str]):
+        """Возвращает несброшенные данные в буфер, чтобы не потерять их до следующей попытки."""
+        for key, count in pending.items():
+            self._pending[key] = self._pending.get(key, 0) + count
+        for key, value in last_used.items():
+            self._last_used.setdefault(key, value)
+
+usage_accumulator = AccountUsageAccumulator()
+
 # Запускаем инициализацию при импорте модуля
 init_redis() 
\ No newline at end of file
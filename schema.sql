@@ -56,6 +56,23 @@ CREATE TABLE IF NOT EXISTS vk_accounts (
     last_used TIMESTAMPTZ
 );
 
+-- Каталог каналов/групп для локального поиска /find-groups (source=local|hybrid)
+CREATE TABLE IF NOT EXISTS channel_directory (
+    platform TEXT NOT NULL, -- telegram | vk
+    channel_id BIGINT NOT NULL, -- Положительный ID канала/группы
+    username TEXT,
+    title TEXT,
+    description TEXT,
+    members_count INTEGER,
+    is_closed BOOLEAN DEFAULT FALSE,
+    search_text TEXT NOT NULL DEFAULT '', -- title + username + description в нижнем регистре
+    last_seen TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (platform, channel_id)
+);
+CREATE INDEX IF NOT EXISTS idx_channel_directory_members ON channel_directory (platform, members_count DESC);
+-- Требует расширения pg_trgm (CREATE EXTENSION IF NOT EXISTS pg_trgm)
+CREATE INDEX IF NOT EXISTS idx_channel_directory_search_trgm ON channel_directory USING GIN (search_text gin_trgm_ops);
+
 -- Можно добавить индексы для часто используемых полей, например:
 -- CREATE INDEX IF NOT EXISTS idx_telegram_accounts_user_api_key ON telegram_accounts (user_api_key);
 -- CREATE INDEX IF NOT EXISTS idx_vk_accounts_user_api_key ON vk_accounts (user_api_key);
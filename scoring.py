@@ -0,0 +1,154 @@
+"""Расчет trend_score постов (Telegram и VK) по именованным формулам.
+
+Базовая формула (engagement) одна для обеих платформ:
+    (views + reactions*10 + comments*20 + forwards*50) / log10(max(subscribers, 10))
+
+Формулы для ранжирования, выбираемые в запросе (score_formula):
+    engagement     - базовая формула;
+    time_decay     - базовая формула с экспоненциальным затуханием по возрасту поста;
+    channel_zscore - отклонение базовой оценки поста от среднего по его каналу (в сигмах).
+
+Пакетный расчет (score_columns) векторизован через NumPy, если он установлен;
+без NumPy используется эквивалентный расчет на чистом Python.
+
+В ответах (round_score) базовая формула отдается целым числом, как и раньше;
+остальные формулы - дробным числом, округленным до 4 знаков.
+"""
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError: # NumPy необязателен - считаем в цикле
+    np = None
+
+REACTION_WEIGHT = 10
+COMMENT_WEIGHT = 20
+FORWARD_WEIGHT = 50
+MIN_SUBSCRIBERS = 10 # Минимум подписчиков для логарифма (log10(10) = 1)
+TREND_HALF_LIFE_HOURS = float(os.getenv('TREND_HALF_LIFE_HOURS', '24')) # Период полураспада для time_decay
+
+DEFAULT_FORMULA = 'engagement'
+FORMULAS = ('engagement', 'time_decay', 'channel_zscore')
+
+
+def trend_score(views: int, reactions: int, comments: int, forwards: int, subscribers: Optional[int]) -> float:
+    """Базовая оценка одного поста (для расчета по ходу обхода истории)."""
+    raw_engagement_score = (views or 0) + (reactions or 0) * REACTION_WEIGHT + (comments or 0) * COMMENT_WEIGHT + (forwards or 0) * FORWARD_WEIGHT
+    if raw_engagement_score <= 0:
+        return 0.0
+    return raw_engagement_score / math.log10(max(subscribers or 0, MIN_SUBSCRIBERS))
+
+def normalize_formula(formula: Optional[str]) -> str:
+    """Название формулы из запроса; неизвестные заменяются базовой."""
+    if not formula:
+        return DEFAULT_FORMULA
+    formula = str(formula).lower()
+    if formula not in FORMULAS:
+        logger.warning(f"Неизвестная формула trend_score '{formula}', используем {DEFAULT_FORMULA}")
+        return DEFAULT_FORMULA
+    return formula
+
+
+def score_columns(views: Sequence[int], reactions: Sequence[int], comments: Sequence[int], forwards: Sequence[int],
+                  subscribers: Sequence[Optional[int]], ages_hours: Optional[Sequence[float]] = None,
+                  channel_ids: Optional[Sequence[Any]] = None, formula: str = DEFAULT_FORMULA,
+                  half_life_hours: float = TREND_HALF_LIFE_HOURS) -> List[float]:
+    """Оценки для пакета постов, заданного колонками одинаковой длины."""
+    formula = normalize_formula(formula)
+    if not len(views):
+        return []
+    if np is not None:
+        return _score_columns_numpy(views, reactions, comments, forwards, subscribers, ages_hours, channel_ids, formula, half_life_hours)
+
+    scores = [trend_score(*row) for row in zip(views, reactions, comments, forwards, subscribers)]
+    if formula == 'time_decay':
+        ages = ages_hours or [0.0] * len(scores)
+        scores = [score * 0.5 ** (max(age or 0.0, 0.0) / half_life_hours) for score, age in zip(scores, ages)]
+    elif formula == 'channel_zscore':
+        groups: Dict[Any, List[int]] = {}
+        for index, channel_id in enumerate(channel_ids or [None] * len(scores)):
+            groups.setdefault(channel_id, []).append(index)
+        zscores = [0.0] * len(scores)
+        for indexes in groups.values():
+            values = [scores[i] for i in indexes]
+            mean = sum(values) / len(values)
+            std = math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))
+            for i in indexes:
+                zscores[i] = (scores[i] - mean) / std if std > 0 else 0.0
+        scores = zscores
+    return scores
+
+def _score_columns_numpy(views, reactions, comments, forwards, subscribers, ages_hours, channel_ids, formula, half_life_hours) -> List[float]:
+    def column(values):
+        # None превращается в NaN при преобразовании, затем в 0
+        return np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0)
+
+    raw = column(views) + column(reactions) * REACTION_WEIGHT + column(comments) * COMMENT_WEIGHT + column(forwards) * FORWARD_WEIGHT
+    scores = np.where(raw > 0, raw / np.log10(np.maximum(column(subscribers), MIN_SUBSCRIBERS)), 0.0)
+    if formula == 'time_decay':
+        ages = column(ages_hours) if ages_hours is not None else np.zeros_like(scores)
+        scores = scores * np.power(0.5, np.maximum(ages, 0.0) / half_life_hours)
+    elif formula == 'channel_zscore':
+        group_index: Dict[Any, int] = {}
+        groups = np.fromiter((group_index.setdefault(channel_id, len(group_index)) for channel_id in (channel_ids or [None] * len(scores))),
+                             dtype=np.int64, count=len(scores))
+        counts = np.bincount(groups)
+        means = np.bincount(groups, weights=scores) / counts
+        variances = np.bincount(groups, weights=scores * scores) / counts - means * means
+        stds = np.sqrt(np.maximum(variances, 0.0))[groups]
+        scores = np.divide(scores - means[groups], stds, out=np.zeros_like(scores), where=stds > 0)
+    return scores.tolist()
+
+
+def _age_hours(date_value, now: datetime) -> float:
+    if not date_value:
+        return 0.0
+    try:
+        if isinstance(date_value, (int, float)):
+            posted = datetime.fromtimestamp(date_value, tz=timezone.utc)
+        else:
+            posted = datetime.fromisoformat(str(date_value))
+            if posted.tzinfo is None:
+                posted = posted.replace(tzinfo=timezone.utc)
+        return (now - posted).total_seconds() / 3600
+    except (TypeError, ValueError, OverflowError):
+        return 0.0
+
+def score_posts(posts: List[Dict], formula: str = DEFAULT_FORMULA, platform: str = 'telegram') -> List[Dict]:
+    """Пересчитывает trend_score готовых постов выбранной формулой и сортирует их по убыванию.
+
+    Возвращает копии постов (исходные могут быть общими с кэшем / другими запросами).
+    platform задает раскладку полей: 'telegram' (reactions/forwards/subscribers)
+    или 'vk' (likes/reposts/group_members).
+    """
+    formula = normalize_formula(formula)
+    if not posts:
+        return []
+    if platform == 'vk':
+        reactions_key, forwards_key, subscribers_key, channel_key = 'likes', 'reposts', 'group_members', 'group_id'
+    else:
+        reactions_key, forwards_key, subscribers_key, channel_key = 'reactions', 'forwards', 'subscribers', 'channel_id'
+    now = datetime.now(timezone.utc)
+    scores = score_columns(
+        [post.get('views') for post in posts],
+        [post.get(reactions_key) for post in posts],
+        [post.get('comments') for post in posts],
+        [post.get(forwards_key) for post in posts],
+        [post.get(subscribers_key) for post in posts],
+        ages_hours=[_age_hours(post.get('date'), now) for post in posts],
+        channel_ids=[post.get(channel_key) for post in posts],
+        formula=formula,
+    )
+    scored = [{**post, 'trend_score': round_score(score, formula)} for post, score in zip(posts, scores)]
+    scored.sort(key=lambda post: post['trend_score'], reverse=True)
+    return scored
+
+def round_score(score: float, formula: str = DEFAULT_FORMULA):
+    """trend_score для ответа: базовая формула исторически отдается целым числом."""
+    return int(score) if normalize_formula(formula) == DEFAULT_FORMULA else round(score, 4)
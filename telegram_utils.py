@@ -11,6 +11,7 @@ from telethon.errors.rpcerrorlist import (
 import logging
 import time
 import math
+from collections import deque
 from dotenv import load_dotenv
 from telethon.tl.functions.messages import GetHistoryRequest
 from telethon.tl.functions.channels import JoinChannelRequest, GetFullChannelRequest
@@ -18,7 +19,7 @@ from telethon.tl.types import InputPeerChannel
 from telethon.tl.functions.messages import SearchGlobalRequest
 from telethon.tl.types import Channel, User
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Optional, Callable, Any, Union, Tuple, Sequence
+from typing import List, Dict, Optional, Callable, Any, Union, Tuple, Sequence, Awaitable
 from user_manager import get_active_accounts, update_account_usage
 from telethon.tl.functions import TLRequest
 import sqlite3
@@ -37,6 +38,10 @@ from telethon.errors import ChannelInvalidError, ChannelPrivateError, UserDeacti
 # Импортируем КЛАСС пула, а не экземпляр
 from client_pools import TelegramClientPool, TELEGRAM_DEGRADED_MODE_DELAY 
 import redis_utils
+from channel_directory import directory_writer
+from post_model import post_from_telegram, telegram_counters
+from topk import TopK
+import scoring
 # Определим перечисление для типов прокси, так как ProxyType недоступен в Telethon
 class ProxyType:
     HTTP = 'http'
@@ -73,6 +78,9 @@ S3_LINK_TEMPLATE = os.getenv('S3_LINK_TEMPLATE', 'https://scraper.website.yandex
 TG_MEDIA_POLICY = os.getenv('TG_MEDIA_POLICY', 'all').lower()  # all | thumbnails_only
 TG_VIDEO_PLACEHOLDER_ALWAYS = os.getenv('TG_VIDEO_PLACEHOLDER_ALWAYS', 'false').lower() == 'true'
 TG_DEGRADED_REQ_THRESHOLD = int(os.getenv('TG_DEGRADED_REQ_THRESHOLD', '150'))
+# Межпроцессная координация загрузок одного канала через блокировку в Redis (в дополнение к in-process)
+TG_SINGLEFLIGHT_REDIS = os.getenv('TG_SINGLEFLIGHT_REDIS', 'false').lower() == 'true'
+TG_SINGLEFLIGHT_WAIT = float(os.getenv('TG_SINGLEFLIGHT_WAIT', '60'))
 # ----------------------------------------------------
 
 # load_dotenv()
@@ -96,6 +104,35 @@ TELEGRAM_DEGRADED_MODE_DELAY = 0.5
 # ------------------------------------------------------------------------
 
 
+# Классы запросов для pacer аккаунта (см. client_pools.AccountPacer)
+_REQUEST_CLASS_BY_NAME = {
+    'SearchRequest': 'search',
+    'SearchGlobalRequest': 'search',
+    'GetFullChannelRequest': 'full_channel',
+    'GetHistoryRequest': 'history',
+    'GetRepliesRequest': 'history',
+    'get_messages': 'history',
+    'iter_messages': 'history',
+    'download_media': 'download',
+}
+
+
+def _request_class_for(func_or_req_type) -> str:
+    """Определяет класс запроса по типу TL-запроса или имени метода клиента."""
+    return _REQUEST_CLASS_BY_NAME.get(getattr(func_or_req_type, '__name__', ''), 'default')
+
+
+def _account_id_for_client(client: TelegramClient) -> str:
+    """ID аккаунта клиента из пула, чтобы все wrapper'ы аккаунта делили один pacer."""
+    from pools import telegram_pool
+    account_id = telegram_pool.get_account_id_by_client(client)
+    if account_id:
+        return account_id
+    session_filename = getattr(client.session, 'filename', None) if client.session else None
+    logger.warning(f"Клиент {session_filename or 'unknown'} не найден в пуле, pacer привязан к имени сессии")
+    return session_filename or 'unknown'
+
+
 class TelegramClientWrapper:
     def __init__(self, client: TelegramClient, account_id: str, api_key: Optional[str] = None):
         self.client = client
@@ -134,60 +171,44 @@ class TelegramClientWrapper:
         else:
             logger.info(f"Клиент {self.account_id} работает без прокси (атрибут _proxy не найден).")
 
-        self.last_request_time = 0
-        self.last_group_request_time = 0
         self.requests_count = 0
         self.degraded_mode = False
+        # Темп запросов общий для аккаунта (а не для экземпляра wrapper), хранится в пуле
+        self.pacer = TelegramClientPool.get_pacer(account_id)
         
     def set_degraded_mode(self, degraded: bool):
         """Устанавливает режим пониженной производительности."""
         self.degraded_mode = degraded
+        self.pacer.degraded = degraded
 
-    async def _apply_delays(self):
-        """Применяет задержки перед выполнением запроса."""
-        # Мягкая деградация по Redis-счётчику
+    async def _apply_delays(self, request_class: str = 'default'):
+        """Ждет токен в pacer аккаунта для данного класса запроса."""
+        # Мягкая деградация по счётчику из накопителя (Redis сверяется не чаще USAGE_REFRESH_INTERVAL)
         try:
             if self.api_key and self.account_id:
-                stats = await redis_utils.get_account_stats_redis(self.account_id, 'telegram')
-                reqs = int(stats.get('requests_count', 0)) if isinstance(stats, dict) else 0
-                self.degraded_mode = reqs >= TG_DEGRADED_REQ_THRESHOLD
+                reqs = await redis_utils.usage_accumulator.get_requests_count(self.account_id, 'telegram')
+                self.set_degraded_mode(reqs >= TG_DEGRADED_REQ_THRESHOLD)
         except Exception as _:
             pass
-
-        current_time = time.time()
-        if self.degraded_mode:
-            request_delay = random.uniform(REQUEST_DELAY_MIN + 1, REQUEST_DELAY_MAX + 1)
-        else:
-            request_delay = random.uniform(REQUEST_DELAY_MIN, REQUEST_DELAY_MAX)
-        group_delay = GROUP_DELAY * 2 if self.degraded_mode else GROUP_DELAY
-
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < request_delay:
-            await asyncio.sleep(request_delay - time_since_last_request)
-            self.last_request_time = time.time()
-        else:
-            self.last_request_time = current_time
-
-        time_since_last_group = current_time - self.last_group_request_time
-        if time_since_last_group < group_delay:
-            await asyncio.sleep(group_delay - time_since_last_group)
-            self.last_group_request_time = time.time()
-        else:
-            self.last_group_request_time = current_time
+        await self.pacer.acquire(request_class)
+
+    async def iter_messages_paced(self, entity, page_size: int = 100, **kwargs):
+        """iter_messages, где каждая страница истории (GetHistory) проходит через pacer аккаунта."""
+        await self.pacer.acquire('history')
+        count = 0
+        async for message in self.client.iter_messages(entity, **kwargs):
+            yield message
+            count += 1
+            if count % page_size == 0:
+                await self.pacer.acquire('history') # Перед запросом следующей страницы
 
     async def _make_request(self, func_or_req_type: Union[Callable[..., Any], type], *args, **kwargs):
         """Выполняет запрос (Request или метод клиента) с соблюдением задержек."""
-        await self._apply_delays()
+        await self._apply_delays(_request_class_for(func_or_req_type))
         self.requests_count += 1
         if self.api_key:
-            try:
-                # Используем Redis для обновления статистики аккаунтов
-                from redis_utils import update_account_usage_redis
-                await update_account_usage_redis(self.api_key, self.account_id, "telegram")
-            except ImportError:
-                # Если Redis не доступен, используем обычное обновление
-                from user_manager import update_account_usage
-                await update_account_usage(self.api_key, self.account_id, "telegram")
+            # Статистика копится в памяти и сбрасывается в Redis пакетно (без сетевых вызовов здесь)
+            redis_utils.usage_accumulator.record(self.account_id, "telegram")
         
         # Логируем информацию о запросе с учетом прокси
         proxy_info = " через прокси" if self.has_proxy else " без прокси"
@@ -255,21 +276,11 @@ class TelegramClientWrapper:
 
     async def make_high_level_request(self, method, *args, **kwargs):
         """Выполняет высокоуровневый запрос к клиенту (не Request) с задержками."""
-        await self._apply_delays()
+        await self._apply_delays(_request_class_for(method))
         self.requests_count += 1
         if self.api_key:
-            try:
-                # Используем Redis для обновления статистики аккаунтов
-                try:
-                    from redis_utils import update_account_usage_redis
-                    await update_account_usage_redis(self.api_key, self.account_id, "telegram")
-                except ImportError:
-                    logger.warning("Модуль redis_utils не найден, используется синхронное обновление статистики")
-                    # Если Redis не доступен, используем обычное обновление (синхронное)
-                    from user_manager import update_account_usage
-                    await update_account_usage(self.api_key, self.account_id, "telegram")
-            except Exception as e:
-                logger.error(f"Ошибка при обновлении статистики использования: {e}")
+            # Статистика копится в памяти и сбрасывается в Redis пакетно (без сетевых вызовов здесь)
+            redis_utils.usage_accumulator.record(self.account_id, "telegram")
         
         proxy_info = " через прокси" if self.has_proxy else " без прокси"
         logger.info(f"Выполнение высокоуровневого метода Telegram {method.__name__}{proxy_info}")
@@ -379,6 +390,277 @@ async def auth_telegram_2fa(client: TelegramClient, password: str) -> None:
         logger.error(f"Ошибка при авторизации 2FA: {e}")
         raise
 
+# --- Кэш метаданных каналов (Redis) ---
+def _channel_meta_from_entity(entity, fallback_meta: Optional[Dict] = None) -> Dict:
+    """Собирает словарь метаданных канала из сущности Telethon."""
+    fallback_meta = fallback_meta or {}
+    title = getattr(entity, 'title', None) or f"{getattr(entity, 'first_name', '') or ''} {getattr(entity, 'last_name', '') or ''}".strip() or None
+    participants_count = getattr(entity, 'participants_count', None) or fallback_meta.get('participants_count')
+    return {
+        'id': entity.id,
+        'username': getattr(entity, 'username', None),
+        'title': title,
+        'access_hash': getattr(entity, 'access_hash', None) if isinstance(entity, types.Channel) else None,
+        'participants_count': participants_count
+    }
+
+
+async def remember_channel_entity(account_id: str, entity, participants_count: Optional[int] = None) -> None:
+    """Сохраняет метаданные канала в Redis-кэш (только для каналов и супергрупп)."""
+    if not isinstance(entity, types.Channel):
+        return
+    await redis_utils.set_tg_channel_meta(
+        entity.id,
+        account_id=account_id,
+        access_hash=getattr(entity, 'access_hash', None),
+        username=getattr(entity, 'username', None),
+        title=getattr(entity, 'title', None),
+        participants_count=participants_count or getattr(entity, 'participants_count', None) or None
+    )
+    # Каталог каналов для локального поиска (запись буферизуется и сохраняется пакетно).
+    # Каталог общий для всех API ключей: приватные каналы (без username) и группы
+    # (в т.ч. группы комментариев), доступные через чьи-то аккаунты, помечаются закрытыми
+    # и в результаты поиска не попадают
+    is_public = bool(getattr(entity, 'username', None) or getattr(entity, 'usernames', None))
+    directory_writer.record(
+        'telegram', entity.id,
+        title=getattr(entity, 'title', None),
+        username=getattr(entity, 'username', None),
+        members_count=participants_count or getattr(entity, 'participants_count', None) or None,
+        is_closed=not is_public or bool(getattr(entity, 'megagroup', False))
+    )
+
+
+async def resolve_channel_cached(wrapper: TelegramClientWrapper, channel_ref) -> Tuple[Optional[Any], Dict]:
+    """Возвращает (peer для запросов, метаданные канала), сначала обращаясь к Redis-кэшу.
+
+    При попадании в кэш с access_hash для этого аккаунта возвращается InputPeerChannel
+    без сетевых запросов. Иначе выполняется get_entity, и результат сохраняется в кэш.
+    """
+    cached_meta = await redis_utils.get_tg_channel_meta(channel_ref, wrapper.account_id)
+    if cached_meta and cached_meta.get('access_hash') is not None:
+        logger.debug(f"[Acc: {wrapper.account_id}] Канал {channel_ref} найден в кэше метаданных (ID: {cached_meta['id']})")
+        input_peer = types.InputPeerChannel(channel_id=cached_meta['id'], access_hash=cached_meta['access_hash'])
+        return input_peer, cached_meta
+
+    entity = await wrapper.make_high_level_request(wrapper.client.get_entity, channel_ref)
+    if not entity:
+        return None, cached_meta or {}
+    await remember_channel_entity(wrapper.account_id, entity)
+    return entity, _channel_meta_from_entity(entity, cached_meta)
+
+
+# --- Общая очередь каналов для нескольких аккаунтов ---
+class SingleFlight:
+    """Объединяет одновременные загрузки с одинаковым ключом (канал + окно + фильтры).
+
+    Первый вызов выполняет загрузку, остальные ждут его результата. Если загрузка
+    ведущего упала (FloodWait его аккаунта, отмена запроса), ожидающие выполняют ее сами,
+    чтобы ошибка одного аккаунта не приписывалась другим.
+    При use_redis и переданном load_shared координация расширяется на другие процессы:
+    владелец блокировки в Redis загружает, остальные ждут появления результата через load_shared.
+    """
+
+    _FAILED = object()
+
+    def __init__(self, use_redis: bool = False, wait_timeout: float = TG_SINGLEFLIGHT_WAIT):
+        self.use_redis = use_redis
+        self.wait_timeout = wait_timeout
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                 load_shared: Optional[Callable[[str, float], Awaitable[Any]]] = None):
+        future = self._inflight.get(key)
+        if future is not None:
+            logger.debug(f"[singleflight] Ожидаем уже идущую загрузку '{key}'")
+            result = await asyncio.shield(future)
+            if result is not self._FAILED:
+                return result
+            return await fetch()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        result = self._FAILED
+        try:
+            result = await self._fetch_coordinated(key, fetch, load_shared)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+            future.set_result(result)
+
+    async def _fetch_coordinated(self, key, fetch, load_shared):
+        if not (self.use_redis and load_shared):
+            return await fetch()
+        token = await redis_utils.acquire_singleflight_lock(key, ttl=int(self.wait_timeout) + 60)
+        if token:
+            try:
+                return await fetch()
+            finally:
+                await redis_utils.release_singleflight_lock(key, token)
+
+        # Канал загружает другой процесс - ждем его результат
+        started_at = time.time()
+        logger.debug(f"[singleflight] '{key}' загружается другим процессом, ожидаем результат")
+        while time.time() - started_at < self.wait_timeout:
+            await asyncio.sleep(0.5)
+            shared = await load_shared(key, started_at)
+            if shared is not None:
+                return shared
+            if not await redis_utils.is_singleflight_locked(key):
+                break # Владелец снял блокировку, но результата нет - загружаем сами
+        shared = await load_shared(key, started_at)
+        return shared if shared is not None else await fetch()
+
+
+# Загрузки каналов для trending и posts-by-period (ключи у них разные)
+_trending_flights = SingleFlight(use_redis=TG_SINGLEFLIGHT_REDIS)
+_period_flights = SingleFlight()
+
+
+# Ошибки аккаунта: при них аккаунт выбывает из ChannelWorkQueue, а элемент отдается другому аккаунту
+ACCOUNT_ERRORS = (FloodWaitError, AuthKeyError, UserDeactivatedBanError)
+
+
+class ChannelWorkQueue:
+    """Очередь работ (каналов или ключевых слов), которую аккаунты разбирают по готовности.
+
+    Каждый аккаунт берет следующий элемент сразу после завершения предыдущего.
+    При FloodWait или ошибке аккаунта (AuthKeyError, UserDeactivatedBanError) элемент
+    возвращается в очередь, а аккаунт выбывает из обработки этого запроса; оставшиеся
+    аккаунты дорабатывают очередь. Прочие ошибки считаются ошибками элемента: он
+    помечается как необработанный, аккаунт продолжает работу.
+    on_result(item, result) вызывается сразу по готовности элемента (для потоковой выдачи).
+    keep_results=False - результаты не накапливаются (их забирает on_result), run() вернет [].
+    """
+
+    def __init__(self, items: Sequence[Any], max_attempts: int = 3, stop_when: Optional[Callable[[List[Any]], bool]] = None,
+                 telegram_pool: Optional[TelegramClientPool] = None,
+                 on_result: Optional[Callable[[Any, Any], Awaitable[None]]] = None, keep_results: bool = True):
+        self.pending = deque((item, 0) for item in items)
+        self.telegram_pool = telegram_pool # Для парковки аккаунтов после FloodWait
+        self.max_attempts = max_attempts
+        self.stop_when = stop_when # Условие досрочной остановки по уже собранным результатам
+        self.on_result = on_result
+        self.keep_results = keep_results
+        self.in_flight = 0
+        self.failed_items: List[Any] = []
+        self._condition = asyncio.Condition()
+
+    async def _take(self):
+        async with self._condition:
+            # Ждем, пока другие аккаунты не вернут или не завершат свои элементы
+            while not self.pending and self.in_flight > 0:
+                await self._condition.wait()
+            if not self.pending:
+                return None
+            self.in_flight += 1
+            return self.pending.popleft()
+
+    async def _release(self, item=None, attempts: int = 0, requeue: bool = False, failed: bool = False):
+        async with self._condition:
+            self.in_flight -= 1
+            if failed:
+                self.failed_items.append(item)
+            elif requeue:
+                if attempts + 1 < self.max_attempts:
+                    self.pending.append((item, attempts + 1))
+                else:
+                    self.failed_items.append(item)
+            self._condition.notify_all()
+
+    async def _worker(self, account_id: str, process_item: Callable[[Any], Any], results: List[Any]):
+        processed = 0
+        while True:
+            taken = await self._take()
+            if taken is None:
+                break
+            item, attempts = taken
+            try:
+                item_result = await process_item(item)
+            except FloodWaitError as e:
+                logger.warning(f"[Acc: {account_id}] FloodWait {e.seconds}s на '{item}'. Возвращаем элемент в очередь, аккаунт выбывает.")
+                if self.telegram_pool:
+                    await self.telegram_pool.park_account(account_id, e.seconds)
+                await self._release(item, attempts, requeue=True)
+                break
+            except (AuthKeyError, UserDeactivatedBanError) as e:
+                logger.error(f"[Acc: {account_id}] Ошибка аккаунта при обработке '{item}': {e}. Возвращаем элемент в очередь, аккаунт выбывает.")
+                await self._release(item, attempts, requeue=True)
+                break
+            except Exception as e:
+                # Ошибка конкретного элемента (ссылка, разбор) - аккаунт продолжает работу
+                logger.error(f"[Acc: {account_id}] Ошибка при обработке '{item}': {e}. Элемент пропущен.", exc_info=True)
+                await self._release(item, attempts, failed=True)
+                continue
+            await self._release()
+            processed += 1
+            if self.on_result:
+                try:
+                    await self.on_result(item, item_result)
+                except Exception as e:
+                    logger.error(f"[Acc: {account_id}] Ошибка в обработчике результата для '{item}': {e}", exc_info=True)
+            if item_result and self.keep_results:
+                results.append(item_result)
+                if self.stop_when and self.pending and self.stop_when(results):
+                    logger.info(f"Условие остановки очереди выполнено, пропускаем оставшиеся {len(self.pending)} элементов.")
+                    self.pending.clear()
+        logger.info(f"[Acc: {account_id}] Обработано элементов из общей очереди: {processed}")
+
+    async def run(self, workers: Dict[str, Callable[[Any], Any]]) -> List[Any]:
+        """Запускает по одному воркеру на аккаунт. Возвращает список результатов process_item."""
+        results: List[Any] = []
+        await asyncio.gather(*(self._worker(account_id, process_item, results) for account_id, process_item in workers.items()))
+        left = [item for item, _ in self.pending] + self.failed_items
+        if left:
+            logger.warning(f"Не удалось обработать {len(left)} элементов очереди (нет доступных аккаунтов или превышены попытки): {left[:5]}...")
+        return results
+
+
+# Одновременные GetFullChannelRequest одного канала (разные слова/аккаунты) выполняются один раз
+_members_flights = SingleFlight()
+TG_MEMBERS_LOOKUP_CONCURRENCY = int(os.getenv('TG_MEMBERS_LOOKUP_CONCURRENCY', '4'))
+
+async def _get_participants_counts(wrapper: 'TelegramClientWrapper', account_id: str, chats: List[Any]) -> Dict[int, Optional[int]]:
+    """Число подписчиков для каналов из результата поиска.
+
+    Сначала берется из кэша метаданных (один MGET), оставшиеся запрашиваются через
+    GetFullChannelRequest с ограниченной параллельностью (темп держит pacer аккаунта).
+    """
+    counts: Dict[int, Optional[int]] = await redis_utils.get_tg_channel_members_many([chat.id for chat in chats])
+    missing = [chat for chat in chats if chat.id not in counts]
+    if counts:
+        logger.debug(f"[Acc: {account_id}] Подписчики {len(counts)} каналов взяты из кэша метаданных, к запросу: {len(missing)}")
+    if not missing:
+        return counts
+
+    semaphore = asyncio.Semaphore(TG_MEMBERS_LOOKUP_CONCURRENCY)
+
+    async def fetch_count(chat):
+        access_hash = getattr(chat, 'access_hash', None)
+        if access_hash is None:
+            logger.warning(f"[Acc: {account_id}] Канал {chat.id} ('{chat.title}') не имеет access_hash. Пропускаем GetFullChannelRequest.")
+            return None
+        async with semaphore:
+            try:
+                input_channel = types.InputChannel(channel_id=chat.id, access_hash=int(access_hash))
+                full_channel = await wrapper._make_request(GetFullChannelRequest, channel=input_channel)
+                if full_channel and hasattr(full_channel, 'full_chat') and full_channel.full_chat:
+                    return full_channel.full_chat.participants_count
+            except FloodWaitError:
+                raise
+            except Exception as e_gfc:
+                logger.error(f"[Acc: {account_id}] Ошибка GetFullChannelRequest для канала {chat.id}: {e_gfc}")
+        return None
+
+    fetched = await asyncio.gather(*(_members_flights.do(f"tg_members:{chat.id}", lambda chat=chat: fetch_count(chat)) for chat in missing),
+                                   return_exceptions=True)
+    for chat, count in zip(missing, fetched):
+        if isinstance(count, FloodWaitError):
+            raise count # Аккаунт упёрся в лимит - решение (ждать или парковать) принимает вызывающий код
+        counts[chat.id] = count if not isinstance(count, BaseException) else None
+    return counts
+
+
 # --- Вспомогательная функция (код без изменений, только проверяем сигнатуру) ---
 async def _find_channels_with_account(
     client: TelegramClient,
@@ -386,7 +668,8 @@ async def _find_channels_with_account(
     keywords: List[str],
     min_members: int = 100000,
     max_channels: int = 20,
-    api_key: Optional[str] = None
+    api_key: Optional[str] = None,
+    raise_account_errors: bool = False
     ) -> Dict[int, Dict]:
     """Ищет каналы с использованием одного конкретного клиента и обновляет статистику.
 
@@ -397,6 +680,7 @@ async def _find_channels_with_account(
         min_members: Минимальное количество участников.
         max_channels: Максимальное количество каналов.
         api_key: API ключ пользователя для обновления статистики.
+        raise_account_errors: Пробрасывать FloodWait и ошибки аккаунта (для ChannelWorkQueue).
 
     Returns:
         Словарь найденных каналов.
@@ -426,14 +710,19 @@ async def _find_channels_with_account(
             processed_keywords.add(keyword)
 
             try:
-                cache_key = f"tg_group_search:{keyword.lower()}:{min_members}:{max_channels}"
+                # Кэш хранит сырые результаты поиска (без фильтра min_members/max_channels), фильтруем при чтении
+                cache_key = f"tg_group_search:{keyword.lower()}"
+                search_limit = max_channels * 2
                 channels_data = None
                 if redis_client:
                     cached = await redis_client.get(cache_key)
                     if cached:
-                        logger.info(f"[Acc: {account_id}] Используем кэш для слова '{keyword}'")
                         try:
-                            channels_data = json.loads(cached)
+                            cached_entry = json.loads(cached)
+                            # Кэш годится, если поиск делался с не меньшим лимитом
+                            if isinstance(cached_entry, dict) and cached_entry.get('limit', 0) >= search_limit:
+                                channels_data = cached_entry.get('channels', [])
+                                logger.info(f"[Acc: {account_id}] Используем кэш для слова '{keyword}'")
                         except Exception as e:
                             logger.warning(f"[Acc: {account_id}] Ошибка при чтении кэша для '{keyword}': {e}")
                             channels_data = None
@@ -442,39 +731,26 @@ async def _find_channels_with_account(
                     result = await wrapper._make_request(
                         functions.contacts.SearchRequest,
                         q=keyword,
-                        limit=max_channels * 2
+                        limit=search_limit
                     )
                     if result is not None and isinstance(result.chats, list):
+                        broadcast_chats = [chat for chat in result.chats if isinstance(chat, types.Channel) and getattr(chat, 'megagroup', False) is False]
+                        members_by_id = await _get_participants_counts(wrapper, account_id, broadcast_chats)
                         channels_data = []
-                        for chat in result.chats:
-                            if isinstance(chat, types.Channel) and getattr(chat, 'megagroup', False) is False:
-                                channel_id = chat.id
-                                participants_count = None
-                                access_hash = getattr(chat, 'access_hash', None)
-                                if access_hash is not None:
-                                    try:
-                                        input_channel = types.InputChannel(channel_id=chat.id, access_hash=int(access_hash))
-                                        full_channel = await wrapper._make_request(
-                                            GetFullChannelRequest,
-                                            channel=input_channel
-                                        )
-                                        if full_channel and hasattr(full_channel, 'full_chat') and full_channel.full_chat:
-                                            participants_count = full_channel.full_chat.participants_count
-                                    except Exception as e_gfc:
-                                        logger.error(f"[Acc: {account_id}] Ошибка GetFullChannelRequest для канала {chat.id}: {e_gfc}")
-                                else:
-                                    logger.warning(f"[Acc: {account_id}] Канал {chat.id} ('{chat.title}') не имеет access_hash. Пропускаем GetFullChannelRequest.")
-                                channels_data.append({
-                                    'id': chat.id,
-                                    'title': chat.title,
-                                    'username': getattr(chat, 'username', None),
-                                    'members_count': participants_count
-                                })
-                    if redis_client:
-                        try:
-                            await redis_client.set(cache_key, json.dumps(channels_data), ex=86400)
-                        except Exception as e:
-                            logger.warning(f"[Acc: {account_id}] Не удалось сохранить результат поиска в кэш: {e}")
+                        for chat in broadcast_chats:
+                            participants_count = members_by_id.get(chat.id)
+                            await remember_channel_entity(account_id, chat, participants_count)
+                            channels_data.append({
+                                'id': chat.id,
+                                'title': chat.title,
+                                'username': getattr(chat, 'username', None),
+                                'members_count': participants_count
+                            })
+                        if redis_client:
+                            try:
+                                await redis_client.set(cache_key, json.dumps({'limit': search_limit, 'channels': channels_data}), ex=86400)
+                            except Exception as e:
+                                logger.warning(f"[Acc: {account_id}] Не удалось сохранить результат поиска в кэш: {e}")
                 # Теперь работаем с channels_data (список словарей)
                 for chat_data in channels_data or []:
                     channel_id = chat_data['id']
@@ -500,6 +776,7 @@ async def _find_channels_with_account(
                     logger.info(f"[Acc: {account_id}] Достигнут общий лимит ({max_channels}) найденных каналов.")
                     break
             except FloodWaitError as e:
+                if raise_account_errors: raise
                 logger.warning(f"[Acc: {account_id}] FloodWaitError при поиске по слову '{keyword}': ждем {e.seconds} секунд")
                 await asyncio.sleep(e.seconds + 1)
             except (UsernameNotOccupiedError, UsernameInvalidError):
@@ -507,10 +784,14 @@ async def _find_channels_with_account(
             except Exception as e_search:
                 logger.error(f"[Acc: {account_id}] Ошибка при поиске по слову '{keyword}': {e_search}", exc_info=True)
 
+    except FloodWaitError:
+         raise # Сюда попадаем только при raise_account_errors=True
     except AuthKeyError:
          logger.error(f"[Acc: {account_id}] Ключ авторизации невалиден. Поиск прерван.")
+         if raise_account_errors: raise
     except UserDeactivatedBanError:
          logger.error(f"[Acc: {account_id}] Аккаунт заблокирован. Поиск прерван.")
+         if raise_account_errors: raise
     except Exception as e_outer:
          logger.error(f"[Acc: {account_id}] Общая ошибка в _find_channels_with_account: {e_outer}", exc_info=True)
 
@@ -545,10 +826,22 @@ async def find_channels(
         return []
 
     all_found_channels_dict: Dict[int, Dict] = {}
-    tasks = []
-    keywords_distributed = 0
+    workers = {}
+
+    def _make_keyword_worker(client, account_id):
+        async def process_keyword(keyword):
+            return await _find_channels_with_account(
+                client=client,
+                account_id=account_id,
+                keywords=[keyword],
+                min_members=min_members,
+                max_channels=max_channels,
+                api_key=api_key,
+                raise_account_errors=True
+            )
+        return process_keyword
 
-    # --- Распределение ключевых слов и запуск задач --- 
+    # --- Проверка аккаунтов; ключевые слова разбираются из общей очереди --- 
     for i, account_info in enumerate(active_accounts):
         account_id = account_info.get('id')
         if not account_id: logger.warning(f"Найден аккаунт без ID в списке активных (индекс {i}). Пропуск."); continue
@@ -572,47 +865,18 @@ async def find_channels(
             continue
         # --- Конец проверки --- 
 
-        # Распределяем ключевые слова (round-robin)
-        keywords_for_account = keywords[i::num_accounts] # Берем каждое N-ое слово, начиная с i
-        
-        if not keywords_for_account:
-             logger.info(f"Для аккаунта {account_id} не осталось ключевых слов для обработки.")
-             continue
-        
-        keywords_distributed += len(keywords_for_account)
-        logger.info(f"Аккаунт {account_id} будет искать по {len(keywords_for_account)} словам: {keywords_for_account[:3]}..." )
-        
-        # Создаем задачу, передавая только нужные слова
-        tasks.append(asyncio.create_task(
-            _find_channels_with_account(
-                client=client, # Передаем рабочий клиент
-                account_id=account_id, 
-                keywords=keywords_for_account, # <<< Передаем ЧАСТЬ слов
-                min_members=min_members,
-                max_channels=max_channels,
-                api_key=api_key
-            )
-        ))
-
-    logger.info(f"Всего распределено ключевых слов: {keywords_distributed}. Запускаем {len(tasks)} задач поиска...")
-
-    # Ожидаем завершения всех задач
-    if tasks:
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for i, result in enumerate(results):
-            # Получаем ID для лога, даже если результат - ошибка
-            acc_id_log = "unknown_id"
-            if i < len(active_accounts) and isinstance(active_accounts[i], dict):
-                acc_id_log = active_accounts[i].get('id', f"index_{i}")
-
-            if isinstance(result, Exception):
-                logger.error(f"Ошибка при поиске каналов аккаунтом {acc_id_log}: {result}", exc_info=result)
-            elif isinstance(result, dict):
-                logger.info(f"Аккаунт {acc_id_log} нашел {len(result)} каналов.")
+        workers[account_id] = _make_keyword_worker(client, account_id)
+
+    logger.info(f"Запускаем общую очередь из {len(keywords)} ключевых слов на {len(workers)} аккаунтах...")
+
+    # Каждый аккаунт берет следующее слово, как только закончил предыдущее
+    if workers:
+        enough_channels = lambda found: len({channel_id for result in found for channel_id in result}) >= max_channels
+        results = await ChannelWorkQueue(list(dict.fromkeys(keywords)), stop_when=enough_channels, telegram_pool=telegram_pool).run(workers)
+        for result in results:
+            if isinstance(result, dict):
                 # Объединяем результаты, новые каналы заменят старые, если ID совпадут
                 all_found_channels_dict.update(result)
-            else:
-                logger.warning(f"Неожиданный результат поиска от аккаунта {acc_id_log}: {type(result)}")
 
     # Преобразуем объединенный словарь в список
     channels_list = list(all_found_channels_dict.values())
@@ -732,7 +996,9 @@ async def _process_channels_for_trending(
     min_comments: Optional[int],
     min_forwards: Optional[int],
     background_tasks_queue: List[Dict],
-    api_key: Optional[str] = None # <<<--- Добавляем api_key
+    api_key: Optional[str] = None, # <<<--- Добавляем api_key
+    raise_account_errors: bool = False, # Пробрасывать FloodWait и ошибки аккаунта наружу (для ChannelWorkQueue)
+    scanned_channels: Optional[set] = None # Сюда добавляются каналы, обработанные без ошибок
     ) -> List[Dict]:
     processed_posts_for_these_channels = []
     logger = logging.getLogger(__name__)
@@ -767,40 +1033,48 @@ async def _process_channels_for_trending(
                     else: logger.warning(f"[Шаг 0] Неожиданный тип ID: {type(channel_id_input)}. Пропуск."); continue
                 logger.debug(f"[Шаг 0] Идентификатор для запросов: {peer_identifier} (тип: {type(peer_identifier)})")
 
-                # --- Используем wrapper для get_entity ---
+                # --- Метаданные канала: сначала Redis-кэш, затем get_entity через wrapper ---
                 chat_entity = None
-                logger.debug(f"[Шаг 1] Вызов wrapper.get_entity({peer_identifier}) для получения информации")
+                channel_meta = {}
+                logger.debug(f"[Шаг 1] Получение метаданных канала {peer_identifier} (кэш -> get_entity)")
                 try:
-                    # chat_entity = await client.get_entity(peer_identifier)
-                    chat_entity = await wrapper.make_high_level_request(wrapper.client.get_entity, peer_identifier)
+                    chat_entity, channel_meta = await resolve_channel_cached(wrapper, peer_identifier)
                     if not chat_entity: logger.error(f"[Шаг 1] ОШИБКА: get_entity через wrapper вернул None для {peer_identifier}. Пропуск."); continue
-                    logger.debug(f"[Шаг 1] Успех! Получена сущность: ID={chat_entity.id}, Type={type(chat_entity)}")
-                    if not entity_username: entity_username = getattr(chat_entity, 'username', None)
-                    chat_entity_id_for_data = chat_entity.id
+                    logger.debug(f"[Шаг 1] Успех! Канал: ID={channel_meta.get('id')}, Type={type(chat_entity)}")
+                    if isinstance(chat_entity, types.InputPeerChannel):
+                        peer_identifier = chat_entity # Запросы истории идут по закэшированному access_hash
+                    if not entity_username: entity_username = channel_meta.get('username')
+                    chat_entity_id_for_data = channel_meta.get('id', chat_entity_id_for_data)
                 except (ValueError, TypeError) as e_val_type: logger.warning(f"[Шаг 1] ОШИБКА ({type(e_val_type).__name__}) для {peer_identifier}. Пропуск.", exc_info=True); continue
-                except FloodWaitError as flood: logger.warning(f"[Шаг 1] Flood wait ({flood.seconds}s) для {peer_identifier}. Пропуск."); await asyncio.sleep(flood.seconds); continue
+                except FloodWaitError as flood:
+                    if raise_account_errors: raise
+                    logger.warning(f"[Шаг 1] Flood wait ({flood.seconds}s) для {peer_identifier}. Пропуск."); await asyncio.sleep(flood.seconds); continue
+                except (AuthKeyError, UserDeactivatedBanError) as e_account:
+                    if raise_account_errors: raise
+                    logger.error(f"[Шаг 1] Ошибка аккаунта {account_id} при get_entity для {peer_identifier}: {e_account}. Пропуск."); continue
                 except Exception as e_entity: logger.error(f"[Шаг 1] Неожиданная ошибка get_entity для {peer_identifier}: {e_entity}", exc_info=True); continue
                 # -----------------------------------------
 
-                # --- Извлечение данных из chat_entity ---
-                channel_title = getattr(chat_entity, 'title', None) or f"{getattr(chat_entity, 'first_name', '')} {getattr(chat_entity, 'last_name', '')}".strip() or f"Unknown ({chat_entity_id_for_data})"
-                subscribers = getattr(chat_entity, 'participants_count', None)
+                # --- Извлечение данных из метаданных канала ---
+                channel_title = channel_meta.get('title') or f"Unknown ({chat_entity_id_for_data})"
+                subscribers = channel_meta.get('participants_count')
+                cached_subscribers = subscribers
 
                 # --- Используем wrapper для GetFullChannelRequest ---
                 if subscribers is None or subscribers == 0:
                     logger.debug(f"Subscribers count is {subscribers}. Trying GetFullChannelRequest via wrapper...")
                     try:
                         input_peer = None
-                        if isinstance(chat_entity, types.Channel) and hasattr(chat_entity, 'access_hash') and chat_entity.access_hash is not None:
-                            input_peer = types.InputChannel(channel_id=chat_entity.id, access_hash=chat_entity.access_hash)
+                        if channel_meta.get('access_hash') is not None:
+                            input_peer = types.InputChannel(channel_id=chat_entity_id_for_data, access_hash=channel_meta['access_hash'])
                         if input_peer and isinstance(input_peer, types.InputChannel):
                             # full_chat_result = await client(functions.channels.GetFullChannelRequest(channel=input_peer))
                             full_chat_result = await wrapper._make_request(functions.channels.GetFullChannelRequest, channel=input_peer)
                             subscribers = getattr(getattr(full_chat_result, 'full_chat', None), 'participants_count', None)
                             if subscribers is not None: logger.debug(f"Successfully retrieved subscribers ({subscribers}) via GetFullChannelRequest.")
-                            else: logger.warning(f"GetFullChannelRequest did not return participants_count for {chat_entity.id}.")
-                        else: logger.warning(f"Could not create InputPeerChannel for GetFullChannelRequest for {chat_entity.id}.")
-                    except Exception as e_full: logger.warning(f"Error getting full channel info for {chat_entity.id}: {e_full}")
+                            else: logger.warning(f"GetFullChannelRequest did not return participants_count for {chat_entity_id_for_data}.")
+                        else: logger.warning(f"Could not create InputPeerChannel for GetFullChannelRequest for {chat_entity_id_for_data}.")
+                    except Exception as e_full: logger.warning(f"Error getting full channel info for {chat_entity_id_for_data}: {e_full}")
                 # -----------------------------------------------
 
                 # --- Используем wrapper для get_entity(username) ---
@@ -824,7 +1098,7 @@ async def _process_channels_for_trending(
                         found_chat_with_hash = None
                         if search_result and hasattr(search_result, 'chats'): # Add check here
                             for found_chat in search_result.chats:
-                                if found_chat.id == chat_entity.id and hasattr(found_chat, 'access_hash') and found_chat.access_hash: found_chat_with_hash = found_chat; break
+                                if found_chat.id == chat_entity_id_for_data and hasattr(found_chat, 'access_hash') and found_chat.access_hash: found_chat_with_hash = found_chat; break
                         if found_chat_with_hash:
                             logger.debug(f"Found channel via search with access_hash. Trying GetFullChannelRequest again via wrapper...")
                             try:
@@ -836,16 +1110,18 @@ async def _process_channels_for_trending(
                                 else: logger.warning("GetFullChannelRequest after search did not return participants_count.")
                             except Exception as e_gfc_search: logger.warning(f"Error during GetFullChannelRequest after search: {e_gfc_search}")
                         else: logger.warning(f"Channel '{entity_username}' not found via SearchRequest or no access_hash in result.")
-                    except FloodWaitError as flood: logger.warning(f"Flood wait ({flood.seconds}s) during SearchRequest for '{entity_username}'."); await asyncio.sleep(flood.seconds)
+                    except FloodWaitError as flood:
+                        if raise_account_errors: raise
+                        logger.warning(f"Flood wait ({flood.seconds}s) during SearchRequest for '{entity_username}'."); await asyncio.sleep(flood.seconds)
+                    except (AuthKeyError, UserDeactivatedBanError):
+                        if raise_account_errors: raise
+                        logger.error(f"Account error {account_id} during SearchRequest for '{entity_username}'.")
                     except Exception as e_search: logger.warning(f"Error during SearchRequest for '{entity_username}': {e_search}")
                 # -------------------------------------------
 
-                # ... (проверка кэша и установка subscribers_for_calc как раньше) ...
-                if subscribers is None:
-                    cache_key = f"@{entity_username}" if entity_username else str(chat_entity_id_for_data)
-                    cached_subs = channel_members_cache.get(cache_key)
-                    if cached_subs is not None: logger.info(f"Subscribers count not found actively for {chat_entity_id_for_data}. Using cached value: {cached_subs}"); subscribers = cached_subs
-                    else: logger.warning(f"Subscribers count not found actively AND not in cache for {chat_entity_id_for_data}. Cache key tried: '{cache_key}'.")
+                # --- Сохраняем найденное число подписчиков в кэш метаданных ---
+                if subscribers and subscribers != cached_subscribers:
+                    await redis_utils.set_tg_channel_meta(chat_entity_id_for_data, participants_count=subscribers)
 
                 if subscribers is None: logger.warning(f"Using 10 for trend score calculation for channel {chat_entity_id_for_data} ('{entity_username}' / {peer_identifier})."); subscribers_count_for_calc = 10
                 else: subscribers_count_for_calc = int(subscribers)
@@ -857,16 +1133,8 @@ async def _process_channels_for_trending(
                 processed_in_channel_count = 0
                 # --- Обновляем статистику перед iter_messages (приблизительно) ---
                 if api_key:
-                    try:
-                        from redis_utils import update_account_usage_redis
-                        await update_account_usage_redis(api_key, account_id, "telegram") # Используем account_id из параметров
-                        logger.info(f"[Acc: {account_id}] [Chan: {channel_id_input}] Статистика обновлена (Redis) перед iter_messages.")
-                    except ImportError:
-                        from user_manager import update_account_usage
-                        await update_account_usage(api_key, account_id, "telegram")
-                        logger.info(f"[Acc: {account_id}] [Chan: {channel_id_input}] Статистика обновлена (user_manager) перед iter_messages.")
-                    except Exception as stats_err:
-                        logger.error(f"[Acc: {account_id}] [Chan: {channel_id_input}] Ошибка обновления статистики перед iter_messages: {stats_err}")
+                    redis_utils.usage_accumulator.record(account_id, "telegram") # Используем account_id из параметров
+                    logger.debug(f"[Acc: {account_id}] [Chan: {channel_id_input}] Статистика учтена перед iter_messages.")
                 else:
                     logger.warning(f"[Acc: {account_id}] [Chan: {channel_id_input}] API ключ не предоставлен, статистика не обновлена перед iter_messages.")
                 # -----------------------------------------------------------------------
@@ -878,7 +1146,7 @@ async def _process_channels_for_trending(
                 
                 # --- ДИАГНОСТИКА: Пытаемся получить 1 сообщение напрямую ---
                 try:
-                    latest_message = await client.get_messages(peer_identifier, limit=1)
+                    latest_message = await wrapper.make_high_level_request(wrapper.client.get_messages, peer_identifier, limit=1)
                     if latest_message and hasattr(latest_message, '__len__') and len(latest_message) > 0:
                         msg = latest_message[0]
                         logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] DIAGNOSTIC: get_messages(limit=1) successful. Latest post ID: {msg.id}, Date: {msg.date}")
@@ -890,27 +1158,29 @@ async def _process_channels_for_trending(
 
                 # --- ДИАГНОСТИКА: Оборачиваем iter_messages в try...except ---
                 try:
-                    async for post in client.iter_messages(entity=peer_identifier, limit=3000):
+                    # --- Фаза 1: легкий проход по истории, считаем trend_score без доп. запросов ---
+                    # Храним только top-K кандидатов канала (мин-куча по trend_score)
+                    top_candidates = TopK(posts_per_channel, key=lambda c: c[:2]) # Ключ: (light_score, id поста)
+                    seen_grouped_ids = set()
+                    # Альбомы собираются из потока iter_messages без дополнительных запросов
+                    async for streamed in _iter_posts_with_albums(wrapper.iter_messages_paced(peer_identifier, limit=3000)):
                         iter_count += 1
-                        # Лёгкая пауза каждые 20 сообщений, чтобы сгладить нагрузку
-                        if iter_count % 20 == 0:
-                            await asyncio.sleep(random.uniform(0.2, 0.6))
-                        if not post or not isinstance(post, types.Message) or not post.date:
-                            logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пропуск (None, не Message или нет даты)")
-                            continue
-                        
+                        post = streamed.main
+
                         post_date_naive = post.date.replace(tzinfo=None) if post.date.tzinfo is not None else post.date
                         logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Post ID={post.id}, Date={post_date_naive.isoformat()}")
                         
                         if post_date_naive < cutoff_date_naive:
                             logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пост {post.id} слишком старый ({post_date_naive.isoformat()} < {cutoff_date_naive.isoformat()}). Прерываем цикл.")
                             break # Прерываем цикл, т.к. сообщения идут от новых к старым
-                            
-                        # --- УБИРАЕМ ПРОВЕРКУ ТЕКСТА ЗДЕСЬ ---
-                        # if not post.message:
-                        #     logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пост {post.id} пропущен (нет текста).")
-                        #     continue
-                        # -------------------------------------
+
+                        if streamed.grouped_id:
+                            if streamed.grouped_id in seen_grouped_ids:
+                                continue
+                            seen_grouped_ids.add(streamed.grouped_id)
+                        elif not (getattr(post, 'message', None) or getattr(post, 'text', None)):
+                            logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пост {post.id} пропущен (нет текста).")
+                            continue
                             
                         views = getattr(post, 'views', 0) if post.views is not None else 0
                         if min_views is not None and views < min_views:
@@ -935,15 +1205,22 @@ async def _process_channels_for_trending(
                         if min_forwards is not None and forwards < min_forwards:
                             logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пост {post.id} пропущен (форварды {forwards} < min_forwards {min_forwards}).")
                             continue
-                        
+
+                        light_score = scoring.trend_score(views, reactions, comments, forwards, subscribers)
+                        top_candidates.push((light_score, post.id, streamed, (views, reactions, comments, forwards)))
+
+                    logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Фаза 1: просмотрено {iter_count} постов, кандидатов в top-{posts_per_channel}: {len(top_candidates)}")
+
+                    # --- Фаза 2: альбомы, текст и медиа только для top-K кандидатов ---
+                    for _light_score, _post_id, streamed, (views, reactions, comments, forwards) in top_candidates.results():
+                        post = streamed.main
                         # --- Дедупликация альбомов ---
                         if hasattr(post, 'grouped_id') and post.grouped_id:
                             if post.grouped_id in processed_grouped_ids:
                                 continue  # Уже обработан этот альбом
                             
                             try:
-                                album_messages = await get_album_messages(wrapper, peer_identifier, post)
-                                album_messages.sort(key=lambda m: m.id)
+                                album_messages = await _complete_streamed_album(wrapper, peer_identifier, streamed)
                                 main_album_msg = album_messages[0]
                                 # Собираем текст/подпись со ВСЕХ сообщений альбома
                                 post_text_found = ""
@@ -957,25 +1234,12 @@ async def _process_channels_for_trending(
                                     except Exception as e_text_extract:
                                         logger.warning(f"[Acc: {account_id}][Chan: {channel_id_input}] Error extracting text from album message {m.id} (Group: {post.grouped_id}): {e_text_extract}")
                                 post_text_found = "\n".join(collected_texts).strip() # Объединяем найденные тексты
-                                # Если текст не найден, пытаемся получить текст из соседнего сообщения до или после альбома
+                                # Если текст не найден, берем текст соседнего сообщения до или после альбома
                                 if not post_text_found:
-                                    for neighbor_id in (main_album_msg.id - 1, album_messages[-1].id + 1):
-                                        try:
-                                            neighbor = await wrapper.make_high_level_request(
-                                                wrapper.client.get_messages,
-                                                peer_identifier,
-                                                ids=neighbor_id
-                                            )
-                                            neighbor_txt = getattr(neighbor, 'message', None) or getattr(neighbor, 'text', None) or getattr(neighbor, 'caption', None)
-                                            # Убедимся, что соседнее сообщение - текстовое (без медиа)
-                                            if neighbor and neighbor_txt and not getattr(neighbor, 'media', None):
-                                                post_text_found = neighbor_txt
-                                                logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Found adjacent text for album {main_album_msg.id} in msg {neighbor_id}")
-                                                break # Нашли текст, выходим из цикла проверки соседей
-                                        except Exception as e_desc:
-                                            # Ошибки получения соседних сообщений ожидаемы (их может не быть)
-                                            logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Error fetching adjacent text for album post {main_album_msg.id} at id {neighbor_id}: {e_desc}")
-                               
+                                    post_text_found = await _album_neighbor_text(wrapper, peer_identifier, streamed, album_messages)
+                                    if post_text_found:
+                                        logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Found adjacent text for album {main_album_msg.id}")
+
                                 # Собираем все медиа из альбома
                                 media_objects_to_process = [m.media for m in album_messages if m.media]
                                 media_tasks_for_post = {}
@@ -1022,27 +1286,14 @@ async def _process_channels_for_trending(
                                             "post_text": post_text_found
                                         }
                                 background_tasks_queue.extend(media_tasks_for_post.values())
-                                raw_engagement_score = (main_album_msg.views or 0) + (reactions * 10) + (comments * 20) + (forwards * 50)
-                                subscribers_for_calc = subscribers if subscribers and subscribers > 0 else 1
-                                log_subs = math.log10(subscribers_for_calc) if subscribers_for_calc > 1 else 1
-                                trend_score = raw_engagement_score / log_subs if log_subs != 0 else raw_engagement_score
-                                post_data = {
-                                    'id': main_album_msg.id,
-                                    'channel_id': str(chat_entity_id_for_data),
-                                    'channel_title': channel_title,
-                                    'channel_username': entity_username,
-                                    'subscribers': subscribers,
-                                    'text': post_text_found,
-                                    'views': main_album_msg.views,
-                                    'reactions': reactions,
-                                    'comments': comments,
-                                    'forwards': forwards,
-                                    'date': main_album_msg.date.isoformat(),
-                                    'url': f"https://t.me/{entity_username}/{main_album_msg.id}" if entity_username else f"https://t.me/c/{abs(chat_entity_id_for_data)}/{main_album_msg.id}",
-                                    'media': media_list,
-                                    'trend_score': int(trend_score)
-                                }
-                                processed_posts_for_these_channels.append(post_data)
+                                trend_score = scoring.trend_score(main_album_msg.views or 0, reactions, comments, forwards, subscribers)
+                                post_data = post_from_telegram(
+                                    main_album_msg, str(chat_entity_id_for_data), channel_title, entity_username, subscribers,
+                                    text=post_text_found, media=media_list,
+                                    counters=(main_album_msg.views or 0, reactions, comments, forwards),
+                                    trend_score=scoring.round_score(trend_score)
+                                )
+                                processed_posts_for_these_channels.append(post_data.to_dict())
                                 processed_in_channel_count += 1
                                 processed_grouped_ids.add(post.grouped_id)
                                 if processed_in_channel_count >= posts_per_channel: break
@@ -1055,54 +1306,20 @@ async def _process_channels_for_trending(
                         # logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пост {post.id} ПРОШЕЛ все фильтры. Добавляем.") # Логируем после проверки текста
                         
                         # --- Собираем данные поста ---
-                        post_data = {
-                            'id': post.id,
-                            'channel_id': str(chat_entity_id_for_data),
-                            'channel_title': channel_title,
-                            'channel_username': entity_username,
-                            'subscribers': subscribers,
-                            'text': "", # Инициализируем текст пустым
-                            'views': views, 'reactions': reactions, 'comments': comments, 'forwards': forwards,
-                            'date': post.date.isoformat(),
-                            'url': f"https://t.me/{entity_username}/{post.id}" if entity_username else f"https://t.me/c/{abs(chat_entity_id_for_data)}/{post.id}",
-                            'media': [],
-                            'trend_score': 0.0
-                        }
+                        post_data = post_from_telegram(
+                            post, str(chat_entity_id_for_data), channel_title, entity_username, subscribers,
+                            text="", # Текст заполняется ниже
+                            counters=(views, reactions, comments, forwards),
+                            trend_score=0.0
+                        )
 
                         # --- Обработка медиа и Поиск Текста ---
                         media_objects_to_process = []
                         # Извлекаем текст из основного сообщения (.message или .text)
                         post_text_found = getattr(post, 'message', None) or getattr(post, 'text', None) or ""
 
-                        if hasattr(post, 'grouped_id') and post.grouped_id: # Проверяем, является ли пост частью альбома
-                            logger.debug(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Post {post.id} is part of album {post.grouped_id}. Fetching album messages...")
-                            try:
-                                album_messages = await get_album_messages(wrapper, peer_identifier, post)
-                                # Собираем текст/подпись со ВСЕХ сообщений альбома
-                                collected_texts_single = []
-                                for album_msg in album_messages:
-                                    # Собираем медиа со всех сообщений альбома
-                                    if album_msg and album_msg.media:
-                                        media_objects_to_process.append(album_msg.media)
-                                    # Ищем первый непустой текст в альбоме
-                                    try:
-                                        txt_single = getattr(album_msg, 'message', None) or getattr(album_msg, 'text', None) or getattr(album_msg, 'caption', None)
-                                        if txt_single:
-                                            collected_texts_single.append(str(txt_single))
-                                    except Exception as e_text_single:
-                                        logger.warning(f"[Acc: {account_id}][Chan: {channel_id_input}] Error extracting text from album message {album_msg.id} (during single post handling): {e_text_single}")
-                                # Объединяем текст, если он был найден
-                                if collected_texts_single:
-                                    post_text_found = "\n".join(collected_texts_single).strip()
-                                    logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Combined text for album {post.grouped_id} from {len(collected_texts_single)} message(s).")
-                                # Если текст так и не найден в альбоме, используем основной текст поста (если был)
-                                elif not post_text_found: # Дополнительно проверяем post_text_found
-                                    logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: No text found in album {post.grouped_id}, using main message text ('{post_text_found[:20]}...')")
-                            except Exception as e_album:
-                                logger.error(f"[Acc: {account_id}][Chan: {channel_id_input}] Error fetching album for post {post.id}: {e_album}")
-                                # Используем текст из основного сообщения, если был
-
-                        elif post.media: # Если это не альбом, но есть медиа
+                        # Альбомы обработаны выше, здесь только одиночные сообщения
+                        if post.media: # Если это не альбом, но есть медиа
                             media_objects_to_process.append(post.media)
 
                         # --- НОВАЯ ПРОВЕРКА: Пропускаем, если текст так и не найден ---
@@ -1115,14 +1332,12 @@ async def _process_channels_for_trending(
                         logger.info(f"[Acc: {account_id}][Chan: {channel_id_input}] Iter {iter_count}: Пост {post.id} ПРОШЕЛ все фильтры (включая текст). Добавляем.")
 
                         # Обновляем текст в post_data
-                        post_data['text'] = post_text_found
+                        post_data.text = post_text_found
 
                         # --- Модифицированная обработка медиа --- 
                         media_tasks_for_post = {} # Словарь для уникальных задач загрузки
                         processed_media_urls = set() # Чтобы не добавлять одинаковые URL
                         media_list = []  # <-- добавляю инициализацию
-                        # Инициализируем post_data['media'] как пустой список
-                        post_data['media'] = []
 
                         for media_obj_container in media_objects_to_process:
                             media_details_tuple = _extract_media_details(media_obj_container)
@@ -1172,12 +1387,12 @@ async def _process_channels_for_trending(
                                     "media_object": media_object,
                                     "file_id": file_id,
                                     "s3_filename": s3_filename_to_use,
-                                    "post_url": post_data.get('url'),
+                                    "post_url": post_data.url,
                                     "post_text": post_text_found
                                 }
                             elif not s3_filename_to_use:
                                 logger.warning(f"[Acc: {account_id}] Не удалось определить имя файла для media {file_id} ({media_type}) — задача не будет добавлена.")
-                        post_data['media'] = media_list        
+                        post_data.media = media_list
                         # Добавляем все уникальные задачи для этого поста в общую очередь
                         # Важно: убедитесь, что background_tasks_queue ожидает такой формат словаря!
                         # Возможно, нужно будет скорректировать background_tasks.py/media_utils.py
@@ -1185,70 +1400,198 @@ async def _process_channels_for_trending(
                         # --- Конец модифицированной обработки медиа ---
 
                         # --- Расчет trend_score ---
-                        raw_engagement_score = views + (reactions * 10) + (comments * 20) + (forwards * 50)
-                        subscribers_for_calc = subscribers if subscribers and subscribers > 0 else 1 # Защита от 0
-                        log_subs = math.log10(subscribers_for_calc) if subscribers_for_calc > 1 else 1 # Защита от <=1
-                        trend_score = raw_engagement_score / log_subs if log_subs != 0 else raw_engagement_score # Защита от деления на 0 (хотя log_subs не будет 0)
-                        post_data['trend_score'] = int(trend_score)
+                        post_data.trend_score = scoring.round_score(scoring.trend_score(views, reactions, comments, forwards, subscribers))
 
-                        processed_posts_for_these_channels.append(post_data)
+                        processed_posts_for_these_channels.append(post_data.to_dict())
                         processed_in_channel_count += 1
                         if processed_in_channel_count >= posts_per_channel: break
+                    if scanned_channels is not None:
+                        scanned_channels.add(channel_id_input) # История канала просмотрена без ошибок
                 except Exception as e_iter:
+                     if raise_account_errors and isinstance(e_iter, ACCOUNT_ERRORS): raise
                      logger.error(f"[Acc: {account_id}][Chan: {channel_id_input}] DIAGNOSTIC: Error during client.iter_messages loop: {e_iter}", exc_info=True)
                 # ------------------------------------------------------------
 
                 # --- Логирование завершения (без изменений) ---
                 logger.info(f"--- Завершена обработка канала {channel_id_input}. Собрано постов: {channel_processed_posts_count} ---")
             except FloodWaitError as e:
+                if raise_account_errors: raise
                 logger.warning(f"[Шаг 2] Flood wait ({e.seconds}s) при iter_messages для {peer_identifier}. Прерываем."); await asyncio.sleep(e.seconds)
             except Exception as e_iter:
+                if raise_account_errors and isinstance(e_iter, ACCOUNT_ERRORS): raise
                 logger.error(f"[Шаг 2] ОШИБКА iter_messages для {peer_identifier}: {e_iter}", exc_info=True)
             logger.info(f"--- Завершена обработка канала {channel_id_input}. Собрано постов: {channel_processed_posts_count} ---")
     except Exception as main_err:
+        if raise_account_errors and isinstance(main_err, ACCOUNT_ERRORS): raise
         logger.error(f"Критическая ошибка в _process_channels_for_trending перед циклом обработки каналов: {main_err}", exc_info=True)
         return []
     logger.info(f"=== Завершена обработка ВСЕХ каналов для этого вызова, собрано итого: {len(processed_posts_for_these_channels)} постов ===")
     return processed_posts_for_these_channels
 
 
-async def get_album_messages(wrapper: TelegramClientWrapper, chat, main_message): # <<< Принимаем wrapper
-    """Получает все сообщения альбома."""
+ALBUM_MAX_SIZE = 10  # Максимальное количество медиа в альбоме Telegram
+
+
+def _group_album_window(window_messages, main_message):
+    """Оставляет из окна сообщений только непрерывную серию альбома вокруг main_message."""
+    album_id = main_message.grouped_id
+    by_id = {}
+    for msg in window_messages:
+        if msg and isinstance(msg, types.Message):
+            by_id[msg.id] = msg
+    by_id[main_message.id] = main_message
+
+    album_messages = [main_message]
+    # Идем от основного сообщения в обе стороны, пока grouped_id совпадает
+    for direction in (1, -1):
+        current_id = main_message.id + direction
+        while abs(current_id - main_message.id) < ALBUM_MAX_SIZE:
+            msg = by_id.get(current_id)
+            if msg is None or getattr(msg, 'grouped_id', None) != album_id:
+                break
+            album_messages.append(msg)
+            current_id += direction
+
+    album_messages.sort(key=lambda m: m.id)
+    return album_messages
+
+
+async def get_album_messages(wrapper, chat, main_message):
+    """Получает все сообщения альбома одним запросом get_messages по окну main_id±9.
+
+    Принимает TelegramClientWrapper (запрос идет через make_high_level_request)
+    или обычный TelegramClient (например, из media_utils).
+    """
     if not hasattr(main_message, 'grouped_id') or not main_message.grouped_id:
         return [main_message]  # Это не альбом
 
     album_id = main_message.grouped_id
     main_id = main_message.id
+    window_ids = [i for i in range(main_id - (ALBUM_MAX_SIZE - 1), main_id + ALBUM_MAX_SIZE) if i > 0 and i != main_id]
 
-    # Получаем ID сообщений выше (предположительно более новые части альбома)
-    # и ниже (предположительно более старые части)
-    album_messages = [main_message]
+    try:
+        if isinstance(wrapper, TelegramClientWrapper):
+            window_messages = await wrapper.make_high_level_request(wrapper.client.get_messages, chat, ids=window_ids)
+        else:
+            window_messages = await wrapper.get_messages(chat, ids=window_ids)
+    except Exception as e:
+        logger.error(f"Ошибка при получении окна сообщений альбома {album_id} (ids {window_ids[0]}..{window_ids[-1]}): {e}")
+        return [main_message]
 
-    # Ищем в обоих направлениях от основного сообщения
-    # Максимальное количество медиа в альбоме Telegram - 10
-    for offset_id in [main_id + 1, main_id - 1]:  # Ищем в обе стороны
-        direction = 1 if offset_id > main_id else -1
-        for i in range(9):  # Максимум 9 дополнительных сообщений (10 всего в альбоме)
-            try:
-                # --- Используем wrapper для get_messages --- 
-                # msg = await client.get_messages(chat, ids=offset_id + (i * direction))
-                msg = await wrapper.make_high_level_request(wrapper.client.get_messages, chat, ids=offset_id + (i * direction))
-                # ---------------------------------------------------------
-                # Check if msg is a Message object before accessing grouped_id
-                if msg and isinstance(msg, types.Message) and hasattr(msg, 'grouped_id') and msg.grouped_id == album_id:
-                    album_messages.append(msg)
-                else:
-                    # Если сообщение не часть альбома, прекращаем поиск в этом направлении
-                    break
-            except Exception as e:
-                # Лог ошибки остается прежним
-                logger.error(f"Ошибка при получении сообщения {offset_id + (i * direction)}: {e}")
-                break
+    album_messages = _group_album_window(window_messages or [], main_message)
+    logger.info(f"Найдено {len(album_messages)} сообщений в альбоме {album_id} (1 запрос)")
+    return album_messages
 
-    logger.info(f"Найдено {len(album_messages)} сообщений в альбоме {album_id}")
+
+class _StreamedPost:
+    """Пост из потока iter_messages: одиночное сообщение или собранный альбом."""
+    __slots__ = ('messages', 'grouped_id', 'newer_neighbor', 'older_neighbor', 'complete')
+
+    def __init__(self, messages, newer_neighbor=None, older_neighbor=None, complete=True):
+        self.messages = sorted(messages, key=lambda m: m.id)
+        self.grouped_id = getattr(self.messages[0], 'grouped_id', None)
+        self.newer_neighbor = newer_neighbor  # Сообщение потока сразу после альбома (id больше)
+        self.older_neighbor = older_neighbor  # Сообщение потока сразу до альбома (id меньше)
+        self.complete = complete  # False, если поток оборвался внутри альбома
+
+    @property
+    def main(self):
+        return self.messages[0]
+
+
+async def _iter_posts_with_albums(message_iter):
+    """Группирует подряд идущие сообщения с одинаковым grouped_id в один пост.
+
+    iter_messages отдает части альбома подряд, поэтому альбом собирается из потока
+    без дополнительных запросов. Служебные сообщения не выдаются, но учитываются как соседи.
+    """
+    album_buffer = []
+    newer_neighbor = None
+    previous = None
+    async for message in message_iter:
+        is_post = isinstance(message, types.Message) and message.date and getattr(message, 'action', None) is None
+        grouped_id = getattr(message, 'grouped_id', None) if is_post else None
+
+        if album_buffer and grouped_id and grouped_id == album_buffer[0].grouped_id:
+            album_buffer.append(message)
+            previous = message
+            continue
+        if album_buffer:
+            yield _StreamedPost(album_buffer, newer_neighbor, message)
+            album_buffer = []
+
+        if is_post:
+            if grouped_id:
+                album_buffer = [message]
+                newer_neighbor = previous
+            else:
+                yield _StreamedPost([message])
+        previous = message
+
+    if album_buffer:
+        # Поток закончился на альбоме — более старые части могли не попасть в выборку
+        yield _StreamedPost(album_buffer, newer_neighbor, None, complete=False)
+
+
+async def _complete_streamed_album(wrapper, chat, streamed: _StreamedPost):
+    """Возвращает сообщения альбома; дозапрашивает окно только если альбом на границе выборки."""
+    if streamed.complete:
+        return streamed.messages
+    logger.debug(f"Альбом {streamed.grouped_id} на границе выборки, дозапрашиваем окно сообщений")
+    album_messages = await get_album_messages(wrapper, chat, streamed.main)
+    known_ids = {m.id for m in album_messages}
+    album_messages.extend(m for m in streamed.messages if m.id not in known_ids)
+    album_messages.sort(key=lambda m: m.id)
     return album_messages
 
+
+async def _album_neighbor_text(wrapper, chat, streamed: _StreamedPost, album_messages) -> str:
+    """Текст соседнего текстового сообщения (main_id-1, затем last_id+1) из буфера потока."""
+    first_id = album_messages[0].id
+    last_id = album_messages[-1].id
+    for neighbor_id, buffered in ((first_id - 1, streamed.older_neighbor), (last_id + 1, streamed.newer_neighbor)):
+        neighbor = buffered if buffered is not None and buffered.id == neighbor_id else None
+        if neighbor is None and not streamed.complete and neighbor_id < first_id:
+            # Старший сосед не попал в поток (граница выборки) — единственный случай сетевого запроса
+            try:
+                neighbor = await wrapper.make_high_level_request(wrapper.client.get_messages, chat, ids=neighbor_id)
+            except Exception as e_desc:
+                logger.info(f"Error fetching adjacent text for album {first_id} at id {neighbor_id}: {e_desc}")
+                continue
+        neighbor_txt = getattr(neighbor, 'message', None) or getattr(neighbor, 'text', None) or getattr(neighbor, 'caption', None)
+        # Соседнее сообщение должно быть текстовым (без медиа)
+        if neighbor and neighbor_txt and not getattr(neighbor, 'media', None):
+            return neighbor_txt
+    return ""
+
 # --- Основная функция get_trending_posts ---
+def _trending_cache_key(api_key: Optional[str], channel_id: str, days_back: int, posts_per_channel: int, min_views, min_reactions, min_comments, min_forwards) -> str:
+    """Ключ кэша trending: пользователь + канал + окно фильтров (параметры, влияющие на результат канала)."""
+    channel_norm = redis_utils.normalize_tg_channel_id(channel_id)
+    channel_part = str(channel_norm) if channel_norm is not None else str(channel_id).lstrip('@').lower()
+    filters = ':'.join(str(v or 0) for v in (min_views, min_reactions, min_comments, min_forwards))
+    return f"tg_trending:{redis_utils.tenant_scope(api_key)}:{channel_part}:d{days_back}:p{posts_per_channel}:{filters}"
+
+def _launch_media_background_tasks(background_tasks_to_run: List[Dict]):
+    """Запускает фоновую обработку медиа (по одной задаче на file_id)."""
+    if background_tasks_to_run:
+         logger.info(f"Запуск {len(background_tasks_to_run)} фоновых задач на обработку медиа...")
+         launched_file_ids = set()
+         tasks_launched_count = 0
+         for task_data in background_tasks_to_run:
+              file_id = task_data.get("file_id")
+              # Проверяем, что передали account_id
+              if file_id and task_data.get("account_id") and file_id not in launched_file_ids:
+                   asyncio.create_task(process_single_media_background(**task_data))
+                   launched_file_ids.add(file_id)
+                   tasks_launched_count += 1
+              elif file_id and not task_data.get("account_id"):
+                   logger.warning(f"Пропуск фоновой задачи для file_id {file_id} - отсутствует account_id.")
+
+         logger.info(f"Успешно запущено {tasks_launched_count} уникальных фоновых задач.")
+    else:
+         logger.info("Фоновых задач на обработку медиа нет.")
+
 async def get_trending_posts(
     telegram_pool: TelegramClientPool,
     channel_ids: Sequence[Union[int, str]],
@@ -1258,16 +1601,26 @@ async def get_trending_posts(
     min_reactions: Optional[int] = None,
     min_comments: Optional[int] = None,
     min_forwards: Optional[int] = None,
-    api_key: Optional[str] = None # Ключ для поиска активных аккаунтов
+    api_key: Optional[str] = None, # Ключ для поиска активных аккаунтов
+    on_channel_result: Optional[Callable[[str, List[Dict]], Awaitable[None]]] = None,
+    total_limit: Optional[int] = None,
+    score_formula: Optional[str] = None
     ) -> List[Dict]:
     """
     Получает трендовые посты из каналов.
     Генерирует предварительные S3 URL и запускает фоновую обработку медиа.
     Поддерживает ротацию аккаунтов, если передан api_key и есть несколько активных.
+    on_channel_result(channel_id, posts) вызывается по готовности каждого канала (потоковый режим).
+    total_limit - сколько лучших постов вернуть всего (None - все найденные).
+    score_formula - формула итогового ранжирования (см. scoring.FORMULAS); кандидаты в каналах
+    отбираются базовой формулой, выбранная применяется ко всем кандидатам в конце.
     """
     logger = logging.getLogger(__name__)
     try:
-        all_posts = []
+        score_formula = scoring.normalize_formula(score_formula)
+        # Лучшие посты по trend_score отбираются по мере готовности каналов, без общей сортировки.
+        # Для другой формулы нужны все кандидаты: она пересчитывается по всему набору.
+        top_posts = TopK(total_limit if score_formula == scoring.DEFAULT_FORMULA else None, key=lambda p: p.get('trend_score') or 0)
         # Обрабатываем вложенные списки/кортежи и преобразуем все в строки для унификации
         flat_channel_ids_str = []
         def flatten(items):
@@ -1288,12 +1641,37 @@ async def get_trending_posts(
 
         background_tasks_to_run = [] # Общий список для данных фоновых задач
 
+        # --- Кэш по каналам: свежие записи отдаем сразу, устаревающие обновляем в фоне ---
+        flat_channel_ids_str = list(dict.fromkeys(flat_channel_ids_str)) # Дубликаты каналов не обрабатываем дважды
+        cache_keys = {
+            channel_id: _trending_cache_key(api_key, channel_id, days_back, posts_per_channel, min_views, min_reactions, min_comments, min_forwards)
+            for channel_id in flat_channel_ids_str
+        }
+        cached_entries = await redis_utils.get_tg_trending_cache(list(cache_keys.values()))
+        channels_to_fetch = []
+        stale_channels = []
+        for channel_id in flat_channel_ids_str:
+            entry = cached_entries.get(cache_keys[channel_id])
+            if entry is None:
+                channels_to_fetch.append(channel_id)
+                continue
+            top_posts.extend(entry.get('posts', []))
+            if entry.get('stale'):
+                stale_channels.append(channel_id)
+            if on_channel_result:
+                await on_channel_result(channel_id, entry.get('posts', []))
+        logger.info(f"Кэш trending: {len(flat_channel_ids_str) - len(channels_to_fetch)} каналов из кэша (устаревают: {len(stale_channels)}), к загрузке: {len(channels_to_fetch)}")
+
         active_accounts = []
-        # Пытаемся использовать ротацию, если передан api_key
-        if api_key:
+        ready_clients = {} # account_id -> готовый (подключенный и авторизованный) клиент
+        # Пытаемся использовать ротацию, если передан api_key (аккаунты нужны, только если есть что загружать)
+        if api_key and (channels_to_fetch or stale_channels):
             try:
                 from user_manager import get_active_accounts # Импорт внутри try
                 active_accounts = await get_active_accounts(api_key, "telegram")
+                # Аккаунты, припаркованные после FloodWait, в этом запросе не используем
+                if telegram_pool:
+                    active_accounts = await telegram_pool.exclude_parked_accounts(active_accounts)
                 # Логируем результат получения аккаунтов ДО проверки их количества
                 logger.info(f"Найдено {len(active_accounts)} активных Telegram аккаунтов для ключа {api_key}.")
 
@@ -1306,8 +1684,8 @@ async def get_trending_posts(
 
         # --- НАЧАЛО ОБРАБОТКИ 0, 1 или >1 аккаунтов ---
         if not active_accounts:
-            logger.warning("Не найдено активных аккаунтов для обработки каналов. Возвращаем пустой результат.")
-            # all_posts останется пустым
+            if channels_to_fetch or stale_channels:
+                logger.warning("Не найдено активных аккаунтов для обработки каналов. Возвращаем только данные из кэша.")
         elif len(active_accounts) == 1:
             logger.info("Найден 1 активный аккаунт. Обработка без ротации...")
             account_info = active_accounts[0]
@@ -1356,32 +1734,14 @@ async def get_trending_posts(
                          logger.error(f"[Single Acc] Ошибка при проверке/подключении клиента {account_id_single}: {e_check}.")
                      # --- Конец проверки ---
 
-                     # Если клиент готов, вызываем обработку
                      if is_ready_single:
-                         logger.info(f"[Single Acc] Вызов _process_channels_for_trending для {len(flat_channel_ids_str)} каналов...")
-                         # Вызываем напрямую, без task
-                         processed_posts = await _process_channels_for_trending(
-                             client_single,
-                             account_id_single,
-                             flat_channel_ids_str, # Все каналы идут одному аккаунту
-                             cutoff_date.replace(tzinfo=None),
-                             posts_per_channel,
-                             min_views, min_reactions, min_comments, min_forwards,
-                             background_tasks_to_run, # Передаем список для задач
-                             api_key
-                         )
-                         all_posts.extend(processed_posts)
-                         logger.info(f"[Single Acc] Обработка завершена. Найдено постов: {len(processed_posts)}")
+                         ready_clients[account_id_single] = client_single
         elif len(active_accounts) > 1: # Ротация для >1 аккаунта (старый блок if)
             # Проверяем, передан ли пул
             if not telegram_pool:
                 logger.error("Экземпляр telegram_pool не был передан в get_trending_posts, но найдено >1 активных аккаунтов. Ротация невозможна.")
             else:
-                num_accounts = len(active_accounts)
-                channels_per_account = (len(flat_channel_ids_str) + num_accounts - 1) // num_accounts # Округление вверх
-                tasks = []
-                start_index = 0
-                logger.info(f"Распределяем {len(flat_channel_ids_str)} каналов по {num_accounts} аккаунтам (примерно по {channels_per_account})")
+                logger.info(f"Распределяем каналы по {len(active_accounts)} аккаунтам через общую очередь")
 
                 for i, account_info in enumerate(active_accounts):
                      account_id_rot = None
@@ -1421,70 +1781,82 @@ async def get_trending_posts(
 
                      if not is_ready_rot: continue # Пропускаем, если клиент не готов
 
-                     # Определяем каналы для этого аккаунта
-                     end_index = min(start_index + channels_per_account, len(flat_channel_ids_str))
-                     channels_for_this_account = flat_channel_ids_str[start_index:end_index]
-                     start_index = end_index
-
-                     if not channels_for_this_account: continue # Пропускаем, если каналов не осталось
-
-                     logger.info(f"Аккаунт ID: {account_id_rot} будет обрабатывать {len(channels_for_this_account)} каналов: {channels_for_this_account[:3]}...")
-
-                     # Создаем задачу для аккаунта
-                     task = asyncio.create_task(
-                        _process_channels_for_trending(
-                            account_client,
-                            account_id_rot,
-                            channels_for_this_account,
-                            cutoff_date.replace(tzinfo=None),
-                            posts_per_channel,
-                            min_views, min_reactions, min_comments, min_forwards,
-                            background_tasks_to_run,
-                            api_key
-                        )
-                     )
-                     tasks.append(task)
-
-                # Ждем завершения всех задач обработки каналов
-                if tasks:
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-                    for i, result in enumerate(results):
-                        acc_id_log = f"index_{i}"
-                        if i < len(active_accounts):
-                             info = active_accounts[i]
-                             if isinstance(info, dict): acc_id_log = info.get('id', acc_id_log)
-
-                        if isinstance(result, Exception):
-                            logger.error(f"Ошибка при обработке каналов аккаунтом ID: {acc_id_log}: {result}", exc_info=result)
-                        elif isinstance(result, list):
-                            logger.info(f"Аккаунт ID: {acc_id_log} успешно обработал каналы, найдено постов: {len(result)}")
-                            all_posts.extend(result)
-                        else:
-                             logger.warning(f"Неожиданный результат от аккаунта ID: {acc_id_log}: {type(result)}")
+                     ready_clients[account_id_rot] = account_client
         # --- КОНЕЦ ОБРАБОТКИ 0, 1 или >1 аккаунтов ---
 
+        if ready_clients:
+            async def load_shared_result(cache_key, since):
+                # Результат загрузки другого процесса появляется в кэше trending
+                entry = (await redis_utils.get_tg_trending_cache([cache_key])).get(cache_key)
+                if entry and entry.get('fetched_at', 0) >= since:
+                    return entry.get('posts', [])
+                return None
+
+            def _make_channel_worker(account_client, account_id_rot, media_tasks):
+                async def fetch_channel(channel_id):
+                    scanned = set()
+                    posts = await _process_channels_for_trending(
+                        account_client,
+                        account_id_rot,
+                        [channel_id],
+                        cutoff_date.replace(tzinfo=None),
+                        posts_per_channel,
+                        min_views, min_reactions, min_comments, min_forwards,
+                        media_tasks, # Список фоновых задач на обработку медиа
+                        api_key,
+                        raise_account_errors=True,
+                        scanned_channels=scanned
+                    )
+                    # Ошибка канала не должна закэшироваться как пустой результат
+                    if channel_id in scanned:
+                        await redis_utils.set_tg_trending_cache(cache_keys[channel_id], posts or [])
+                    else:
+                        logger.warning(f"[Acc: {account_id_rot}] Канал {channel_id} не обработан, результат не кэшируется")
+                    return posts
+
+                async def process_channel(channel_id):
+                    # Одновременные запросы того же канала с теми же фильтрами от того же пользователя
+                    # ждут одну загрузку (ключ кэша включает tenant_scope)
+                    return await _trending_flights.do(cache_keys[channel_id], lambda: fetch_channel(channel_id), load_shared_result)
+                return process_channel
+
+            # Каждый готовый аккаунт берет следующий канал, как только закончил предыдущий.
+            # При FloodWait аккаунт паркуется, а канал достается другому аккаунту.
+            if channels_to_fetch:
+                workers = {acc_id: _make_channel_worker(acc_client, acc_id, background_tasks_to_run) for acc_id, acc_client in ready_clients.items()}
+                fetched_count = 0
+
+                async def collect_channel_result(channel_id, posts):
+                    nonlocal fetched_count
+                    fetched_count += len(posts or [])
+                    top_posts.extend(posts or [])
+                    if on_channel_result:
+                        await on_channel_result(channel_id, posts)
+
+                await ChannelWorkQueue(channels_to_fetch, telegram_pool=telegram_pool, on_result=collect_channel_result, keep_results=False).run(workers)
+                logger.info(f"Общая очередь каналов обработана {len(workers)} аккаунтами, найдено постов: {fetched_count}")
+
+            # Устаревающие записи кэша обновляем в фоне, ответ их не ждет
+            if stale_channels:
+                claimed = [channel_id for channel_id in stale_channels if await redis_utils.claim_tg_trending_refresh(cache_keys[channel_id])]
+                if claimed:
+                    async def refresh_stale_channels():
+                        refresh_media_tasks = []
+                        refresh_workers = {acc_id: _make_channel_worker(acc_client, acc_id, refresh_media_tasks) for acc_id, acc_client in ready_clients.items()}
+                        await ChannelWorkQueue(claimed, telegram_pool=telegram_pool).run(refresh_workers)
+                        _launch_media_background_tasks(refresh_media_tasks)
+                        logger.info(f"Фоновое обновление кэша trending завершено для {len(claimed)} каналов.")
+                    logger.info(f"Запускаем фоновое обновление кэша trending для {len(claimed)} каналов.")
+                    asyncio.create_task(refresh_stale_channels())
+        elif channels_to_fetch:
+            logger.warning(f"Нет готовых аккаунтов: {len(channels_to_fetch)} каналов без кэша не обработаны.")
+
         # Запускаем все собранные фоновые задачи на обработку медиа
-        if background_tasks_to_run:
-             logger.info(f"Запуск {len(background_tasks_to_run)} фоновых задач на обработку медиа...")
-             launched_file_ids = set()
-             tasks_launched_count = 0
-             for task_data in background_tasks_to_run:
-                  file_id = task_data.get("file_id")
-                  # Проверяем, что передали account_id
-                  if file_id and task_data.get("account_id") and file_id not in launched_file_ids:
-                       asyncio.create_task(process_single_media_background(**task_data))
-                       launched_file_ids.add(file_id)
-                       tasks_launched_count += 1
-                  elif file_id and not task_data.get("account_id"):
-                       logger.warning(f"Пропуск фоновой задачи для file_id {file_id} - отсутствует account_id.")
-                  # Убрали лишний else, который логировал пропуск без file_id
-
-             logger.info(f"Успешно запущено {tasks_launched_count} уникальных фоновых задач.")
-        else:
-             logger.info("Фоновых задач на обработку медиа нет.")
+        _launch_media_background_tasks(background_tasks_to_run)
 
-        # Сортируем финальный список постов
-        all_posts.sort(key=lambda x: x.get('trend_score', 0), reverse=True)
+        all_posts = top_posts.results()
+        if score_formula != scoring.DEFAULT_FORMULA:
+            all_posts = scoring.score_posts(all_posts, score_formula)[:total_limit]
         logger.info(f"Итоговый сбор постов завершен. Найдено {len(all_posts)} постов. Фоновая обработка медиа запущена.")
         return all_posts
 
@@ -1492,9 +1864,9 @@ async def get_trending_posts(
         logger.error(f"Критическая ошибка в get_trending_posts: {e}", exc_info=True)
         return [] # Возвращаем пустой список при серьезной ошибке
 
-async def _process_groups_for_posts(client, group_ids, max_posts, cutoff_date, min_views, api_key=None, non_blocking=False):
+async def _process_groups_for_posts(client, group_ids, max_posts, cutoff_date, min_views, api_key=None, non_blocking=False, account_id=None):
     """Вспомогательная функция для параллельной обработки групп."""
-    wrapper = TelegramClientWrapper(client, client.session.filename if client.session else 'unknown')
+    wrapper = TelegramClientWrapper(client, account_id or _account_id_for_client(client), api_key)
     group_posts = []
     
     for group_id in group_ids:
@@ -1524,7 +1896,7 @@ async def _process_groups_for_posts(client, group_ids, max_posts, cutoff_date, m
             channel_posts = []
             try:
                 limit = max_posts * 3
-                async for message in wrapper.client.iter_messages(channel_entity, limit=limit):
+                async for message in wrapper.iter_messages_paced(channel_entity, limit=limit):
                     if message.date.replace(tzinfo=None) < cutoff_date:
                         break
                     channel_posts.append(message)
@@ -1548,8 +1920,7 @@ async def _process_groups_for_posts(client, group_ids, max_posts, cutoff_date, m
                 reactions = len(post.reactions.results) if post.reactions else 0
                 comments = post.replies.replies if post.replies else 0
                 forwards = post.forwards or 0
-                raw_engagement_score = views + (reactions * 10) + (comments * 20) + (forwards * 50)
-                trend_score = int(raw_engagement_score / math.log10(subscribers_for_calc)) if raw_engagement_score > 0 else 0
+                trend_score = scoring.round_score(scoring.trend_score(views, reactions, comments, forwards, subscribers_for_calc))
                 url = url_template.format(id=post.id)
                 post_data = {
                     "id": post.id,
@@ -1627,7 +1998,7 @@ async def _process_media_async(client, message, post_data):
 async def get_posts_in_channels(client: TelegramClient, channel_ids: List[Union[int, str]], keywords: Optional[List[str]] = None, count: int = 10, min_views: int = 1000, days_back: int = 3) -> List[Dict]:
     """Получает посты из каналов по ключевым словам."""
     posts = []
-    wrapper = TelegramClientWrapper(client, client.session.filename if client.session else 'unknown')
+    wrapper = TelegramClientWrapper(client, _account_id_for_client(client))
     
     for channel_id in channel_ids:
         try:
@@ -1644,7 +2015,7 @@ async def get_posts_in_channels(client: TelegramClient, channel_ids: List[Union[
             cutoff_date = datetime.now().replace(tzinfo=None) - timedelta(days=days_back)
             channel_posts = []
             try:
-                async for message in wrapper.client.iter_messages(channel, limit=100):
+                async for message in wrapper.iter_messages_paced(channel, limit=100):
                     if not message or not hasattr(message, 'date') or not message.date:
                         continue
                     if message.date.replace(tzinfo=None) < cutoff_date:
@@ -1657,16 +2028,12 @@ async def get_posts_in_channels(client: TelegramClient, channel_ids: List[Union[
                 views = getattr(message, 'views', 0)
                 if views >= min_views:
                     if not keywords or any(keyword.lower() in (message.message or '').lower() for keyword in keywords):
-                        post_data = {
-                            "id": message.id,
-                            "channel_id": channel_id,
-                            "channel_title": getattr(channel, 'title', getattr(channel, 'first_name', 'Unknown')) if channel else 'Unknown',
-                            "text": message.message,
-                            "views": views,
-                            "date": message.date.isoformat() if hasattr(message, 'date') and message.date else None,
-                            "url": f"https://t.me/c/{abs(channel.id)}/{message.id}" if channel and hasattr(channel, 'id') else None,
-                            "media": []
-                        }
+                        post_data = post_from_telegram(
+                            message, channel_id,
+                            channel_title=getattr(channel, 'title', getattr(channel, 'first_name', 'Unknown')) if channel else 'Unknown',
+                            url=f"https://t.me/c/{abs(channel.id)}/{message.id}" if channel and hasattr(channel, 'id') else None,
+                            with_counters=False
+                        ).to_dict('telegram_simple')
                         # Обрабатываем медиа с быстрой генерацией ссылок
                         if message.media:
                             from media_utils import generate_media_links_with_album
@@ -1682,7 +2049,7 @@ async def get_posts_in_channels(client: TelegramClient, channel_ids: List[Union[
 async def get_posts_by_keywords(client: TelegramClient, group_keywords: List[str], post_keywords: List[str], count: int = 10, min_views: int = 1000, days_back: int = 3) -> List[Dict]:
     """Получает посты из каналов по ключевым словам."""
     posts = []
-    wrapper = TelegramClientWrapper(client, client.session.filename if client.session else 'unknown')
+    wrapper = TelegramClientWrapper(client, _account_id_for_client(client))
     
     for group_keyword in group_keywords:
         try:
@@ -1699,7 +2066,7 @@ async def get_posts_by_keywords(client: TelegramClient, group_keywords: List[str
             cutoff_date = datetime.now().replace(tzinfo=None) - timedelta(days=days_back)
             group_posts = []
             try:
-                async for message in wrapper.client.iter_messages(group_entity, limit=100):
+                async for message in wrapper.iter_messages_paced(group_entity, limit=100):
                     if not message or not hasattr(message, 'date') or not message.date:
                         continue
                     if message.date.replace(tzinfo=None) < cutoff_date:
@@ -1741,11 +2108,15 @@ async def get_posts_by_period(
     min_views: int = 0,
     api_key: Optional[str] = None,
     non_blocking: bool = False, # Этот параметр больше не используется напрямую здесь
-    is_degraded: bool = False # Глобальный флаг деградации не используется, получаем для каждого аккаунта
+    is_degraded: bool = False, # Глобальный флаг деградации не используется, получаем для каждого аккаунта
+    on_channel_result: Optional[Callable[[str, List[Dict]], Awaitable[None]]] = None,
+    total_limit: Optional[int] = None
     ) -> List[Dict]:
     """
     Асинхронно получает посты из указанных каналов за заданный период,
     распределяя каналы между доступными активными аккаунтами.
+    on_channel_result(group_id, posts) вызывается по готовности каждого канала (потоковый режим).
+    total_limit - сколько самых новых постов вернуть всего (None - все найденные).
     """
     logger = logging.getLogger(__name__)
     logger.info(f"Запрос постов за период {days_back} дней из {len(group_ids)} каналов. Лимит на канал: {limit_per_channel}. API Key: {'Есть' if api_key else 'Нет'}")
@@ -1771,10 +2142,30 @@ async def get_posts_by_period(
     cutoff_date_naive = cutoff_date.replace(tzinfo=None) # Для передачи в задачу
     logger.info(f"Вычислена дата отсечки: {cutoff_date.isoformat()} (naive: {cutoff_date_naive.isoformat()})")
 
-    tasks = []
-    groups_distributed = 0
+    workers = {}
 
-    # --- Распределение ID групп и запуск задач --- 
+    def _make_group_worker(client_task, account_id_task, is_degraded_task):
+        async def fetch_group(group_id):
+            return await _process_groups_for_period_task(
+                client=client_task,
+                account_id=account_id_task,
+                api_key=api_key,
+                group_ids_for_account=[group_id],
+                limit_per_channel=limit_per_channel,
+                cutoff_date=cutoff_date_naive, # Передаем naive дату
+                min_views=min_views,
+                is_degraded=is_degraded_task, # Передаем статус деградации из пула
+                raise_account_errors=True
+            )
+
+        async def process_group(group_id):
+            # Одновременные запросы той же группы с тем же окном ждут одну загрузку
+            # Ключ включает пользователя: результат, собранный его аккаунтами, не достается другим
+            flight_key = f"tg_period:{redis_utils.tenant_scope(api_key)}:{str(group_id).lstrip('@').lower()}:d{days_back}:l{limit_per_channel}:v{min_views or 0}"
+            return await _period_flights.do(flight_key, lambda: fetch_group(group_id))
+        return process_group
+
+    # --- Проверка аккаунтов; группы разбираются из общей очереди --- 
     for i, account_info in enumerate(active_accounts):
         account_id_task = account_info.get('id')
         if not account_id_task: logger.warning(f"Найден аккаунт без ID в списке активных (индекс {i}). Пропуск."); continue
@@ -1805,58 +2196,22 @@ async def get_posts_by_period(
         
         if not is_ready: continue # Пропускаем, если клиент не готов
 
-        # Распределяем ID групп (round-robin)
-        groups_for_account = group_ids[i::num_accounts] # Берем каждый N-ый ID, начиная с i
-        
-        if not groups_for_account:
-             logger.info(f"Для аккаунта {account_id_task} не осталось групп для обработки.")
-             continue
-        
-        groups_distributed += len(groups_for_account)
-        logger.info(f"Аккаунт {account_id_task} будет обрабатывать {len(groups_for_account)} групп: {groups_for_account[:3]}..." )
-        
-        # Создаем задачу, передавая нужные группы и параметры
-        tasks.append(asyncio.create_task(
-            _process_groups_for_period_task(
-                client=client_task, 
-                account_id=account_id_task, 
-                api_key=api_key,
-                group_ids_for_account=groups_for_account, 
-                limit_per_channel=limit_per_channel,
-                cutoff_date=cutoff_date_naive, # Передаем naive дату
-                min_views=min_views,
-                is_degraded=is_degraded_task # Передаем статус деградации из пула
-            )
-        ))
-
-    logger.info(f"Всего распределено групп: {groups_distributed}. Запускаем {len(tasks)} задач обработки...")
-
-    # Собираем результаты
-    final_posts = []
-    if tasks:
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for i, result in enumerate(results):
-            # Получаем ID для лога, даже если результат - ошибка
-            acc_id_log = "unknown_id"
-            # Проверяем границы перед доступом к active_accounts[i]
-            if i < len(active_accounts):
-                account_info = active_accounts[i]
-                if isinstance(account_info, dict):
-                    acc_id_log = account_info.get('id', f"index_{i}")
-            else:
-                acc_id_log = f"task_index_{i}" # Если индекс выходит за пределы
+        workers[account_id_task] = _make_group_worker(client_task, account_id_task, is_degraded_task)
 
-            if isinstance(result, Exception):
-                logger.error(f"Ошибка при обработке групп аккаунтом {acc_id_log}: {result}", exc_info=result)
-            elif isinstance(result, list):
-                logger.info(f"Аккаунт {acc_id_log} успешно обработал группы, найдено постов: {len(result)}")
-                final_posts.extend(result)
-            else:
-                logger.warning(f"Неожиданный результат обработки групп от аккаунта {acc_id_log}: {type(result)}")
+    logger.info(f"Запускаем общую очередь из {len(group_ids)} групп на {len(workers)} аккаунтах...")
+
+    # Собираем результаты: каждый аккаунт берет следующую группу, как только закончил предыдущую.
+    # Самые новые посты отбираются по мере готовности групп, без общей сортировки.
+    top_posts = TopK(total_limit, key=lambda p: p.get('date') or datetime.min.isoformat())
 
-    # --- Финальная сортировка всех постов по дате --- 
-    final_posts.sort(key=lambda p: p.get('date', datetime.min.isoformat()), reverse=True)
-    # ----------------------------------------------
+    async def collect_group_result(group_id, posts):
+        top_posts.extend(posts or [])
+        if on_channel_result:
+            await on_channel_result(group_id, posts)
+
+    if workers:
+        await ChannelWorkQueue(list(group_ids), telegram_pool=telegram_pool, on_result=collect_group_result, keep_results=False).run(workers)
+    final_posts = top_posts.results()
 
     logger.info(f"Завершено получение постов за период. Всего найдено: {len(final_posts)}")
     return final_posts
@@ -1870,7 +2225,8 @@ async def _process_groups_for_period_task(
     limit_per_channel: int,
     cutoff_date: datetime,
     min_views: int,
-    is_degraded: bool
+    is_degraded: bool,
+    raise_account_errors: bool = False # Пробрасывать FloodWait и ошибки аккаунта наружу (для ChannelWorkQueue)
 ) -> List[Dict]:
     """Обрабатывает список ID групп, назначенных одному аккаунту."""
     logger = logging.getLogger(__name__)
@@ -1901,45 +2257,49 @@ async def _process_groups_for_period_task(
             
             if entity_id_to_find is None: logger.warning(f"[Task Acc: {account_id}] [Chan: {group_id}] Не удалось определить entity_id_to_find. Пропуск группы."); continue
 
-            channel_entity = await wrapper.make_high_level_request(wrapper.client.get_entity, entity_id_to_find)
+            # Метаданные канала: сначала Redis-кэш, затем get_entity
+            channel_entity, channel_meta = await resolve_channel_cached(wrapper, entity_id_to_find)
             if not channel_entity: logger.warning(f"[Task Acc: {account_id}] [Chan: {group_id}] get_entity вернул None. Пропуск группы."); continue
-            channel_title = getattr(channel_entity, 'title', 'Unknown Title')
-            logger.info(f"[Task Acc: {account_id}] [Chan: {group_id}] Успешно получена entity: '{channel_title}' (ID: {channel_entity.id})")
+            channel_title = channel_meta.get('title') or 'Unknown Title'
+            channel_username = channel_meta.get('username')
+            channel_id_str = str(channel_meta['id']).replace('-100', '')
+            logger.info(f"[Task Acc: {account_id}] [Chan: {group_id}] Успешно получена entity: '{channel_title}' (ID: {channel_id_str})")
+            # Число подписчиков для расчета trend_score
+            subscribers = channel_meta.get('participants_count')
+            if subscribers is None:
+                subscribers = 10
+            else:
+                try:
+                    subscribers = int(subscribers)
+                except Exception:
+                    subscribers = 10
+            subscribers_for_calc = max(subscribers, 10)
             # -------------------------------------------------------
 
             # --- Обновление статистики перед iter_messages --- 
-            if api_key: # Обновляем статистику один раз на группу
-                try:
-                    from redis_utils import update_account_usage_redis; await update_account_usage_redis(api_key, account_id, "telegram")
-                    logger.info(f"[Task Acc: {account_id}] [Chan: {group_id}] Статистика обновлена (Redis) перед iter_messages.")
-                except ImportError: 
-                    from user_manager import update_account_usage; await update_account_usage(api_key, account_id, "telegram")
-                    logger.info(f"[Task Acc: {account_id}] [Chan: {group_id}] Статистика обновлена (user_manager) перед iter_messages.")
-                except Exception as stats_err: logger.error(f"[Task Acc: {account_id}] [Chan: {group_id}] Ошибка обновления статистики: {stats_err}")
+            if api_key: # Учитываем статистику один раз на группу (сброс в Redis - пакетный)
+                redis_utils.usage_accumulator.record(account_id, "telegram")
+                logger.debug(f"[Task Acc: {account_id}] [Chan: {group_id}] Статистика учтена перед iter_messages.")
             # -------------------------------------------------
             
             message_count_in_loop = 0
             # Используем channel_entity вместо group_id в iter_messages для большей надежности
-            async for message in client.iter_messages(channel_entity, limit=limit_per_channel): 
+            # Альбомы собираются из потока iter_messages без дополнительных запросов
+            async for streamed in _iter_posts_with_albums(wrapper.iter_messages_paced(channel_entity, limit=limit_per_channel)):
                 message_count_in_loop += 1
-                # Пропускаем None и сообщения без даты
-                if not message or not message.date: continue # Добавим проверку на None
-                # Пропускаем системные сообщения (action != None)
-                if getattr(message, 'action', None) is not None:
-                    continue
+                message = streamed.main
                 msg_date_naive = message.date.replace(tzinfo=None)
                 if msg_date_naive <= cutoff_date: # Сравниваем с cutoff_date без tzinfo
                     logger.debug(f"[Task Acc: {account_id}] [Chan: {group_id}] Сообщение {message.id} ({msg_date_naive}) слишком старое ({cutoff_date}). Прерываем.")
                     break # Прерываем, так как сообщения идут от новых к старым
                 
-                is_album = message.grouped_id is not None
+                is_album = streamed.grouped_id is not None
                 if is_album:
                     if message.grouped_id in processed_grouped_ids:
                         continue
                     processed_grouped_ids.add(message.grouped_id)
                     try:
-                        album_messages = await get_album_messages(wrapper, channel_entity, message)
-                        album_messages.sort(key=lambda m: m.id)
+                        album_messages = await _complete_streamed_album(wrapper, channel_entity, streamed)
                         main_album_msg = album_messages[0]
                         # Собираем текст из всех сообщений альбома
                         album_texts = []
@@ -1953,54 +2313,16 @@ async def _process_groups_for_period_task(
                         post_text = "\n".join(album_texts).strip()
                         # Fallback на соседние сообщения, если текст пуст
                         if not post_text:
-                           for neighbor_id_album in (main_album_msg.id - 1, album_messages[-1].id + 1):
-                               try:
-                                   neighbor_album = await wrapper.make_high_level_request(wrapper.client.get_messages, channel_entity, ids=neighbor_id_album)
-                                   neighbor_text_album = getattr(neighbor_album, 'message', None) or getattr(neighbor_album, 'text', None) or getattr(neighbor_album, 'caption', None)
-                                   if neighbor_album and neighbor_text_album and not getattr(neighbor_album, 'media', None):
-                                       post_text = neighbor_text_album
-                                       break
-                               except Exception:
-                                   pass # Ignore errors fetching neighbors
-
-                        channel_id_str = str(channel_entity.id).replace('-100', '')
-                        subscribers = getattr(channel_entity, 'participants_count', None)
-                        if subscribers is None:
-                            subscribers = 10
-                        else:
-                            try:
-                                subscribers = int(subscribers)
-                            except Exception:
-                                subscribers = 10
-                        subscribers_for_calc = max(subscribers, 10)
+                            post_text = await _album_neighbor_text(wrapper, channel_entity, streamed, album_messages)
+
                         # Используем просмотры, реакции и т.д. из основного сообщения альбома (main_album_msg)
-                        views_album = getattr(main_album_msg, 'views', 0)
-                        reactions_album = sum(r.count for r in main_album_msg.reactions.results) if main_album_msg.reactions and main_album_msg.reactions.results else 0
-                        comments_album = main_album_msg.replies.replies if main_album_msg.replies else 0
-                        forwards_album = getattr(main_album_msg, 'forwards', 0)
-
-                        raw_engagement_score = (views_album or 0) + (reactions_album * 10) + (comments_album * 20) + (forwards_album * 50)
-                        if subscribers_for_calc > 1 and raw_engagement_score > 0:
-                            import math
-                            trend_score = int(raw_engagement_score / math.log10(subscribers_for_calc))
-                        else:
-                            trend_score = 0
-                        post_data = {
-                            "id": main_album_msg.id,
-                            "channel_id": channel_id_str,
-                            "channel_title": channel_title,
-                            "channel_username": getattr(channel_entity, 'username', None),
-                            "text": post_text,
-                            "views": views_album,
-                            "reactions": reactions_album,
-                            "comments": comments_album,
-                            "forwards": forwards_album,
-                            "date": main_album_msg.date.isoformat(),
-                            "url": f"https://t.me/{getattr(channel_entity, 'username', f'c/{channel_id_str}')}/{main_album_msg.id}",
-                            "media": [], # Медиа здесь не обрабатываем
-                            "trend_score": trend_score
-                        }
-                        channel_posts.append(post_data)
+                        counters = telegram_counters(main_album_msg)
+                        post_data = post_from_telegram(
+                            main_album_msg, channel_id_str, channel_title, channel_username,
+                            text=post_text, counters=counters, # Медиа здесь не обрабатываем
+                            trend_score=scoring.round_score(scoring.trend_score(*counters, subscribers_for_calc))
+                        )
+                        channel_posts.append(post_data.to_dict('telegram_period'))
                     except Exception as album_err:
                         logger.error(f"[Task Acc: {account_id}] [Chan: {group_id}] Ошибка обработки альбома {message.grouped_id}: {album_err}")
                     continue # Пропускаем дальнейшую обработку отдельных сообщений альбома
@@ -2008,50 +2330,24 @@ async def _process_groups_for_period_task(
                     # Извлекаем текст (.message, .text, .caption)
                     post_text = getattr(message, 'message', None) or getattr(message, 'text', None) or getattr(message, 'caption', None) or ""
 
-                    channel_id_str = str(channel_entity.id).replace('-100', '')
-                    # Получаем число подписчиков для расчета trend_score
-                    subscribers = getattr(channel_entity, 'participants_count', None)
-                    if subscribers is None:
-                        subscribers = 10
-                    else:
-                        try:
-                            subscribers = int(subscribers)
-                        except Exception:
-                            subscribers = 10
-                    subscribers_for_calc = max(subscribers, 10)
                     # Считаем trend_score по формуле из trending
-                    views_msg = getattr(message, 'views', 0) or 0
-                    reactions_msg = sum(r.count for r in message.reactions.results) if message.reactions and message.reactions.results else 0
-                    comments_msg = message.replies.replies if message.replies and message.replies.replies is not None else 0
-                    forwards_msg = getattr(message, 'forwards', 0) or 0
-
-                    raw_engagement_score = (views_msg or 0) + (reactions_msg * 10) + (comments_msg * 20) + (forwards_msg * 50)
-                    if subscribers_for_calc > 1 and raw_engagement_score > 0:
-                        import math
-                        trend_score = int(raw_engagement_score / math.log10(subscribers_for_calc))
-                    else:
-                        trend_score = 0
-                    post_data = {
-                        "id": message.id,
-                        "channel_id": channel_id_str,
-                        "channel_title": channel_title,
-                        "channel_username": getattr(channel_entity, 'username', None),
-                        "text": post_text,
-                        "views": views_msg,
-                        "reactions": reactions_msg,
-                        "comments": comments_msg,
-                        "forwards": forwards_msg,
-                        "date": message.date.isoformat(),
-                        "url": f"https://t.me/{getattr(channel_entity, 'username', f'c/{channel_id_str}')}/{message.id}",
-                        "media": [], # Медиа здесь не обрабатываем
-                        "trend_score": trend_score
-                    }
-                    channel_posts.append(post_data)
+                    counters = telegram_counters(message)
+                    post_data = post_from_telegram(
+                        message, channel_id_str, channel_title, channel_username,
+                        text=post_text, counters=counters, # Медиа здесь не обрабатываем
+                        trend_score=scoring.round_score(scoring.trend_score(*counters, subscribers_for_calc))
+                    )
+                    channel_posts.append(post_data.to_dict('telegram_period'))
                 # --- Конец логики обработки message ---
                 
             logger.info(f"[Task Acc: {account_id}] [Chan: {group_id}] Завершен цикл iter_messages. Найдено: {len(channel_posts)}")
 
-        except FloodWaitError as e: logger.error(f"[Task Acc: {account_id}] [Chan: {group_id}] FloodWaitError: {e.seconds} сек. Пропуск группы."); channel_posts = []
+        except FloodWaitError as e:
+            if raise_account_errors: raise
+            logger.error(f"[Task Acc: {account_id}] [Chan: {group_id}] FloodWaitError: {e.seconds} сек. Пропуск группы."); channel_posts = []
+        except (AuthKeyError, UserDeactivatedBanError) as e_account:
+            if raise_account_errors: raise
+            logger.error(f"[Task Acc: {account_id}] [Chan: {group_id}] Ошибка аккаунта: {e_account}. Пропуск группы."); channel_posts = []
         except (ChannelInvalidError, ChannelPrivateError, ChatForbiddenError, UsernameNotOccupiedError, UsernameInvalidError) as e_perm: logger.warning(f"[Task Acc: {account_id}] [Chan: {group_id}] Ошибка доступа/не найдено: {e_perm}. Пропуск группы."); channel_posts = []
         except Exception as e:
             logger.error(f"[Task Acc: {account_id}] [Chan: {group_id}] Непредвиденная Ошибка: {e.__class__.__name__}: {e}", exc_info=True)
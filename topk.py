@@ -0,0 +1,60 @@
+"""Потоковый отбор K лучших элементов (постов по trend_score или дате).
+
+Вместо "собрать все посты -> отсортировать -> обрезать" элементы добавляются в
+min-heap размера K по мере поступления; не входящие в top-K отбрасываются сразу,
+поэтому в памяти одновременно находится не больше K элементов.
+"""
+import heapq
+from itertools import count
+from typing import Any, Callable, Iterable, List, Optional
+
+
+class TopK:
+    """K лучших элементов по ключу (по убыванию). limit=None - без ограничения.
+
+    При равных ключах сохраняется порядок поступления, как у sorted(..., reverse=True).
+    """
+    __slots__ = ('limit', 'key', '_heap', '_counter')
+
+    def __init__(self, limit: Optional[int], key: Callable[[Any], Any]):
+        self.limit = limit
+        self.key = key
+        self._heap: List[tuple] = []
+        self._counter = count()
+
+    def push(self, item) -> bool:
+        """Добавляет элемент. Возвращает False, если он не попал в top-K."""
+        return self.push_keyed(self.key(item), item)
+
+    def push_keyed(self, key_value, item) -> bool:
+        """Добавляет элемент с уже посчитанным ключом."""
+        if self.limit is not None and self.limit <= 0:
+            return False
+        # Более поздний элемент с тем же ключом "меньше" и вытесняется первым
+        entry = (key_value, -next(self._counter), item)
+        if self.limit is None or len(self._heap) < self.limit:
+            heapq.heappush(self._heap, entry)
+            return True
+        if entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+            return True
+        return False
+
+    def accepts(self, key_value) -> bool:
+        """Попадет ли элемент с таким ключом в top-K (чтобы не строить заведомо лишние элементы)."""
+        if self.limit is None:
+            return True
+        if self.limit <= 0:
+            return False
+        return len(self._heap) < self.limit or key_value > self._heap[0][0]
+
+    def extend(self, items: Iterable[Any]):
+        for item in items:
+            self.push(item)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def results(self) -> List[Any]:
+        """Элементы от лучшего к худшему."""
+        return [entry[2] for entry in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
@@ -160,6 +160,10 @@ async def init_db(conn: asyncpg.Connection):
         last_used TIMESTAMPTZ
     )''')
     logger.info("Таблица 'vk_accounts' проверена/создана.")
+
+    # Каталог каналов для локального поиска /find-groups
+    from channel_directory import init_channel_directory
+    await init_channel_directory(conn)
     # --- Конец создания таблиц ---
 
     # --- Добавление столбцов (с использованием PostgreSQL) ---
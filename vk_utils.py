@@ -6,11 +6,17 @@ from vk_api.exceptions import ApiError
 from dotenv import load_dotenv
 import os
 import aiohttp
-from typing import List, Dict, Optional, Union, Any, Tuple
+from collections import OrderedDict
+from typing import List, Dict, Optional, Union, Any, Tuple, AsyncIterator
 from datetime import datetime, timedelta, timezone
 from user_manager import get_active_accounts, update_account_usage
+from channel_directory import directory_writer
+from post_model import post_from_vk, vk_counters, vk_trend_score
+from topk import TopK
+from redis_utils import get_redis
+from client_pools import VKTransport, vk_transport
+import scoring
 import math
-import redis
 import json
 import re
 import random
@@ -18,37 +24,310 @@ import random
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-# Константы для ротации аккаунтов
-REQUEST_SEMAPHORE = asyncio.Semaphore(2)  # Максимум 2 одновременных запроса
-REQUEST_DELAY = 0.1  # 100мс между запросами (10 запросов в секунду)
-GROUP_DELAY = 1.0  # 1 секунда между запросами к разным группам
-DEGRADED_MODE_DELAY = 0.5  # Задержка в режиме пониженной производительности (500мс)
+# Темп запросов: отдельно для каждого токена (лимит VK - 3 запроса в секунду на пользовательский токен)
+VK_TOKEN_RPS = float(os.getenv('VK_TOKEN_RPS', '3'))
+VK_TOKEN_MIN_RPS = 0.5 # Нижняя граница темпа токена после ошибок 6
+VK_TOKEN_RPS_RECOVERY = 0.1 # На сколько восстанавливается темп токена после каждого успешного запроса
+VK_MAX_RETRIES = int(os.getenv('VK_MAX_RETRIES', '3')) # Повторов запроса после ошибки 6
+VK_METHOD_LIMIT_COOLDOWN = int(os.getenv('VK_METHOD_LIMIT_COOLDOWN', '3600')) # На сколько отключать метод для токена после ошибки 29
+# Методы с более жесткими лимитами VK: минимальный интервал между вызовами одним токеном (сек)
+VK_METHOD_MIN_INTERVAL = {
+    'newsfeed.search': 1.0,
+    'wall.search': 1.0,
+    'groups.search': 1.0,
+}
+DEGRADED_MODE_DELAY = 0.5  # Минимальный интервал между запросами токена в режиме пониженной производительности (500мс)
 
 # TTL для кэша количества участников (1 час)
 GROUP_MEMBERS_CACHE_TTL = 3600
 
-# Инициализация Redis
-try:
-    REDIS_URL = os.getenv("REDIS_URL")
-    if REDIS_URL:
-        logger.info(f"Подключение к Redis по URL: {REDIS_URL.split('@')[0]}@...")
-        redis_client = redis.from_url(REDIS_URL)
-        # Проверка соединения
-        if redis_client:
-            redis_client.ping()
-            logger.info("Успешное подключение к Redis")
+# execute: до 25 обращений к API за один запрос (лимит VK), считается как один запрос к токену
+VK_EXECUTE_MAX_CALLS = 25
+VK_EXECUTE_BATCH_SIZE = max(1, min(int(os.getenv('VK_EXECUTE_BATCH_SIZE', str(VK_EXECUTE_MAX_CALLS))), VK_EXECUTE_MAX_CALLS))
+
+GROUP_MEMBERS_CACHE_MAXSIZE = int(os.getenv('VK_GROUP_MEMBERS_CACHE_MAXSIZE', '50000')) # Записей в памяти процесса
+VK_GROUPS_BY_ID_MAX = 500 # Максимум id в одном groups.getById
+DEFAULT_GROUP_MEMBERS = 10000 # Если число участников получить не удалось
+
+VK_WALL_PAGE_MAX = 100 # Максимум постов в одном wall.get
+VK_WALL_PAGE_MIN = 10 # Минимальный размер следующей страницы при адаптивном подборе
+VK_WALL_PAGE_RESERVE = 1.2 # Запас к оценке числа постов, оставшихся до начала периода
+VK_NEWSFEED_SEARCH_PAGE_MAX = 200 # Максимум постов в одном newsfeed.search
+
+# Поиск постов на стороне VK (wall.search / newsfeed.search) вместо загрузки стен целиком
+VK_SEARCH_MODES = ('auto', 'search', 'wall')
+VK_SEARCH_MAX_KEYWORDS = int(os.getenv('VK_SEARCH_MAX_KEYWORDS', '5')) # Каждое слово - отдельный поисковый вызов на группу
+VK_SEARCH_MIN_KEYWORD_LEN = 3 # Более короткие слова совпадают почти с любым постом
+
+
+class TTLLRUCache:
+    """Ограниченный по размеру LRU-кэш в памяти с TTL записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+
+    def get(self, key) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False) # Вытесняем давно не использованные
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class VKRateLimiter:
+    """Темп запросов к VK API отдельно для каждого токена.
+
+    Каждому запросу выделяется слот с интервалом 1/rps в расписании его токена, так что
+    общая пропускная способность растет вместе с числом активных токенов. Ошибка 6
+    (слишком много запросов в секунду) вдвое снижает темп токена, успешные ответы
+    постепенно возвращают его; ошибка 29 (лимит метода) отключает метод для токена
+    на VK_METHOD_LIMIT_COOLDOWN секунд.
+    """
+
+    def __init__(self, rps: float = VK_TOKEN_RPS):
+        self.rps = rps
+        self._tokens: Dict[str, Dict[str, Any]] = {}
+
+    def _state(self, token: str) -> Dict[str, Any]:
+        state = self._tokens.get(token)
+        if state is None:
+            state = self._tokens[token] = {"rps": self.rps, "next_slot": 0.0, "method_slots": {}, "blocked": {}}
+        return state
+
+    async def acquire(self, token: str, method: str, min_interval: float = 0.0) -> bool:
+        """Ждет слот для запроса. False - метод для токена отключен после ошибки 29."""
+        state = self._state(token)
+        now = time.monotonic()
+        blocked_until = state["blocked"].get(method)
+        if blocked_until:
+            if blocked_until > now:
+                return False
+            del state["blocked"][method]
+        # Слот резервируется до await, поэтому одновременные запросы одного токена встают в очередь
+        slot = max(now, state["next_slot"])
+        state["next_slot"] = slot + max(1.0 / state["rps"], min_interval)
+        method_interval = VK_METHOD_MIN_INTERVAL.get(method)
+        if method_interval:
+            slot = max(slot, state["method_slots"].get(method, 0.0))
+            state["method_slots"][method] = slot + method_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        return True
+
+    def on_success(self, token: str):
+        state = self._state(token)
+        if state["rps"] < self.rps:
+            state["rps"] = min(self.rps, state["rps"] + VK_TOKEN_RPS_RECOVERY)
+
+    def on_too_many_requests(self, token: str):
+        """Ошибка 6: снижаем темп токена и делаем паузу перед следующим слотом."""
+        state = self._state(token)
+        state["rps"] = max(VK_TOKEN_MIN_RPS, state["rps"] / 2)
+        state["next_slot"] = max(state["next_slot"], time.monotonic() + 1.0 / state["rps"])
+
+    def on_method_limit(self, token: str, method: str):
+        """Ошибка 29: метод исчерпал лимит для токена, повторять бессмысленно до истечения паузы."""
+        self._state(token)["blocked"][method] = time.monotonic() + VK_METHOD_LIMIT_COOLDOWN
+
+    def is_blocked(self, token: str, method: str) -> bool:
+        """Отключен ли метод для токена после ошибки 29 (вызовы внутри execute)."""
+        blocked_until = self._tokens.get(token, {}).get("blocked", {}).get(method)
+        return bool(blocked_until and blocked_until > time.monotonic())
+
+
+vk_rate_limiter = VKRateLimiter()
+
+
+# Общий кэш количества участников групп: память (LRU с TTL), вторым уровнем - Redis
+GROUP_MEMBERS_CACHE = TTLLRUCache(GROUP_MEMBERS_CACHE_MAXSIZE, GROUP_MEMBERS_CACHE_TTL)
+
+def _extract_members_count(group_data: Dict) -> Optional[int]:
+    """Число участников из объекта группы (поле может называться по-разному)."""
+    for field in ("members_count", "member_count", "count"):
+        if group_data.get(field) is not None:
+            return group_data[field]
+    return None
+
+async def _cached_group_members_many(group_ids: List[int]) -> Dict[int, int]:
+    """Числа участников из общего кэша: память, недостающие - одним MGET из Redis."""
+    counts = {}
+    missing = []
+    for group_id in group_ids:
+        members_count = GROUP_MEMBERS_CACHE.get(group_id)
+        if members_count is None:
+            missing.append(group_id)
         else:
-            logger.warning("Не удалось создать клиент Redis")
-            redis_client = None
+            counts[group_id] = members_count
+    if not missing:
+        return counts
+    redis_client = await get_redis()
+    if not redis_client:
+        return counts
+    try:
+        values = await redis_client.mget([f"vk:group:members:{group_id}" for group_id in missing])
+    except Exception as e:
+        logger.error(f"Ошибка при чтении из Redis ({len(missing)} групп): {e}")
+        return counts
+    for group_id, value in zip(missing, values):
+        if value:
+            counts[group_id] = int(value)
+            GROUP_MEMBERS_CACHE.set(group_id, counts[group_id])
+    return counts
+
+async def _cache_group_members(counts: Dict[int, int]):
+    """Сохраняет числа участников в общий кэш (память и Redis одним pipeline)."""
+    if not counts:
+        return
+    for group_id, members_count in counts.items():
+        GROUP_MEMBERS_CACHE.set(group_id, members_count)
+    redis_client = await get_redis()
+    if not redis_client:
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for group_id, members_count in counts.items():
+                pipe.setex(f"vk:group:members:{group_id}", GROUP_MEMBERS_CACHE_TTL, members_count)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении в Redis: {e}")
+
+async def harvest_group_members(response: Optional[Dict]):
+    """Забирает числа участников из групп extended-ответа (wall.get и т.п. с fields=members_count)."""
+    if not isinstance(response, dict):
+        return
+    counts = {}
+    for group in response.get("groups") or []:
+        members_count = _extract_members_count(group)
+        if members_count is not None and group.get("id") is not None:
+            counts[abs(int(group["id"]))] = members_count
+    await _cache_group_members(counts)
+
+def next_wall_page(items: List[Dict], offset: int, count: int, start_time: int, max_posts: int) -> Optional[Tuple[int, int]]:
+    """Следующая страница стены после полученной: (offset, count) или None, если обход группы закончен.
+
+    Стена идет от новых постов к старым, кроме закрепленного поста (is_pinned) в начале,
+    который может быть сколь угодно старым. Поэтому обход останавливается, как только
+    самый старый незакрепленный пост страницы вышел за start_time. Размер следующей
+    страницы оценивается по плотности постов на текущей: сколько постов примерно
+    осталось до начала периода.
+    """
+    next_offset = offset + len(items)
+    if len(items) < count or next_offset >= max_posts:
+        return None # Стена закончилась или достигнут лимит постов группы
+    dates = [item["date"] for item in items if not item.get("is_pinned")]
+    if not dates:
+        return next_offset, min(VK_WALL_PAGE_MAX, max_posts - next_offset)
+    oldest = min(dates)
+    if oldest < start_time:
+        return None
+    next_count = VK_WALL_PAGE_MAX
+    span = max(dates) - oldest
+    if len(dates) > 1 and span > 0:
+        posts_per_second = (len(dates) - 1) / span
+        expected = math.ceil((oldest - start_time) * posts_per_second * VK_WALL_PAGE_RESERVE) + 1
+        next_count = max(VK_WALL_PAGE_MIN, min(VK_WALL_PAGE_MAX, expected))
+    return next_offset, min(next_count, max_posts - next_offset)
+
+async def iter_wall_pages(vk, owner_ids: List[int], start_time: int, max_posts: int,
+                          queries: Optional[List[str]] = None) -> AsyncIterator[List[Tuple[int, int, Dict]]]:
+    """Обход стен групп раундами до начала периода start_time (unix time).
+
+    Каждый раунд запрашивает следующую страницу всех незавершенных стен, упаковывая
+    до 25 вызовов wall.get в один execute, и выдает список (owner_id, offset, response).
+    С queries вместо wall.get используется wall.search: каждая стена обходится по каждому
+    запросу отдельно, и VK отдает только посты, найденные поиском.
+    Числа участников из extended-ответов сохраняются в общий кэш.
+    """
+    first_page = (0, min(VK_WALL_PAGE_MAX, max_posts))
+    if queries:
+        pages = {(owner_id, query): first_page for owner_id in owner_ids for query in queries if max_posts > 0}
     else:
-        logger.warning("REDIS_URL не задан, использую локальный кэш")
-        redis_client = None
-except Exception as e:
-    logger.error(f"Ошибка подключения к Redis: {e}")
-    redis_client = None
+        pages = {(owner_id, None): first_page for owner_id in owner_ids if max_posts > 0}
+    while pages:
+        active = list(pages.items())
+        calls = []
+        for (owner_id, query), (offset, count) in active:
+            params = {"owner_id": owner_id, "count": count, "offset": offset, "extended": 1, "fields": "members_count"}
+            if query:
+                calls.append(("wall.search", {**params, "query": query, "owners_only": 1}))
+            else:
+                calls.append(("wall.get", params))
+        responses = await vk.execute_many(calls)
+        pages = {}
+        for (page_key, (offset, count)), response in zip(active, responses):
+            await harvest_group_members((response or {}).get("response"))
+            items = ((response or {}).get("response") or {}).get("items")
+            if items is not None:
+                next_page = next_wall_page(items, offset, count, start_time, max_posts)
+                if next_page:
+                    pages[page_key] = next_page
+        yield [(owner_id, offset, response) for ((owner_id, _query), (offset, _count)), response in zip(active, responses)]
 
-# Глобальный кэш для количества участников групп (используется как fallback)
-GROUP_MEMBERS_CACHE = {}
+async def iter_newsfeed_search_pages(vk, queries: List[str], start_time: int, end_time: int,
+                                     max_posts: int) -> AsyncIterator[List[Tuple[str, int, Dict]]]:
+    """Поиск постов по всему VK через newsfeed.search за период [start_time, end_time].
+
+    Раунды устроены так же, как в iter_wall_pages: следующая страница каждого запроса
+    (по next_from) запрашивается через execute, выдается список (query, offset, response).
+    """
+    pages = {query: (None, 0) for query in queries if max_posts > 0} # query -> (next_from, получено постов)
+    while pages:
+        active = list(pages.items())
+        calls = []
+        for query, (start_from, fetched) in active:
+            params = {"q": query, "count": min(VK_NEWSFEED_SEARCH_PAGE_MAX, max_posts - fetched), "start_time": start_time,
+                      "end_time": end_time, "extended": 1, "fields": "members_count"}
+            if start_from:
+                params["start_from"] = start_from
+            calls.append(("newsfeed.search", params))
+        responses = await vk.execute_many(calls)
+        pages = {}
+        for (query, (_start_from, fetched)), response in zip(active, responses):
+            data = (response or {}).get("response") or {}
+            await harvest_group_members(data)
+            items = data.get("items") or []
+            if items and data.get("next_from") and fetched + len(items) < max_posts:
+                pages[query] = (data["next_from"], fetched + len(items))
+        yield [(query, fetched, response) for (query, (_start_from, fetched)), response in zip(active, responses)]
+
+def use_search_mode(keywords: Optional[List[str]], search_mode: Optional[str] = 'wall') -> bool:
+    """Искать ли посты на стороне VK (wall.search / newsfeed.search) вместо загрузки стен целиком.
+
+    search_mode: 'search' - всегда, 'wall' (по умолчанию) - никогда, 'auto' - если набор ключевых слов
+    избирательный: не больше VK_SEARCH_MAX_KEYWORDS слов и каждое не короче
+    VK_SEARCH_MIN_KEYWORD_LEN символов.
+    """
+    if not keywords:
+        return False
+    search_mode = (search_mode or 'wall').lower()
+    if search_mode not in VK_SEARCH_MODES:
+        logger.warning(f"Неизвестный режим поиска VK '{search_mode}', используем wall")
+        search_mode = 'wall'
+    if search_mode != 'auto':
+        return search_mode == 'search'
+    return len(keywords) <= VK_SEARCH_MAX_KEYWORDS and all(len(str(kw).strip()) >= VK_SEARCH_MIN_KEYWORD_LEN for kw in keywords)
+
+def build_execute_code(calls: List[Tuple[str, Dict]]) -> str:
+    """VKScript для execute: возвращает массив результатов вызовов в порядке calls."""
+    return "return [" + ",".join(f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params in calls) + "];"
 
 def validate_proxy(proxy: Optional[str]) -> bool:
     """
@@ -222,81 +501,37 @@ def sanitize_proxy_for_logs(proxy: Optional[str]) -> str:
         return proxy
 
 class VKClient:
-    def __init__(self, access_token: str, proxy: Optional[str] = None, account_id: Optional[str] = None, api_key: Optional[str] = None):
+    def __init__(self, access_token: str, proxy: Optional[str] = None, account_id: Optional[str] = None, api_key: Optional[str] = None,
+                 transport: Optional[VKTransport] = None):
         self.access_token = access_token
         self.proxy = proxy
         self.account_id = account_id
         self.api_key = api_key
-        self.session = None
+        self.transport = transport or vk_transport # HTTP-сессии общие для всех клиентов аккаунта
         self.base_url = "https://api.vk.com/method"
         self.version = "5.199"
-        self.last_request_time = 0
-        self.last_group_request_time = 0
+        self.rate_limiter = vk_rate_limiter # Темп запросов общий для всех клиентов с этим токеном
         self.requests_count = 0
         self.degraded_mode = False
-        self.group_members_cache = {}  # Кэш для хранения количества участников групп
 
     def set_degraded_mode(self, degraded: bool):
         """Устанавливает режим пониженной производительности."""
         self.degraded_mode = degraded
 
     async def __aenter__(self):
-        try:
-            logger.info(f"Инициализация VK клиента с токеном длиной {len(self.access_token) if self.access_token else 0} символов")
-            if self.session is None:
-                self.session = aiohttp.ClientSession()
-                logger.info(f"Создана новая HTTP сессия для VK клиента")
-            return self
-        except Exception as e:
-            import traceback
-            tb = traceback.format_exc()
-            logger.error(f"Ошибка при инициализации VK клиента: {e}")
-            logger.error(f"Трассировка: {tb}")
-            # Создаем сессию даже в случае ошибки
-            if self.session is None:
-                self.session = aiohttp.ClientSession()
-            return self
+        logger.info(f"Инициализация VK клиента с токеном длиной {len(self.access_token) if self.access_token else 0} символов")
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        try:
-            if self.session:
-                logger.info(f"Закрытие HTTP сессии для VK клиента")
-                await self.session.close()
-                self.session = None
-        except Exception as e:
-            import traceback
-            tb = traceback.format_exc()
-            logger.error(f"Ошибка при закрытии HTTP сессии VK клиента: {e}")
-            logger.error(f"Трассировка: {tb}")
+        # Сессии принадлежат общему транспорту и переиспользуются следующими клиентами этого аккаунта
+        pass
 
     async def _make_request(self, method: str, params: Dict) -> Dict:
-        """Выполняет запрос к VK API с соблюдением задержек."""
-        current_time = time.time()
-        
+        """Выполняет запрос к VK API в темпе токена; после ошибки 6 повторяет не более VK_MAX_RETRIES раз."""
         # Проверяем, что токен не пустой
         if not self.access_token:
             logger.error("Токен VK пуст или равен None")
             return {}
-        
-        # Определяем задержки в зависимости от режима
-        request_delay = DEGRADED_MODE_DELAY if self.degraded_mode else REQUEST_DELAY
-        group_delay = GROUP_DELAY * 2 if self.degraded_mode else GROUP_DELAY
-        
-        # Проверяем задержку между запросами
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < request_delay:
-            await asyncio.sleep(request_delay - time_since_last_request)
-            self.last_request_time = time.time()
-        else:
-            self.last_request_time = current_time
-            
-        # Проверяем задержку между группами
-        time_since_last_group = current_time - self.last_group_request_time
-        if time_since_last_group < group_delay:
-            await asyncio.sleep(group_delay - time_since_last_group)
-            self.last_group_request_time = time.time()
-        else:
-            self.last_group_request_time = current_time
 
         # Формируем параметры запроса с токеном
         request_params = params.copy()  # Создаем копию, чтобы не изменять оригинальный словарь
@@ -304,72 +539,71 @@ class VKClient:
             "access_token": self.access_token,
             "v": self.version
         })
+        min_interval = DEGRADED_MODE_DELAY if self.degraded_mode else 0.0
 
-        # Гарантируем, что сессия создана
-        if self.session is None:
-            logger.info("Сессия не была инициализирована, создаём новую сессию")
-            self.session = aiohttp.ClientSession()
-
-        async with REQUEST_SEMAPHORE:
-            try:
-                # Логируем запрос (без токена для безопасности)
-                log_params = {k: v for k, v in request_params.items() if k != "access_token"}
-                
-                # Проверяем валидность прокси
-                proxy_valid = validate_proxy(self.proxy) if self.proxy else False
-                proxy_info = sanitize_proxy_for_logs(self.proxy) if self.proxy else "без прокси"
-                
-                if self.proxy:
-                    logger.info(f"Отправка запроса к VK API: {method} через прокси {proxy_info} c параметрами {log_params}")
-                else:
-                    logger.info(f"Отправка запроса к VK API: {method} без прокси c параметрами {log_params}")
-                
-                # Сначала пробуем с прокси, если он задан и валиден
-                if self.proxy and proxy_valid:
-                    try:
-                        # Нормализуем формат прокси для aiohttp
-                        proxy_url = self.proxy
-                        if '://' not in proxy_url:
-                            proxy_url = 'http://' + proxy_url
-                            
-                        # Для HTTP/HTTPS прокси можно использовать стандартный aiohttp
-                        if proxy_url.startswith(('http://', 'https://')):
-                            async with self.session.get(f"{self.base_url}/{method}", params=request_params, proxy=proxy_url) as response:
-                                return await self._process_response(response, method, params)
-                        else:
-                            # Для SOCKS прокси нужна библиотека aiohttp-socks
-                            # Проверяем, установлена ли она
-                            try:
-                                from aiohttp_socks import ProxyConnector
-                                
-                                # Используем ProxyConnector для SOCKS прокси
-                                connector = ProxyConnector.from_url(proxy_url)
-                                async with aiohttp.ClientSession(connector=connector) as proxy_session:
-                                    async with proxy_session.get(f"{self.base_url}/{method}", params=request_params) as response:
-                                        return await self._process_response(response, method, params)
-                            except ImportError:
-                                # Если библиотека не установлена, логируем предупреждение и продолжаем без прокси
-                                logger.warning(f"Библиотека aiohttp-socks не установлена, но требуется для SOCKS прокси. Продолжаем без прокси.")
-                                # Пробуем запрос без прокси
-                                async with self.session.get(f"{self.base_url}/{method}", params=request_params) as response:
-                                    return await self._process_response(response, method, params)
-                    except aiohttp.ClientProxyConnectionError as e:
-                        logger.error(f"Ошибка подключения через прокси {proxy_info}: {e}")
-                        logger.warning(f"Пробуем запрос без прокси после ошибки")
-                    except Exception as e:
-                        logger.error(f"Ошибка при запросе через прокси {proxy_info}: {e}")
-                        logger.warning(f"Пробуем запрос без прокси после ошибки")
-                
-                # Если прокси не задан, не валиден или произошла ошибка - пробуем без прокси
-                async with self.session.get(f"{self.base_url}/{method}", params=request_params) as response:
-                    return await self._process_response(response, method, params)
-                
-            except Exception as e:
-                import traceback
-                tb = traceback.format_exc()
-                logger.error(f"Ошибка при выполнении запроса к VK API: {e}")
-                logger.error(f"Трассировка: {tb}")
+        for attempt in range(VK_MAX_RETRIES + 1):
+            if not await self.rate_limiter.acquire(self.access_token, method, min_interval):
+                logger.warning(f"Метод {method} временно недоступен для аккаунта {self.account_id or '-'}: исчерпан лимит VK (ошибка 29)")
                 return {}
+            result, error_code = await self._send_request(method, request_params)
+            if error_code == 6:
+                self.rate_limiter.on_too_many_requests(self.access_token)
+                logger.warning(f"Слишком много запросов в секунду для аккаунта {self.account_id or '-'} ({method}), попытка {attempt + 1}/{VK_MAX_RETRIES + 1}")
+                continue
+            if error_code == 29:
+                self.rate_limiter.on_method_limit(self.access_token, method)
+                logger.warning(f"Превышен лимит запросов к VK API для метода {method}, метод отключен для аккаунта {self.account_id or '-'} на {VK_METHOD_LIMIT_COOLDOWN} сек")
+            elif result:
+                self.rate_limiter.on_success(self.access_token)
+            return result
+        logger.error(f"Запрос {method} не выполнен после {VK_MAX_RETRIES + 1} попыток из-за ограничения частоты запросов")
+        return {}
+
+    async def _send_request(self, method: str, request_params: Dict) -> Tuple[Dict, Optional[int]]:
+        """Один HTTP-запрос к VK API. Возвращает (результат или {}, код ошибки VK)."""
+        try:
+            # Логируем запрос (без токена для безопасности)
+            log_params = {k: v for k, v in request_params.items() if k != "access_token"}
+            
+            # Проверяем валидность прокси
+            proxy_valid = validate_proxy(self.proxy) if self.proxy else False
+            proxy_info = sanitize_proxy_for_logs(self.proxy) if self.proxy else "без прокси"
+            
+            if self.proxy:
+                logger.info(f"Отправка запроса к VK API: {method} через прокси {proxy_info} c параметрами {log_params}")
+            else:
+                logger.info(f"Отправка запроса к VK API: {method} без прокси c параметрами {log_params}")
+            
+            # execute (до 25 вызовов, кириллица в запросах) отправляется POST-формой, чтобы не упираться в длину URL
+            if method == "execute":
+                http_method, payload = "POST", {"data": request_params}
+            else:
+                http_method, payload = "GET", {"params": request_params}
+            
+            # Сначала пробуем с прокси, если он задан и валиден (SOCKS встроен в коннектор сессии)
+            if self.proxy and proxy_valid:
+                try:
+                    session, request_proxy = await self.transport.get_session(self.account_id, self.proxy)
+                    async with session.request(http_method, f"{self.base_url}/{method}", proxy=request_proxy, **payload) as response:
+                        return await self._process_response(response)
+                except aiohttp.ClientProxyConnectionError as e:
+                    logger.error(f"Ошибка подключения через прокси {proxy_info}: {e}")
+                    logger.warning(f"Пробуем запрос без прокси после ошибки")
+                except Exception as e:
+                    logger.error(f"Ошибка при запросе через прокси {proxy_info}: {e}")
+                    logger.warning(f"Пробуем запрос без прокси после ошибки")
+            
+            # Если прокси не задан, не валиден или произошла ошибка - пробуем без прокси
+            session, _ = await self.transport.get_session(self.account_id)
+            async with session.request(http_method, f"{self.base_url}/{method}", **payload) as response:
+                return await self._process_response(response)
+            
+        except Exception as e:
+            import traceback
+            tb = traceback.format_exc()
+            logger.error(f"Ошибка при выполнении запроса к VK API: {e}")
+            logger.error(f"Трассировка: {tb}")
+            return {}, None
 
     async def test_connection(self) -> bool:
         """
@@ -385,8 +619,8 @@ class VKClient:
             logger.error(f"Ошибка при проверке соединения VK: {e}")
             return False
     
-    async def _process_response(self, response, method, params):
-        """Обрабатывает ответ от API VK."""
+    async def _process_response(self, response) -> Tuple[Dict, Optional[int]]:
+        """Обрабатывает ответ от API VK. Возвращает (результат или {}, код ошибки VK)."""
         if response.status != 200:
             logger.error(f"Ошибка при запросе к VK API: статус {response.status}")
             try:
@@ -394,13 +628,13 @@ class VKClient:
                 logger.error(f"Текст ошибки: {error_text}")
             except:
                 pass
-            return {}
+            return {}, None
         
         try:
             result = await response.json()
         except Exception as e:
             logger.error(f"Ошибка при декодировании JSON ответа: {e}")
-            return {}
+            return {}, None
         
         # Проверяем ошибки VK API
         if "error" in result:
@@ -410,28 +644,77 @@ class VKClient:
             # Если токен недействителен или истек
             if error.get("error_code") in [5, 27]:
                 logger.error("Токен недействителен или истек")
-                return {}
             
-            # Если превышен лимит запросов
-            if error.get("error_code") == 29:
-                logger.warning("Превышен лимит запросов к VK API")
-                await asyncio.sleep(1)  # Увеличиваем задержку при превышении лимита
-                return await self._make_request(method, params)  # Повторяем запрос
-            
-            return {}
+            # Ошибки 6 и 29 (лимиты частоты) обрабатывает _make_request
+            return {}, error.get("error_code")
         
         self.requests_count += 1
         if self.account_id and self.api_key:
             await update_account_usage(self.api_key, self.account_id, "vk")
         
-        return result
+        return result, None
 
     async def _make_group_request(self, method: str, params: Dict) -> Dict:
-        """Выполняет запрос к группе с дополнительной задержкой."""
-        group_delay = GROUP_DELAY * 2 if self.degraded_mode else GROUP_DELAY
-        await asyncio.sleep(group_delay)
+        """Выполняет запрос к группе (темп задает лимитер токена)."""
         return await self._make_request(method, params)
 
+    async def execute_many(self, calls: List[Tuple[str, Dict]]) -> List[Dict]:
+        """Выполняет вызовы API пачками до VK_EXECUTE_BATCH_SIZE через execute.
+
+        Возвращает результаты в порядке calls в том же виде, что и _make_request:
+        {"response": ...} при успехе, {"error": {...}} при ошибке отдельного вызова,
+        {} если не удалось выполнить весь execute. Ошибки 6 и 29 отдельных вызовов
+        передаются лимитеру токена; вызовы с ошибкой 6 повторяются не более VK_MAX_RETRIES раз.
+        """
+        results: List[Dict] = [{} for _ in calls]
+        pending = list(range(len(calls)))
+        for attempt in range(VK_MAX_RETRIES + 1):
+            retry = []
+            for start in range(0, len(pending), VK_EXECUTE_BATCH_SIZE):
+                indexes = []
+                for index in pending[start:start + VK_EXECUTE_BATCH_SIZE]:
+                    method = calls[index][0]
+                    if self.rate_limiter.is_blocked(self.access_token, method):
+                        # Метод исчерпал лимит для токена - не тратим на него место в execute
+                        results[index] = {"error": {"error_code": 29, "error_msg": f"Лимит метода {method} для токена исчерпан"}}
+                    else:
+                        indexes.append(index)
+                if not indexes:
+                    continue
+                batch = [calls[index] for index in indexes]
+                if len(batch) == 1:
+                    method, params = batch[0]
+                    results[indexes[0]] = await self._make_request(method, params)
+                    continue
+                result = await self._make_request("execute", {"code": build_execute_code(batch)})
+                responses = result.get("response") if result else None
+                if not isinstance(responses, list) or len(responses) != len(batch):
+                    logger.error(f"execute не выполнен для {len(batch)} вызовов ({batch[0][0]}...)")
+                    continue
+                # Для каждого неудачного вызова VK возвращает false, а ошибки - по порядку в execute_errors
+                errors = iter(result.get("execute_errors") or [])
+                too_many_requests = False
+                for index, (method, _params), response in zip(indexes, batch, responses):
+                    if response is not False:
+                        results[index] = {"response": response}
+                        continue
+                    error = next(errors, None) or {"error_code": None, "error_msg": "неизвестная ошибка"}
+                    logger.error(f"Ошибка VK API в execute ({method}): {error.get('error_code')} - {error.get('error_msg')}")
+                    results[index] = {"error": error}
+                    if error.get("error_code") == 6:
+                        too_many_requests = True
+                        retry.append(index)
+                    elif error.get("error_code") == 29:
+                        self.rate_limiter.on_method_limit(self.access_token, method)
+                if too_many_requests:
+                    self.rate_limiter.on_too_many_requests(self.access_token) # Один раз на execute, а не на каждый вызов
+            if not retry:
+                break
+            if attempt < VK_MAX_RETRIES:
+                logger.warning(f"Повтор {len(retry)} вызовов execute после ошибки 6, попытка {attempt + 2}/{VK_MAX_RETRIES + 1}")
+            pending = retry
+        return results
+
     async def find_groups(self, keywords: List[str], min_members: int = 10000, max_groups: int = 20) -> List[Dict]:
         """Поиск групп по ключевым словам."""
         groups = []
@@ -463,6 +746,7 @@ class VKClient:
         """Получение постов из групп."""
         posts = []
         cutoff_date = datetime.now() - timedelta(days=days_back)
+        members = await self.prefetch_group_members(group_ids) # Все группы одним запросом
         
         for group_id in group_ids:
             try:
@@ -484,33 +768,21 @@ class VKClient:
                             continue
                             
                         if not keywords or any(keyword.lower() in post["text"].lower() for keyword in keywords):
-                            post_data = {
-                                "id": post["id"],
-                                "date": post_date.isoformat(), # Дата теперь в UTC
-                                "views": views,
-                                "text": post["text"],
-                                "group_id": group_id,
-                                "group_title": post.get("group_title", ""),
-                                "url": f"https://vk.com/wall-{group_id}_{post['id']}",
-                                "likes": post.get("likes", {}).get("count", 0),
-                                "reposts": post.get("reposts", {}).get("count", 0),
-                                "comments": post.get("comments", {}).get("count", 0),
-                                "group_members": await self._get_group_members_count(group_id),
-                                "media": []
-                            }
-                            
-                            # Рассчитываем показатели вовлеченности по формуле из Telegram
-                            raw_engagement_score = views + (post_data["likes"] * 10) + (post_data["comments"] * 20) + (post_data["reposts"] * 50)
-                            group_members_for_calc = max(post_data["group_members"], 10) # Минимум 10 участников для логарифма
-                            post_data["trend_score"] = int(raw_engagement_score / math.log10(group_members_for_calc)) if raw_engagement_score > 0 else 0
+                            # trend_score считается по формуле из Telegram
+                            post_data = post_from_vk(
+                                post, group_id, post.get("group_title", ""),
+                                group_members=members.get(abs(int(group_id)), DEFAULT_GROUP_MEMBERS),
+                                url=f"https://vk.com/wall-{group_id}_{post['id']}",
+                                date=post_date.isoformat() # Дата теперь в UTC
+                            )
                             
                             if "attachments" in post:
                                 for attachment in post["attachments"]:
                                     media_data = await get_media_info(attachment)
                                     if media_data:
-                                        post_data["media"].append(media_data)
+                                        post_data.media.append(media_data)
                             
-                            posts.append(post_data)
+                            posts.append(post_data.to_dict('vk'))
             except Exception as e:
                 logger.error(f"Ошибка при получении постов из группы {group_id}: {e}")
                 continue
@@ -519,7 +791,7 @@ class VKClient:
 
     async def get_vk_posts(self, group_keywords: List[str], post_keywords: List[str], count: int = 10, min_views: int = 1000, days_back: int = 3) -> List[Dict]:
         """Получение постов из групп по ключевым словам."""
-        posts = []
+        top_posts = TopK(count, key=lambda x: x["trend_score"])
         for group_keyword in group_keywords:
             try:
                 groups = await self.find_groups([group_keyword])
@@ -532,7 +804,7 @@ class VKClient:
                             min_views,
                             days_back
                         )
-                        posts.extend(group_posts)
+                        top_posts.extend(group_posts)
                     except Exception as e:
                         logger.error(f"Ошибка при получении постов из группы {group['id']}: {e}")
                         continue
@@ -540,12 +812,11 @@ class VKClient:
                 logger.error(f"Ошибка при поиске групп по ключевому слову {group_keyword}: {e}")
                 continue
         
-        return sorted(posts, key=lambda x: x["trend_score"], reverse=True)[:count]
+        return top_posts.results()
 
     async def get_posts_by_period(self, group_ids: List[int], max_posts: int = 100, days_back: int = 7, min_views: int = 0) -> List[Dict]:
         """Получение постов из групп за указанный период."""
         try:
-            all_posts = []
             cutoff_date = datetime.now() - timedelta(days=days_back)
             
             # Получаем активные аккаунты
@@ -577,15 +848,11 @@ class VKClient:
             # Ждем завершения всех задач
             results = await asyncio.gather(*tasks)
             
-            # Объединяем результаты
+            # Объединяем результаты: оставляем max_posts самых новых
+            top_posts = TopK(max_posts, key=lambda x: x["date"])
             for result in results:
-                all_posts.extend(result)
-            
-            # Сортируем посты по дате (новые сверху)
-            all_posts.sort(key=lambda x: x["date"], reverse=True)
-            
-            # Ограничиваем количество постов
-            return all_posts[:max_posts]
+                top_posts.extend(result)
+            return top_posts.results()
             
         except Exception as e:
             logger.error(f"Ошибка при получении постов: {e}")
@@ -594,183 +861,101 @@ class VKClient:
     async def process_groups(self, group_ids: List[int], max_posts: int, cutoff_date: datetime, min_views: int) -> List[Dict]:
         """Обрабатывает группы для одного аккаунта."""
         posts = []
+        parsed_groups = []
         for group_id in group_ids:
             try:
                 # Преобразуем ID группы в число, убираем минус, если есть
-                group_id_str = str(group_id).replace('-', '')
-                group_id_int = int(group_id_str)
-                
-                result = await self._make_group_request("wall.get", {
-                    "owner_id": -group_id_int,  # Используем отрицательное числовое значение
-                    "count": max_posts,
-                    "offset": 0
-                })
-                
-                if "response" in result and "items" in result["response"]:
-                    for post in result["response"]["items"]:
-                        # Создаем aware datetime в UTC
-                        post_date = datetime.fromtimestamp(post["date"], tz=timezone.utc) 
-                        if post_date < cutoff_date:
-                            continue
+                parsed_groups.append((group_id, int(str(group_id).replace('-', ''))))
+            except ValueError:
+                logger.error(f"Некорректный ID группы: {group_id}")
+        start_time = int(cutoff_date.timestamp())
+        group_by_owner = {-group_id_int: (group_id, group_id_int) for group_id, group_id_int in parsed_groups}
+        # Стены обходятся пачками через execute до начала периода, а не всегда по max_posts постов
+        async for page_round in iter_wall_pages(self, list(group_by_owner), start_time, max_posts):
+            # Недостающие числа участников - одним groups.getById
+            members = await self.prefetch_group_members([abs(owner_id) for owner_id, _offset, _response in page_round])
+            for owner_id, _offset, result in page_round:
+                group_id, group_id_int = group_by_owner[owner_id]
+                group_id_str = str(group_id_int)
+                try:
+                    if result and "response" in result and "items" in result["response"]:
+                        for post in result["response"]["items"]:
+                            if post["date"] < start_time:
+                                continue
+                            # Создаем aware datetime в UTC
+                            post_date = datetime.fromtimestamp(post["date"], tz=timezone.utc) 
+                                
+                            views = post.get("views", {}).get("count", 0)
+                            if views < min_views:
+                                continue
                             
-                        views = post.get("views", {}).get("count", 0)
-                        if views < min_views:
-                            continue
-                        
-                        post_data = {
-                            "id": post["id"],
-                            "date": post_date.isoformat(), # Дата теперь в UTC
-                            "views": views,
-                            "text": post["text"],
-                            "group_id": group_id,
-                            "group_title": post.get("group_title", ""),
-                            "url": f"https://vk.com/wall-{group_id_str}_{post['id']}",
-                            "likes": post.get("likes", {}).get("count", 0),
-                            "reposts": post.get("reposts", {}).get("count", 0),
-                            "comments": post.get("comments", {}).get("count", 0),
-                            "group_members": await self._get_group_members_count(group_id_int),
-                            "media": []
-                        }
-                        
-                        # Рассчитываем показатели вовлеченности по формуле из Telegram
-                        raw_engagement_score = views + (post_data["likes"] * 10) + (post_data["comments"] * 20) + (post_data["reposts"] * 50)
-                        group_members_for_calc = max(post_data["group_members"], 10) # Минимум 10 участников для логарифма
-                        post_data["trend_score"] = int(raw_engagement_score / math.log10(group_members_for_calc)) if raw_engagement_score > 0 else 0
-                        
-                        if "attachments" in post:
-                            for attachment in post["attachments"]:
-                                media_data = await get_media_info(attachment)
-                                if media_data:
-                                    post_data["media"].append(media_data)
-                        
-                        posts.append(post_data)
-            except Exception as e:
-                logger.error(f"Ошибка при получении постов из группы {group_id}: {e}")
-                continue
+                            # trend_score считается по формуле из Telegram
+                            post_data = post_from_vk(
+                                post, group_id, post.get("group_title", ""),
+                                group_members=members.get(group_id_int, DEFAULT_GROUP_MEMBERS),
+                                url=f"https://vk.com/wall-{group_id_str}_{post['id']}",
+                                date=post_date.isoformat() # Дата теперь в UTC
+                            )
+                            
+                            if "attachments" in post:
+                                for attachment in post["attachments"]:
+                                    media_data = await get_media_info(attachment)
+                                    if media_data:
+                                        post_data.media.append(media_data)
+                            
+                            posts.append(post_data.to_dict('vk'))
+                except Exception as e:
+                    logger.error(f"Ошибка при получении постов из группы {group_id}: {e}")
+                    continue
         
         return posts
 
-    async def _get_group_members_count(self, group_id: Union[int, str]) -> int:
-        """Получает количество участников группы с использованием Redis."""
-        # Преобразуем ID группы в число, убираем минус, если есть
-        if isinstance(group_id, str):
-            group_id_str = group_id.replace('-', '')
-            group_id_int = int(group_id_str)
-        else:
-            group_id_int = abs(group_id)  # Убираем минус, если есть
-            group_id_str = str(group_id_int)
-        
-        # Формируем ключ для Redis
-        redis_key = f"vk:group:members:{group_id_int}"
-        
-        # Проверяем Redis, если доступен
-        if redis_client:
+    async def prefetch_group_members(self, group_ids: List[Union[int, str]]) -> Dict[int, int]:
+        """Числа участников для всех групп запроса: из общего кэша, недостающие - одним groups.getById на 500 id.
+
+        Возвращает таблицу {group_id (без минуса): members_count} для обработки постов.
+        """
+        ids = []
+        for group_id in group_ids:
             try:
-                cached_value = redis_client.get(redis_key)
-                if cached_value:
-                    members_count = int(cached_value)
-                    logger.info(f"Получено количество участников группы {group_id_int} из Redis: {members_count}")
-                    return members_count
+                ids.append(abs(int(str(group_id).replace('-', ''))))
+            except ValueError:
+                logger.error(f"Некорректный ID группы: {group_id}")
+        unique_ids = list(dict.fromkeys(ids))
+        counts = await _cached_group_members_many(unique_ids)
+        missing = [group_id for group_id in unique_ids if group_id not in counts]
+
+        for start in range(0, len(missing), VK_GROUPS_BY_ID_MAX):
+            chunk = missing[start:start + VK_GROUPS_BY_ID_MAX]
+            try:
+                result = await self._make_request("groups.getById", {
+                    "group_ids": ",".join(str(group_id) for group_id in chunk),
+                    "fields": "members_count"
+                })
             except Exception as e:
-                logger.error(f"Ошибка при чтении из Redis: {e}")
-        
-        # Проверяем глобальный кэш в памяти как fallback
-        if group_id_int in GROUP_MEMBERS_CACHE:
-            logger.info(f"Получено количество участников группы {group_id_int} из глобального кэша: {GROUP_MEMBERS_CACHE[group_id_int]}")
-            return GROUP_MEMBERS_CACHE[group_id_int]
-            
-        # Затем локальный кэш экземпляра
-        if group_id_int in self.group_members_cache:
-            logger.info(f"Получено количество участников группы {group_id_int} из локального кэша: {self.group_members_cache[group_id_int]}")
-            return self.group_members_cache[group_id_int]
-            
-        try:
-            logger.info(f"Запрашиваем количество участников группы {group_id_int}")
-            
-            # Попробуем сначала новый подход - используем версию API 5.199 с правильными параметрами
-            result = await self._make_request("groups.getById", {
-                "group_ids": str(group_id_int),  # Используем group_ids для совместимости с новой версией API
-                "fields": "members_count"
-            })
-            
-            if "response" in result and result["response"]:
-                # Новый формат ответа VK API - данные находятся в response.groups
-                if "groups" in result["response"] and result["response"]["groups"]:
-                    group_data = result["response"]["groups"][0]
-                    
-                    # Проверяем разные возможные поля для количества участников
-                    members_count = None
-                    if "members_count" in group_data:
-                        members_count = group_data["members_count"]
-                    elif "member_count" in group_data:  # Возможное альтернативное название
-                        members_count = group_data["member_count"]
-                    elif "count" in group_data:  # Еще одно возможное название
-                        members_count = group_data["count"]
-                else:
-                    # Старый формат ответа (для совместимости)
-                    group_data = result["response"][0] if isinstance(result["response"], list) else result["response"]
-                    
-                    # Проверяем разные возможные поля для количества участников
-                    members_count = None
-                    if "members_count" in group_data:
-                        members_count = group_data["members_count"]
-                    elif "member_count" in group_data:  # Возможное альтернативное название
-                        members_count = group_data["member_count"]
-                    elif "count" in group_data:  # Еще одно возможное название
-                        members_count = group_data["count"]
-                
-                if members_count is not None:
-                    logger.info(f"Получено количество участников группы {group_id_int}: {members_count}")
-                    
-                    # Сохраняем результат во всех кэшах
-                    self.group_members_cache[group_id_int] = members_count
-                    GROUP_MEMBERS_CACHE[group_id_int] = members_count
-                    
-                    # Сохраняем в Redis с TTL, если доступен
-                    if redis_client:
-                        try:
-                            redis_client.setex(redis_key, GROUP_MEMBERS_CACHE_TTL, members_count)
-                            logger.info(f"Сохранено количество участников группы {group_id_int} в Redis с TTL {GROUP_MEMBERS_CACHE_TTL} сек")
-                        except Exception as e:
-                            logger.error(f"Ошибка при сохранении в Redis: {e}")
-                    
-                    return members_count
-                else:
-                    logger.warning(f"Поле members_count не найдено в ответе для группы {group_id_int}. Доступные поля: {list(group_data.keys())}")
-                    
-                    # Попробуем альтернативный подход - используем groups.getById без fields
-                    logger.info(f"Пробуем альтернативный метод для группы {group_id_int}")
-                    alt_result = await self._make_request("groups.getById", {
-                        "group_ids": str(group_id_int)
-                    })
-                    
-                    if "response" in alt_result and alt_result["response"]:
-                        if "groups" in alt_result["response"] and alt_result["response"]["groups"]:
-                            alt_group_data = alt_result["response"]["groups"][0]
-                            # Если поле members_count все еще отсутствует, используем значение по умолчанию
-                            if "members_count" in alt_group_data:
-                                members_count = alt_group_data["members_count"]
-                                logger.info(f"Получено количество участников группы {group_id_int} через альтернативный метод: {members_count}")
-                                
-                                # Сохраняем результат во всех кэшах
-                                self.group_members_cache[group_id_int] = members_count
-                                GROUP_MEMBERS_CACHE[group_id_int] = members_count
-                                
-                                if redis_client:
-                                    try:
-                                        redis_client.setex(redis_key, GROUP_MEMBERS_CACHE_TTL, members_count)
-                                    except Exception as e:
-                                        logger.error(f"Ошибка при сохранении в Redis: {e}")
-                                
-                                return members_count
-                    
-                    return 10000  # Возвращаем значение по умолчанию
-            else:
-                logger.warning(f"Не удалось получить количество участников группы {group_id_int}. Полный ответ: {result}")
-                return 10000  # Возвращаем значение по умолчанию
-        except Exception as e:
-            logger.error(f"Ошибка при получении количества участников группы {group_id_int}: {e}")
-            return 10000  # Возвращаем значение по умолчанию в случае ошибки
+                logger.error(f"Ошибка при получении количества участников {len(chunk)} групп: {e}")
+                continue
+            response = result.get("response") if result else None
+            # Новый формат ответа VK API - данные в response.groups, старый - список групп
+            groups = response.get("groups", []) if isinstance(response, dict) else (response or [])
+            fetched = {}
+            for group_data in groups:
+                members_count = _extract_members_count(group_data)
+                if members_count is not None and group_data.get("id") is not None:
+                    fetched[abs(int(group_data["id"]))] = members_count
+            await _cache_group_members(fetched)
+            counts.update(fetched)
+            if len(fetched) < len(chunk):
+                logger.warning(f"Не удалось получить количество участников для {len(chunk) - len(fetched)} из {len(chunk)} групп")
+
+        logger.info(f"Количество участников: {len(unique_ids)} групп, из кэша {len(unique_ids) - len(missing)}, запрошено {len(missing)}")
+        return counts
+
+    async def _get_group_members_count(self, group_id: Union[int, str]) -> int:
+        """Получает количество участников одной группы (общий кэш, затем groups.getById)."""
+        group_id_int = abs(int(str(group_id).replace('-', '')))
+        counts = await self.prefetch_group_members([group_id_int])
+        return counts.get(group_id_int, DEFAULT_GROUP_MEMBERS)
 
 async def find_vk_groups(vk, keywords, min_members=10000, max_count=20):
     """
@@ -832,6 +1017,9 @@ async def find_vk_groups(vk, keywords, min_members=10000, max_count=20):
                     "members": group.get("members_count", 0),
                     "is_closed": group.get("is_closed", 1)
                 })
+                # Каталог для локального поиска (source=local|hybrid)
+                directory_writer.record('vk', group['id'], title=group.get("name"), username=group.get("screen_name"),
+                                        members_count=group.get("members_count"), is_closed=group.get("is_closed", 1) != 0)
             
             all_groups.extend(groups)
             # Добавляем задержку между запросами как в JS-версии
@@ -870,27 +1058,26 @@ async def find_vk_groups(vk, keywords, min_members=10000, max_count=20):
     
     return result
 
-async def get_vk_posts_in_groups(vk, group_ids, keywords=None, count=10, min_views=1000, days_back=7, max_posts_per_group=300):
+async def get_vk_posts_in_groups(vk, group_ids, keywords=None, count=10, min_views=1000, days_back=7, max_posts_per_group=300, score_formula=None,
+                                 search_mode='wall'):
     """
     Получение постов из групп ВКонтакте.
     
     Args:
         vk (VKClient): Инициализированный клиент VK
-        group_ids (list): Список ID групп
+        group_ids (list): Список ID групп. Пустой список с keywords - поиск по всему VK (newsfeed.search)
         keywords (list, optional): Список ключевых слов для фильтрации постов
         count (int): Общее количество постов для возврата
         min_views (int): Минимальное количество просмотров поста
         days_back (int): Количество дней назад для поиска
         max_posts_per_group (int): Максимальное количество постов из одной группы
+        score_formula (str, optional): Формула trend_score для ранжирования (см. scoring.FORMULAS)
+        search_mode (str): Отбор по keywords: 'search' - поиском VK, 'wall' (по умолчанию) - по загруженным стенам,
+            'auto' - поиском VK для избирательного набора слов (см. use_search_mode)
         
     Returns:
         list: Отсортированный список постов, отвечающих критериям
     """
-    # Проверки
-    if vk is None or not vk.access_token or not group_ids:
-        logger.error("VK клиент не инициализирован, токен пуст или не указаны ID групп")
-        return []
-    
     # Приводим входные параметры к нужному типу
     if isinstance(group_ids, str):
         group_ids = [group_ids]
@@ -898,134 +1085,98 @@ async def get_vk_posts_in_groups(vk, group_ids, keywords=None, count=10, min_vie
     if keywords and isinstance(keywords, str):
         keywords = [keywords]
     
-    logger.info(f"Поиск постов в группах {group_ids} за {days_back} дней{' по ключевым словам: ' + ', '.join(keywords) if keywords else ' (тренды)'}")
+    # Проверки
+    if vk is None or not vk.access_token or not (group_ids or keywords):
+        logger.error("VK клиент не инициализирован, токен пуст или не указаны ID групп")
+        return []
+    # Без групп искать можно только поиском VK
+    search = use_search_mode(keywords, 'search' if not group_ids else search_mode)
+    
+    logger.info(f"Поиск постов в группах {group_ids or 'всего VK'} за {days_back} дней{' по ключевым словам: ' + ', '.join(keywords) if keywords else ' (тренды)'}"
+                f"{' (поиск VK)' if search else ''}")
     
     # Рассчитываем timestamp для фильтрации по дате
     now = int(time.time())
     start_time = now - (days_back * 24 * 60 * 60)
     
-    all_posts = []
-    
-    # Разбиваем на чанки для параллельного выполнения
-    chunk_size = 3
-    group_chunks = [group_ids[i:i+chunk_size] for i in range(0, len(group_ids), chunk_size)]
-    
-    for chunk in group_chunks:
-        tasks = []
-        for group_id in chunk:
-            async def get_posts_from_group(gid=group_id):
-                try:
-                    # Приводим ID группы к нужному формату
-                    gid_str = str(gid).replace('-', '')
-                    owner_id = -int(gid_str)
-                    offset = 0
-                    group_posts = []
-                    # Получаем посты порциями
-                    while offset < max_posts_per_group:
-                        response = await vk._make_request("wall.get", {
-                            "owner_id": owner_id,
-                            "count": 100,
-                            "offset": offset,
-                            "extended": 1
-                        })
-                        if not response or "response" not in response:
-                            logger.error(f"Ошибка получения постов из группы {gid}")
-                            break
-                        posts = response["response"]["items"]
-                        logger.info(f"Получено {len(posts)} постов из группы {gid}, offset: {offset}")
-                        if not posts:
-                            break
-                        # Фильтруем посты
-                        for post in posts:
-                            if post["date"] < start_time or post["date"] > now:
-                                continue
-                            views_count = post.get("views", {}).get("count", 0)
-                            if views_count < min_views:
-                                continue
-                            if keywords and not any(kw.lower() in post.get("text", "").lower() for kw in keywords):
-                                continue
-                            group_posts.append(post)
-                        offset += 100
-                        if len(posts) < 100:
-                            break
-                    return group_posts
-                except Exception as e:
-                    logger.error(f"Ошибка при получении постов из группы {gid}: {str(e)}")
-                    return []
-            tasks.append(get_posts_from_group())
-        # Запускаем задачи параллельно
-        results = await asyncio.gather(*tasks)
-        for posts in results:
-            all_posts.extend(posts)
-        await asyncio.sleep(0.333)
-    
-    # Делаем посты уникальными
-    unique_posts = []
-    seen_keys = set()
-    
-    for post in all_posts:
-        post_key = f"{post['owner_id']}_{post['id']}"
-        if post_key not in seen_keys:
-            seen_keys.add(post_key)
-            unique_posts.append(post)
-    
-    # Сортируем посты
-    sorted_posts = []
+    # Лучшие посты отбираются по мере загрузки групп: в памяти не больше count постов
     if keywords and len(keywords) > 0:
         # По просмотрам при поиске по ключевым словам
-        sorted_posts = sorted(
-            unique_posts, 
-            key=lambda p: p.get("views", {}).get("count", 0), 
-            reverse=True
-        )[:count]
+        top_posts = TopK(count, key=lambda p: p.get("views", {}).get("count", 0))
     else:
-        # По "тренду" для обычного поиска
-        for post in unique_posts:
-            # Получаем количество участников группы
-            gid_str = str(post.get("owner_id", "0")).replace('-', '')
-            group_id = int(gid_str)
-            
-            # Проверяем Redis и кэши
-            redis_key = f"vk:group:members:{group_id}"
-            group_members = None
-            
-            # Проверяем Redis, если доступен
-            if redis_client:
-                try:
-                    cached_value = redis_client.get(redis_key)
-                    if cached_value:
-                        group_members = int(cached_value)
-                        logger.info(f"Использовано количество участников группы {group_id} из Redis: {group_members}")
-                except Exception as e:
-                    logger.error(f"Ошибка при чтении из Redis: {e}")
-            
-            # Проверяем глобальный кэш если Redis не сработал
-            if group_members is None and group_id in GROUP_MEMBERS_CACHE:
-                group_members = GROUP_MEMBERS_CACHE[group_id]
-                logger.info(f"Использовано количество участников группы {group_id} из глобального кэша: {group_members}")
-            
-            # Запрашиваем через API если нет в кэшах
-            if group_members is None:
-                try:
-                    group_members = await vk._get_group_members_count(group_id)
-                except Exception as e:
-                    logger.error(f"Ошибка при получении количества участников группы {group_id}: {e}")
-                    group_members = 10000  # Значение по умолчанию
-            
-            # Рассчитываем показатели вовлеченности по формуле из Telegram
-            raw_engagement_score = (
-                post.get("views", {}).get("count", 0) + 
-                (post.get("likes", {}).get("count", 0) * 10) + 
-                (post.get("comments", {}).get("count", 0) * 20) + 
-                (post.get("reposts", {}).get("count", 0) * 50)
-            )
-            group_members_for_calc = max(group_members, 10)  # Минимум 10 участников для логарифма
-            post["trend_score"] = int(raw_engagement_score / math.log10(group_members_for_calc)) if raw_engagement_score > 0 else 0
-        sorted_posts = sorted(
-            unique_posts, 
-            key=lambda p: p.get("trend_score", 0), 
-            reverse=True
-        )[:count]
+        # По "тренду" для обычного поиска. Для формулы, отличной от базовой, нужны все кандидаты
+        score_formula = scoring.normalize_formula(score_formula)
+        rescore = score_formula != scoring.DEFAULT_FORMULA
+        top_posts = TopK(None if rescore else count, key=lambda p: p.get("trend_score", 0))
+    seen_keys = set() # Делаем посты уникальными
+    members_by_owner = {} # owner_id -> число участников (для trend_score и пересчета формулой)
+    
+    owner_ids = []
+    for gid in group_ids:
+        try:
+            owner_ids.append(-int(str(gid).replace('-', ''))) # Приводим ID группы к нужному формату
+        except ValueError:
+            logger.error(f"Некорректный ID группы: {gid}")
+    
+    # Стены обходятся раундами (до 25 вызовов в одном execute) и только до начала периода.
+    # В режиме поиска кандидатов отбирает сам VK: wall.search по группам или newsfeed.search по всему VK.
+    # Поиск VK морфологический, поэтому результаты дополнительно проверяются той же проверкой подстроки
+    if not group_ids:
+        pages = iter_newsfeed_search_pages(vk, keywords, start_time, now, max_posts_per_group)
+    else:
+        pages = iter_wall_pages(vk, list(dict.fromkeys(owner_ids)), start_time, max_posts_per_group, queries=keywords if search else None)
+    async for page_round in pages:
+        if not keywords:
+            # Числа участников для trend_score: уже из ответов wall.get, недостающие - одним groups.getById
+            members = await vk.prefetch_group_members([owner_id for owner_id, _offset, _response in page_round])
+        for source, offset, response in page_round:
+            source_name = f"группы {abs(source)}" if isinstance(source, int) else f"поиска '{source}'"
+            try:
+                if not response or "response" not in response:
+                    logger.error(f"Ошибка получения постов из {source_name}")
+                    continue
+                posts = response["response"].get("items", [])
+                logger.info(f"Получено {len(posts)} постов из {source_name}, offset: {offset}")
+                # Фильтруем посты
+                for post in posts:
+                    if post["date"] < start_time or post["date"] > now:
+                        continue
+                    views_count = post.get("views", {}).get("count", 0)
+                    if views_count < min_views:
+                        continue
+                    if keywords and not any(kw.lower() in post.get("text", "").lower() for kw in keywords):
+                        continue
+                    post_key = f"{post['owner_id']}_{post['id']}"
+                    if post_key in seen_keys:
+                        continue
+                    seen_keys.add(post_key)
+                    if not keywords:
+                        post_owner = post.get("owner_id", source)
+                        if post_owner not in members_by_owner:
+                            members_by_owner[post_owner] = members.get(abs(int(post_owner)), DEFAULT_GROUP_MEMBERS)
+                        # Рассчитываем показатели вовлеченности по формуле из Telegram
+                        views, likes, comments, reposts = vk_counters(post)
+                        post["trend_score"] = vk_trend_score(views, likes, comments, reposts, members_by_owner[post_owner])
+                    top_posts.push(post)
+            except Exception as e:
+                logger.error(f"Ошибка при получении постов из {source_name}: {str(e)}")
+    
+    sorted_posts = top_posts.results()
+    if not keywords and rescore and sorted_posts:
+        # Пересчитываем оценки выбранной формулой одним пакетом
+        counters = [vk_counters(post) for post in sorted_posts]
+        scores = scoring.score_columns(
+            [c[0] for c in counters], [c[1] for c in counters], [c[2] for c in counters], [c[3] for c in counters],
+            [members_by_owner.get(post.get("owner_id")) for post in sorted_posts],
+            ages_hours=[(now - post["date"]) / 3600 for post in sorted_posts],
+            channel_ids=[post.get("owner_id") for post in sorted_posts],
+            formula=score_formula,
+        )
+        rescored = TopK(count, key=lambda p: p["trend_score"])
+        for post, score in zip(sorted_posts, scores):
+            post["trend_score"] = scoring.round_score(score, score_formula)
+            rescored.push(post)
+        sorted_posts = rescored.results()
     
     # Преобразуем в нужный формат
     result = []
@@ -1045,28 +1196,19 @@ async def get_vk_posts_in_groups(vk, group_ids, keywords=None, count=10, min_vie
                     media_links.append(attachment["doc"]["url"])
         
         # Формируем пост
-        formatted_post = {
-            "text": post.get("text", ""),
-            "likes": post.get("likes", {}).get("count", 0),
-            "reposts": post.get("reposts", {}).get("count", 0),
-            "comments": post.get("comments", {}).get("count", 0),
-            "views": post.get("views", {}).get("count", 0),
-            "date": datetime.fromtimestamp(post["date"]).isoformat(),
-            "post_id": post["id"],
-            "owner_id": post["owner_id"],
-            "url": f"https://vk.com/wall{post['owner_id']}_{post['id']}",
-            "trend_score": post.get("trend_score")
-        }
-        
-        if media_links:
-            formatted_post["media"] = media_links
+        formatted_post = post_from_vk(
+            post, post["owner_id"],
+            date=datetime.fromtimestamp(post["date"]).isoformat(),
+            trend_score=post.get("trend_score")
+        )
+        formatted_post.media = media_links or None # Ключ media только при наличии ссылок
         
-        result.append(formatted_post)
+        result.append(formatted_post.to_dict('vk_wall'))
     
     logger.info(f"Найдено {len(result)} постов, соответствующих критериям")
     return result
 
-async def get_vk_posts(vk, group_keywords, search_keywords=None, count=10, min_views=1000, days_back=7, max_groups=10, max_posts_per_group=300):
+async def get_vk_posts(vk, group_keywords, search_keywords=None, count=10, min_views=1000, days_back=7, max_groups=10, max_posts_per_group=300, search_mode='wall'):
     """Получение постов из групп по ключевым словам.
     
     Args:
@@ -1078,6 +1220,7 @@ async def get_vk_posts(vk, group_keywords, search_keywords=None, count=10, min_v
         days_back: Количество дней назад для поиска постов
         max_groups: Максимальное количество групп для поиска
         max_posts_per_group: Максимальное количество постов от одной группы
+        search_mode: Режим фильтрации по search_keywords (см. get_vk_posts_in_groups)
     
     Returns:
         List[Dict]: Список найденных постов
@@ -1088,7 +1231,7 @@ async def get_vk_posts(vk, group_keywords, search_keywords=None, count=10, min_v
         return []
         
     group_ids = [g['id'] for g in groups]
-    return await get_vk_posts_in_groups(vk, group_ids, search_keywords, count, min_views, days_back, max_posts_per_group)
+    return await get_vk_posts_in_groups(vk, group_ids, search_keywords, count, min_views, days_back, max_posts_per_group, search_mode=search_mode)
 
 # Функция для обработки вложений VK
 async def get_media_info(attachment):
@@ -1275,6 +1418,42 @@ async def find_groups_by_keywords(vk, keywords, min_members=10000, max_count=20,
         return []
     return result
 
+def _parse_vk_comments(response: Dict) -> List[Dict]:
+    """Комментарии из ответа wall.getComments (extended=1) с данными об авторах."""
+    items = response.get("items", [])
+    profiles = {p["id"]: p for p in response.get("profiles", [])}
+    groups = {-(g["id"]): g for g in response.get("groups", [])}
+    comments = []
+    for item in items:
+        from_id = item.get("from_id")
+        author = None
+        if from_id:
+            if from_id > 0 and from_id in profiles:
+                p = profiles[from_id]
+                author = {
+                    "id": p["id"],
+                    "first_name": p.get("first_name"),
+                    "last_name": p.get("last_name"),
+                    "screen_name": p.get("screen_name"),
+                    "photo": p.get("photo_50")
+                }
+            elif from_id < 0 and from_id in groups:
+                g = groups[from_id]
+                author = {
+                    "id": -g["id"],
+                    "name": g.get("name"),
+                    "screen_name": g.get("screen_name"),
+                    "photo": g.get("photo_50")
+                }
+        comments.append({
+            "id": item["id"],
+            "text": item.get("text", ""),
+            "date": item.get("date"),
+            "from_id": from_id,
+            "author": author
+        })
+    return comments
+
 async def fetch_vk_comments(owner_id, post_id, access_token, max_comments=100):
     """
     Получить комментарии к посту VK через VK API.
@@ -1294,52 +1473,67 @@ async def fetch_vk_comments(owner_id, post_id, access_token, max_comments=100):
         "extended": 1  # Важно: extended=1, чтобы получить profiles/groups
     }
     offset = 0
-    author_cache = {}
     try:
-        async with aiohttp.ClientSession() as session:
-            while len(comments) < max_comments:
-                params["offset"] = offset
-                params["count"] = min(100, max_comments - len(comments))
-                async with session.get(url, params=params, timeout=15) as resp:
-                    data = await resp.json()
-                    if "error" in data:
-                        return None, data["error"].get("error_msg", str(data["error"]))
-                    items = data.get("response", {}).get("items", [])
-                    profiles = {p["id"]: p for p in data.get("response", {}).get("profiles", [])}
-                    groups = {-(g["id"]): g for g in data.get("response", {}).get("groups", [])}
-                    for item in items:
-                        from_id = item.get("from_id")
-                        author = None
-                        if from_id:
-                            if from_id > 0 and from_id in profiles:
-                                p = profiles[from_id]
-                                author = {
-                                    "id": p["id"],
-                                    "first_name": p.get("first_name"),
-                                    "last_name": p.get("last_name"),
-                                    "screen_name": p.get("screen_name"),
-                                    "photo": p.get("photo_50")
-                                }
-                            elif from_id < 0 and from_id in groups:
-                                g = groups[from_id]
-                                author = {
-                                    "id": -g["id"],
-                                    "name": g.get("name"),
-                                    "screen_name": g.get("screen_name"),
-                                    "photo": g.get("photo_50")
-                                }
-                        comments.append({
-                            "id": item["id"],
-                            "text": item.get("text", ""),
-                            "date": item.get("date"),
-                            "from_id": from_id,
-                            "author": author
-                        })
-                    if len(items) < params["count"]:
-                        break  # Больше нет комментариев
-                    offset += len(items)
+        session, _ = await vk_transport.get_session(None) # Общая сессия без прокси вместо новой на каждый пост
+        while len(comments) < max_comments:
+            params["offset"] = offset
+            params["count"] = min(100, max_comments - len(comments))
+            async with session.get(url, params=params, timeout=15) as resp:
+                data = await resp.json()
+                if "error" in data:
+                    return None, data["error"].get("error_msg", str(data["error"]))
+                items = data.get("response", {}).get("items", [])
+                comments.extend(_parse_vk_comments(data.get("response", {})))
+                if len(items) < params["count"]:
+                    break  # Больше нет комментариев
+                offset += len(items)
         if not comments:
             return [], "no_comments"
         return comments, None
     except Exception as e:
-        return None, str(e)
\ No newline at end of file
+        return None, str(e)
+
+async def fetch_vk_comments_batch(vk: VKClient, posts: List[Tuple[int, int]], max_comments: int = 100) -> Dict[Tuple[int, int], Tuple[Optional[List[Dict]], Optional[str]]]:
+    """
+    Комментарии к нескольким постам VK: страницы wall.getComments разных постов
+    запрашиваются вместе через execute (до 25 вызовов за запрос).
+    posts: список (owner_id, post_id)
+    Возвращает {(owner_id, post_id): (comments, error)} в формате fetch_vk_comments.
+    """
+    comments_by_post: Dict[Tuple[int, int], List[Dict]] = {post: [] for post in posts}
+    errors: Dict[Tuple[int, int], str] = {}
+    offsets = {post: 0 for post in comments_by_post}
+    while offsets:
+        active = list(offsets.items())
+        calls = []
+        for (owner_id, post_id), offset in active:
+            calls.append(("wall.getComments", {
+                "owner_id": owner_id,
+                "post_id": post_id,
+                "offset": offset,
+                "count": min(100, max_comments - len(comments_by_post[(owner_id, post_id)])),
+                "extended": 1 # profiles/groups для авторов
+            }))
+        responses = await vk.execute_many(calls)
+        for ((post, offset), call), result in zip(zip(active, calls), responses):
+            if not result or "response" not in result:
+                error = (result or {}).get("error") or {}
+                errors[post] = error.get("error_msg") or "Ошибка запроса к VK API"
+                offsets.pop(post, None)
+                continue
+            items = result["response"].get("items", [])
+            comments_by_post[post].extend(_parse_vk_comments(result["response"]))
+            if len(items) < call[1]["count"] or len(comments_by_post[post]) >= max_comments:
+                offsets.pop(post, None) # Больше нет комментариев или достигнут лимит
+            else:
+                offsets[post] = offset + len(items)
+
+    results = {}
+    for post, comments in comments_by_post.items():
+        if post in errors and not comments:
+            results[post] = (None, errors[post])
+        elif not comments:
+            results[post] = ([], "no_comments")
+        else:
+            results[post] = (comments, None)
+    return results
\ No newline at end of file